@@ -0,0 +1,270 @@
+"""
+Token-budgeted conversation history for the chat prompt.
+
+Recent messages are sent verbatim. Older messages are folded, a batch at a
+time, into a rolling summary stored on the Chat, so every request reads a
+bounded number of rows and the history part of the prompt never grows past
+CHAT_HISTORY_TOKEN_BUDGET no matter how long the chat is.
+"""
+import logging
+from functools import lru_cache
+
+import tiktoken
+from django.conf import settings
+from langchain.prompts import PromptTemplate
+
+from .llm import CHAT_MODEL, get_chain
+from .models import Chat, Message
+
+logger = logging.getLogger(__name__)
+
+HISTORY_MODEL = CHAT_MODEL
+
+SUMMARY_PROMPT = PromptTemplate(
+    input_variables=["summary", "messages"],
+    template="""
+You are keeping notes for a mental health professional. Update the running summary of the
+conversation with the new messages below. Keep the client's concerns, feelings, important
+facts and anything the therapist suggested. Be brief and write in the third person.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}
+Updated summary:""",
+)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=HISTORY_MODEL):
+    """
+    Return the tiktoken encoding for the model, loaded once per process.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text):
+    """
+    Count the tokens of text the way the chat model will see them.
+    """
+    if not text:
+        return 0
+    return len(get_encoding().encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """
+    Cut text down to at most max_tokens tokens.
+    """
+    tokens = get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoding().decode(tokens[:max_tokens])
+
+
+def format_message(msg):
+    """
+    Render a single message as a line of the prompt history.
+    """
+    # user_id avoids loading the user row just to know who spoke
+    sender = "Client" if msg.user_id else "Therapist"
+    return f"{sender}: {msg.content}\n"
+
+
+def fit_to_budget(lines, budget):
+    """
+    Return how many of the newest lines fit into budget tokens.
+    """
+    used = 0
+    kept = 0
+    for line in reversed(lines):
+        used += count_tokens(line)
+        if used > budget:
+            break
+        kept += 1
+    return kept
+
+
+def render_history(summary, lines):
+    """
+    Join the rolling summary and the verbatim lines into the prompt history.
+    """
+    parts = []
+    if summary:
+        parts.append(f"(Summary of the earlier conversation: {summary})\n")
+    parts.extend(lines)
+    return "".join(parts)
+
+
+def get_summary_chain():
+    """
+    Return the shared prompt | chat model sequence used for summarizing.
+    """
+    return get_chain(
+        SUMMARY_PROMPT,
+        model=HISTORY_MODEL,
+        temperature=0,
+        max_tokens=settings.CHAT_SUMMARY_MAX_TOKENS,
+    )
+
+
+def summary_inputs(summary, messages):
+    return {
+        "summary": summary or "(none yet)",
+        "messages": "".join(format_message(msg) for msg in messages),
+    }
+
+
+def summarize_messages(summary, messages):
+    """
+    Fold messages into the existing summary with the LLM and return the new summary.
+    """
+    response = get_summary_chain().invoke(summary_inputs(summary, messages))
+    return truncate_tokens(response.content.strip(), settings.CHAT_SUMMARY_MAX_TOKENS)
+
+
+async def asummarize_messages(summary, messages):
+    """
+    Async summarize_messages.
+    """
+    response = await get_summary_chain().ainvoke(summary_inputs(summary, messages))
+    return truncate_tokens(response.content.strip(), settings.CHAT_SUMMARY_MAX_TOKENS)
+
+
+def plan_history(chat, rows):
+    """
+    Decide which of the unsummarized rows stay verbatim.
+
+    rows are the newest unsummarized messages, oldest first. Returns a tuple of
+    (kept, to_fold) where kept is the verbatim suffix of rows and to_fold is the
+    older part that should be folded into the summary, or None when everything
+    still fits and no summarization is needed.
+    """
+    recent = settings.CHAT_HISTORY_RECENT_MESSAGES
+    limit = recent + settings.CHAT_SUMMARY_BATCH_SIZE
+    lines = [format_message(msg) for msg in rows]
+    budget = max(settings.CHAT_HISTORY_TOKEN_BUDGET - count_tokens(chat.summary), 0)
+    fit = fit_to_budget(lines, budget)
+
+    # Let the verbatim window grow until it hits the budget or the batch size, so
+    # the summary is only rewritten once every few turns.
+    if fit == len(rows) and len(rows) < limit:
+        return rows, None
+
+    kept = min(fit, recent)
+    return rows[len(rows) - kept:], rows[:len(rows) - kept]
+
+
+def save_summary(chat, summary, folded):
+    """
+    Store the new summary unless another request already moved the marker.
+    """
+    updated = Chat.objects.filter(
+        pk=chat.pk, summarized_until_id=chat.summarized_until_id
+    ).update(summary=summary, summarized_until_id=folded[-1].id)
+    if updated:
+        chat.summary = summary
+        chat.summarized_until_id = folded[-1].id
+
+
+async def asave_summary(chat, summary, folded):
+    """
+    Async save_summary.
+    """
+    updated = await Chat.objects.filter(
+        pk=chat.pk, summarized_until_id=chat.summarized_until_id
+    ).aupdate(summary=summary, summarized_until_id=folded[-1].id)
+    if updated:
+        chat.summary = summary
+        chat.summarized_until_id = folded[-1].id
+
+
+def finish_history(chat, kept, unfolded=()):
+    """
+    Render the summary plus as many kept messages as fit next to it. unfolded
+    are older messages that should have been folded into the summary but were
+    not (summarizing failed); they are sent verbatim as far as the budget
+    allows, dropping the oldest first.
+    """
+    lines = [format_message(msg) for msg in [*unfolded, *kept]]
+    budget = max(settings.CHAT_HISTORY_TOKEN_BUDGET - count_tokens(chat.summary), 0)
+    fit = fit_to_budget(lines, budget)
+    return render_history(chat.summary, lines[len(lines) - fit:])
+
+
+def unsummarized_messages(chat, exclude_message_id=None):
+    """
+    Queryset of messages in the chat that are not part of the summary yet.
+    """
+    messages = Message.objects.filter(chat=chat).only("id", "user_id", "content")
+    if chat.summarized_until_id is not None:
+        messages = messages.filter(id__gt=chat.summarized_until_id)
+    if exclude_message_id is not None:
+        messages = messages.exclude(id=exclude_message_id)
+    return messages
+
+
+def build_conversation_history(chat, exclude_message_id=None):
+    """
+    Build the history for the prompt within CHAT_HISTORY_TOKEN_BUDGET tokens.
+
+    At most CHAT_HISTORY_RECENT_MESSAGES + CHAT_SUMMARY_BATCH_SIZE rows are read
+    per call, and at most one summarization call is made.
+    """
+    limit = settings.CHAT_HISTORY_RECENT_MESSAGES + settings.CHAT_SUMMARY_BATCH_SIZE
+    messages = unsummarized_messages(chat, exclude_message_id)
+    rows = list(messages.order_by("-id")[:limit])
+    rows.reverse()
+
+    kept, to_fold = plan_history(chat, rows)
+    unfolded = ()
+    if to_fold is not None:
+        older = to_fold
+        if len(rows) == limit:
+            # There may be older unsummarized messages (e.g. chats from before the
+            # summary existed); catch up from the oldest one, a batch per request.
+            boundary = kept[0].id if kept else rows[-1].id + 1
+            to_fold = list(
+                messages.filter(id__lt=boundary).order_by("id")[:settings.CHAT_SUMMARY_BATCH_SIZE]
+            )
+        if to_fold:
+            try:
+                summary = summarize_messages(chat.summary, to_fold)
+                save_summary(chat, summary, to_fold)
+            except Exception as e:
+                logger.warning(f"Could not update summary for chat {chat.id}: {e}")
+                # Keep the older context verbatim rather than losing it this turn
+                unfolded = older
+
+    return finish_history(chat, kept, unfolded)
+
+
+async def abuild_conversation_history(chat, exclude_message_id=None):
+    """
+    Async build_conversation_history, using the async ORM and LLM client.
+    """
+    limit = settings.CHAT_HISTORY_RECENT_MESSAGES + settings.CHAT_SUMMARY_BATCH_SIZE
+    messages = unsummarized_messages(chat, exclude_message_id)
+    rows = [msg async for msg in messages.order_by("-id")[:limit]]
+    rows.reverse()
+
+    kept, to_fold = plan_history(chat, rows)
+    unfolded = ()
+    if to_fold is not None:
+        older = to_fold
+        if len(rows) == limit:
+            boundary = kept[0].id if kept else rows[-1].id + 1
+            to_fold = [
+                msg async for msg in
+                messages.filter(id__lt=boundary).order_by("id")[:settings.CHAT_SUMMARY_BATCH_SIZE]
+            ]
+        if to_fold:
+            try:
+                summary = await asummarize_messages(chat.summary, to_fold)
+                await asave_summary(chat, summary, to_fold)
+            except Exception as e:
+                logger.warning(f"Could not update summary for chat {chat.id}: {e}")
+                unfolded = older
+
+    return finish_history(chat, kept, unfolded)
@@ -0,0 +1,79 @@
+"""
+Process-wide registry of chat models and compiled prompt chains.
+
+ChatOpenAI clients and `prompt | model` chains are built once per worker and
+keyed by model, temperature and any extra model options, so a message only pays
+for the API call itself. All clients share the pooled transport from
+mindshaft.clients.
+"""
+import os
+import threading
+
+from django.conf import settings
+from langchain.prompts import PromptTemplate
+from langchain_openai import ChatOpenAI
+
+from mindshaft.clients import get_async_http_client, get_http_client
+
+CHAT_MODEL = "gpt-4o-mini"
+CHAT_TEMPERATURE = 0.1
+
+CHAT_PROMPT = PromptTemplate(
+    input_variables=["context", "history", "user_message"],
+    template="""
+You are a compassionate mental health professional helping a client. Do not suggest any medicines.
+Use the following context to inform your response, if relevant:
+
+{context}
+
+Conversation History:
+{history}
+Client: {user_message}
+Therapist:"""
+)
+
+_lock = threading.Lock()
+_models = {}
+_chains = {}
+
+
+def _model_key(model, temperature, options):
+    # The pid keeps clients created before a fork out of the workers
+    return (os.getpid(), model, temperature, tuple(sorted(options.items())))
+
+
+def get_chat_model(model=CHAT_MODEL, temperature=CHAT_TEMPERATURE, **options):
+    """
+    Return the shared ChatOpenAI client for model, temperature and options.
+    """
+    key = _model_key(model, temperature, options)
+    chat_model = _models.get(key)
+    if chat_model is None:
+        with _lock:
+            chat_model = _models.get(key)
+            if chat_model is None:
+                chat_model = _models[key] = ChatOpenAI(
+                    model=model,
+                    temperature=temperature,
+                    openai_api_key=settings.OPENAI_API_KEY,
+                    http_client=get_http_client(),
+                    http_async_client=get_async_http_client(),
+                    **options
+                )
+    return chat_model
+
+
+def get_chain(prompt=CHAT_PROMPT, model=CHAT_MODEL, temperature=CHAT_TEMPERATURE, **options):
+    """
+    Return the shared `prompt | chat model` sequence. Prompts are module-level
+    constants, so they are keyed by identity.
+    """
+    key = (id(prompt),) + _model_key(model, temperature, options)
+    chain = _chains.get(key)
+    if chain is None:
+        chat_model = get_chat_model(model, temperature, **options)
+        with _lock:
+            chain = _chains.get(key)
+            if chain is None:
+                chain = _chains[key] = prompt | chat_model
+    return chain
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.3 on 2026-10-17 22:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chats", "0002_chat_user"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chat",
+            name="summarized_until_id",
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="chat",
+            name="summary",
+            field=models.TextField(blank=True, default=""),
+        ),
+    ]
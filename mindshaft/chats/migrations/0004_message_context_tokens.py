@@ -0,0 +1,17 @@
+# Generated by Django 5.1.3 on 2026-10-17 23:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chats", "0003_chat_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="context_tokens",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
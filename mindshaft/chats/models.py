@@ -13,6 +13,11 @@ class Chat(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Rolling summary of the older part of the conversation. Messages with an id
+    # up to and including summarized_until_id are folded into this text.
+    summary = models.TextField(blank=True, default="")
+    summarized_until_id = models.BigIntegerField(blank=True, null=True)
+
     def get_all_messages(self):
         """
         Retrieve all messages in this chat.
@@ -38,6 +43,8 @@ class Message(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     is_system_message = models.BooleanField(default=False)
+    # Tokens of retrieved context in the prompt of an AI reply; null for user messages
+    context_tokens = models.PositiveIntegerField(blank=True, null=True)
 
     def __str__(self):
         return f"Message by {self.user or 'System'} in Chat {self.chat.id}"
@@ -22,8 +22,8 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ['id', 'chat', 'user', 'content', 'created_at', 'is_system_message']
-        read_only_fields = ['created_at']
+        fields = ['id', 'chat', 'user', 'content', 'created_at', 'is_system_message', 'context_tokens']
+        read_only_fields = ['created_at', 'context_tokens']
 
 
 
@@ -0,0 +1,29 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+def sse_event(data, event=None):
+    """
+    Format data as a single Server-Sent Event. Data is sent as JSON so tokens
+    containing newlines survive the line-based protocol.
+    """
+    message = ""
+    if event:
+        message += f"event: {event}\n"
+    message += f"data: {json.dumps(data)}\n\n"
+    return message
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets DRF accept `Accept: text/event-stream` requests. Streaming responses
+    bypass the renderer; regular Responses (errors raised before the stream
+    starts) are sent as a single `error` event.
+    """
+    media_type = "text/event-stream"
+    format = "event-stream"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return sse_event(data, event="error")
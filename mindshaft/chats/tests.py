@@ -1,3 +1,261 @@
-from django.test import TestCase
+import json
+from unittest.mock import AsyncMock, MagicMock, patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.test import TestCase, override_settings
+from langchain_core.messages import AIMessage, AIMessageChunk
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from users.models import CustomUser
+from .models import Chat, Message
+from .history import build_conversation_history
+from .llm import CHAT_PROMPT
+from .llm import CHAT_PROMPT, get_chain, get_chat_model
+
+
+def count_words(text):
+    return len(text.split())
+
+
+@override_settings(
+    CHAT_HISTORY_TOKEN_BUDGET=60,
+    CHAT_HISTORY_RECENT_MESSAGES=4,
+    CHAT_SUMMARY_BATCH_SIZE=4,
+    CHAT_SUMMARY_MAX_TOKENS=50,
+)
+@patch("chats.history.count_tokens", side_effect=count_words)
+class ConversationHistoryTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="client@example.com", password="password123")
+        self.chat = Chat.objects.create(user=self.user, name="Test chat")
+
+    def add_messages(self, count):
+        for i in range(count):
+            Message.objects.create(
+                chat=self.chat,
+                user=self.user if i % 2 == 0 else None,
+                content=f"message {i}",
+            )
+
+    def test_short_chat_is_sent_verbatim(self, _count):
+        """
+        A chat that fits in the budget is not summarized.
+        """
+        self.add_messages(3)
+        with patch("chats.history.summarize_messages") as summarize:
+            history = build_conversation_history(self.chat)
+
+        summarize.assert_not_called()
+        self.assertEqual(history, "Client: message 0\nTherapist: message 1\nClient: message 2\n")
+
+    def test_excluded_message_is_left_out(self, _count):
+        self.add_messages(2)
+        last = Message.objects.filter(chat=self.chat).latest("id")
+        with patch("chats.history.summarize_messages"):
+            history = build_conversation_history(self.chat, exclude_message_id=last.id)
+
+        self.assertNotIn("message 1", history)
+
+    def test_old_messages_are_folded_into_summary(self, _count):
+        """
+        Once the window is full, older messages move into the rolling summary.
+        """
+        self.add_messages(8)
+        with patch("chats.history.summarize_messages", return_value="earlier summary") as summarize:
+            history = build_conversation_history(self.chat)
+
+        folded = summarize.call_args[0][1]
+        self.assertEqual([m.content for m in folded], [f"message {i}" for i in range(4)])
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.summary, "earlier summary")
+        self.assertEqual(self.chat.summarized_until_id, folded[-1].id)
+        self.assertIn("earlier summary", history)
+        self.assertNotIn("message 3\n", history)
+        self.assertIn("message 7", history)
+
+    @override_settings(CHAT_HISTORY_TOKEN_BUDGET=15)
+    def test_failed_summary_keeps_older_messages_verbatim(self, _count):
+        """
+        When summarizing fails, the messages it should have folded are sent as
+        they are, the oldest dropped first to stay within the budget.
+        """
+        self.add_messages(8)
+        with patch("chats.history.summarize_messages", side_effect=RuntimeError("rate limited")):
+            history = build_conversation_history(self.chat)
+
+        self.assertEqual(history, "".join(
+            f"{'Client' if i % 2 == 0 else 'Therapist'}: message {i}\n" for i in range(3, 8)
+        ))
+        self.chat.refresh_from_db()
+        self.assertIsNone(self.chat.summarized_until_id)
+
+    def test_summary_is_incremental(self, _count):
+        """
+        The next request only reads messages after the summary marker.
+        """
+        self.add_messages(8)
+        with patch("chats.history.summarize_messages", return_value="earlier summary"):
+            build_conversation_history(self.chat)
+
+        self.add_messages(2)
+        with patch("chats.history.summarize_messages") as summarize:
+            history = build_conversation_history(self.chat)
+
+        summarize.assert_not_called()
+        self.assertTrue(history.startswith("(Summary of the earlier conversation: earlier summary)"))
+
+
+class AddMessageStreamViewTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="client@example.com", password="password123")
+        self.chat = Chat.objects.create(user=self.user, name="Test chat")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def read_events(self, response):
+        events = []
+        for block in b"".join(response.streaming_content).decode().strip().split("\n\n"):
+            lines = dict(line.split(": ", 1) for line in block.split("\n"))
+            events.append((lines.get("event"), json.loads(lines["data"])))
+        return events
+
+    @patch("chats.views.AddMessageStreamView.build_prompt_inputs", return_value={})
+    @patch("chats.views.AddMessageStreamView.get_chain")
+    def test_reply_is_streamed_and_saved(self, get_chain, _inputs):
+        chain = MagicMock()
+        chain.stream.return_value = iter([
+            AIMessageChunk(content="Hello"),
+            AIMessageChunk(content=" there"),
+            AIMessageChunk(content="", usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12}),
+        ])
+        get_chain.return_value = chain
+
+        response = self.client.post(
+            f"/api/chats/{self.chat.id}/messages/stream/", {"content": "Hi"}, HTTP_ACCEPT="text/event-stream"
+        )
+        events = self.read_events(response)
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(events[0], ("token", {"content": "Hello"}))
+        self.assertEqual(events[1], ("token", {"content": " there"}))
+        done_event, done = events[-1]
+        self.assertEqual(done_event, "done")
+        self.assertEqual(done["ai_response"], "Hello there")
+        self.assertEqual(done["tokens_used"], 12)
+        self.assertIsNotNone(done["time_to_first_token_ms"])
+
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credits_used_today, 12)
+        self.assertTrue(Message.objects.filter(chat=self.chat, is_system_message=True, content="Hello there").exists())
+
+    @patch("chats.views.AddMessageStreamView.build_prompt_inputs", return_value={"context_tokens": 42})
+    @patch("chats.views.AddMessageStreamView.get_chain")
+    def test_context_tokens_are_recorded_on_the_reply(self, get_chain, _inputs):
+        get_chain.return_value.stream.return_value = iter([AIMessageChunk(content="Hello")])
+
+        response = self.client.post(
+            f"/api/chats/{self.chat.id}/messages/stream/", {"content": "Hi"}, HTTP_ACCEPT="text/event-stream"
+        )
+        done_event, done = self.read_events(response)[-1]
+
+        self.assertEqual(done["context_tokens"], 42)
+        self.assertEqual(Message.objects.get(chat=self.chat, is_system_message=True).context_tokens, 42)
+        self.assertIsNone(Message.objects.get(chat=self.chat, is_system_message=False).context_tokens)
+        self.assertNotIn("context_tokens", get_chain.return_value.stream.call_args.args[0])
+
+    @patch("chats.views.count_tokens", side_effect=count_words)
+    @patch("chats.views.AddMessageStreamView.build_prompt_inputs")
+    @patch("chats.views.AddMessageStreamView.get_chain")
+    def test_client_leaving_early_is_still_charged(self, get_chain, build_inputs, _count):
+        build_inputs.return_value = {"context": "Breathe slowly.", "history": "", "user_message": "Hi"}
+        get_chain.return_value.stream.return_value = iter([
+            AIMessageChunk(content="Hello"),
+            AIMessageChunk(content=" there"),
+            AIMessageChunk(content="", usage_metadata={"input_tokens": 10, "output_tokens": 2, "total_tokens": 12}),
+        ])
+
+        response = self.client.post(
+            f"/api/chats/{self.chat.id}/messages/stream/", {"content": "Hi"}, HTTP_ACCEPT="text/event-stream"
+        )
+        next(iter(response.streaming_content))
+        response.close()
+
+        prompt = CHAT_PROMPT.format(context="Breathe slowly.", history="", user_message="Hi")
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.credits_used_today, count_words(prompt) + 1)
+        self.assertEqual(Message.objects.get(chat=self.chat, is_system_message=True).content, "Hello")
+
+    def test_other_users_chat_is_rejected(self):
+        other = CustomUser.objects.create_user(email="other@example.com", password="password123")
+        self.client.force_authenticate(other)
+
+        response = self.client.post(f"/api/chats/{self.chat.id}/messages/stream/", {"content": "Hi"})
+
+        self.assertEqual(response.status_code, 403)
+
+
+class AsyncAddMessageViewTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(email="client@example.com", password="password123")
+        self.chat = Chat.objects.create(user=self.user, name="Test chat")
+        self.auth_headers = {"Authorization": f"Bearer {RefreshToken.for_user(self.user).access_token}"}
+
+    @patch("chats.views.AsyncAddMessageView.abuild_prompt_inputs", new_callable=AsyncMock, return_value={})
+    @patch("chats.views.AsyncAddMessageView.get_chain")
+    async def test_message_and_reply_are_saved(self, get_chain, _inputs):
+        get_chain.return_value.ainvoke = AsyncMock(return_value=AIMessage(
+            content=" I hear you. ", response_metadata={"token_usage": {"total_tokens": 7}}
+        ))
+
+        response = await self.async_client.post(
+            f"/api/chats/{self.chat.id}/messages/add/async/",
+            {"content": "I feel anxious"},
+            content_type="application/json",
+            headers=self.auth_headers,
+        )
+
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual(data["ai_response"], "I hear you.")
+        self.assertEqual(data["tokens_used"], 7)
+        contents = await sync_to_async(list)(
+            Message.objects.filter(chat=self.chat).order_by("id").values_list("content", flat=True)
+        )
+        self.assertEqual(contents, ["I feel anxious", "I hear you."])
+
+    async def test_message_is_validated_by_the_serializer(self):
+        response = await self.async_client.post(
+            f"/api/chats/{self.chat.id}/messages/add/async/",
+            {"content": ""},
+            content_type="application/json",
+            headers=self.auth_headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("content", response.json())
+        self.assertFalse(await Message.objects.filter(chat=self.chat).aexists())
+
+    async def test_missing_token_is_rejected(self):
+        response = await self.async_client.post(
+            f"/api/chats/{self.chat.id}/messages/add/async/",
+            {"content": "Hi"},
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, 401)
+
+
+class LLMRegistryTest(TestCase):
+    def test_clients_are_reused_per_model_and_temperature(self):
+        self.assertIs(get_chat_model("gpt-4o-mini", 0.1), get_chat_model("gpt-4o-mini", 0.1))
+        self.assertIsNot(get_chat_model("gpt-4o-mini", 0.1), get_chat_model("gpt-4o-mini", 0.7))
+        self.assertIsNot(get_chat_model(), get_chat_model(stream_usage=True))
+
+    def test_chains_are_compiled_once(self):
+        self.assertIs(get_chain(CHAT_PROMPT), get_chain(CHAT_PROMPT))
+
+    def test_clients_share_the_pooled_transport(self):
+        first = get_chat_model("gpt-4o-mini", 0.1)
+        second = get_chat_model("gpt-4o-mini", 0.7)
+        self.assertIs(first.root_client._client, second.root_client._client)
@@ -4,6 +4,8 @@ from .views import (
     UserChatsView,
     ChatMessagesView,
     AddMessageView,
+    AddMessageStreamView,
+    AsyncAddMessageView,
     DeleteChatView,
 )
 
@@ -13,4 +15,6 @@ urlpatterns = [
     path('user/', UserChatsView.as_view(), name='user-chats'),
     path('<int:chat_id>/messages/', ChatMessagesView.as_view(), name='chat-messages'),
     path('<int:chat_id>/messages/add/', AddMessageView.as_view(), name='add-message'),
+    path('<int:chat_id>/messages/add/async/', AsyncAddMessageView.as_view(), name='add-message-async'),
+    path('<int:chat_id>/messages/stream/', AddMessageStreamView.as_view(), name='add-message-stream'),
 ]
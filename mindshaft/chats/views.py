@@ -3,25 +3,38 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import PermissionDenied
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
 from django.shortcuts import get_object_or_404
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
 from .models import Chat, Message, ChatParticipant
 from users.utils import consume_credits
 from .serializers import ChatSerializer, MessageSerializer, CreateChatSerializer, AddMessageSerializer
+from .history import build_conversation_history, abuild_conversation_history, count_tokens
+from .llm import CHAT_PROMPT, get_chain
+from .streaming import EventStreamRenderer, sse_event
+from mindshaft import metrics
 from django.conf import settings
-from rag.utils import get_relevant_context
+from rag.context import aretrieve_context, retrieve_context
 from langchain.llms import OpenAI
 from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain.chat_models import ChatOpenAI
+import asyncio
+import json
+import logging
 import os
+import time
 
 
 from users.decorators import email_verified_required
 from django.utils.decorators import method_decorator
-# Chroma DB Directory
-CHROMA_DB_DIR = os.path.join(settings.BASE_DIR, 'rag', 'chroma_db')
 os.environ["OPENAI_API_KEY"]=settings.OPENAI_API_KEY
 
+logger = logging.getLogger(__name__)
+
 
 
 class UserChatsView(APIView):
@@ -84,8 +97,73 @@ class CreateChatView(APIView):
         return Response(serializer.errors, status=400)
 
 
+class ChatPromptMixin:
+    """
+    Prompt, model and context helpers shared by the add-message views.
+    """
+
+    def get_chain(self, **model_options):
+        """
+        Return the shared prompt | chat model sequence for this worker.
+        """
+        return get_chain(CHAT_PROMPT, **model_options)
+
+    def build_prompt_inputs(self, user_message, chat, message_id=None):
+        """
+        Collect the retrieved context and conversation history for the prompt.
+        `context_tokens` is not a prompt input; the views pop it and record it on the reply.
+        """
+        # The worker's retriever returns "No relevant context available." until an index exists
+        context = retrieve_context(user_message)
+
+        # Get conversation history, without the message we are answering
+        history = self.get_conversation_history(chat, exclude_message_id=message_id)
+
+        return {
+            "context": context.text,
+            "context_tokens": context.tokens,
+            "history": history,
+            "user_message": user_message
+        }
+
+    def get_conversation_history(self, chat, exclude_message_id=None):
+        """
+        Retrieve the token-budgeted conversation history for the chat.
+        """
+        return build_conversation_history(chat, exclude_message_id=exclude_message_id)
+
+    def reply_data(self, user, chat, user_message, msg_content, total_tokens):
+        """
+        Response body of the add-message views.
+        """
+        return {
+            "id": user_message.id,
+            "chat": chat.id,
+            "user": user.email,
+            "content": user_message.content,
+            "ai_response": msg_content,  # Include AI response in the API response
+            "created_at": user_message.created_at,
+            "tokens_used": total_tokens
+        }
+
+    async def abuild_prompt_inputs(self, user_message, chat, message_id=None):
+        """
+        Async build_prompt_inputs: retrieval and the history fetch run concurrently.
+        """
+        context, history = await asyncio.gather(
+            aretrieve_context(user_message),
+            abuild_conversation_history(chat, exclude_message_id=message_id),
+        )
+        return {
+            "context": context.text,
+            "context_tokens": context.tokens,
+            "history": history,
+            "user_message": user_message
+        }
+
+
 # @method_decorator(email_verified_required, name='dispatch')
-class AddMessageView(APIView):
+class AddMessageView(ChatPromptMixin, APIView):
     """
     View to add a message to a chat owned by the logged-in user and generate an AI response.
     """
@@ -113,7 +191,9 @@ class AddMessageView(APIView):
 
             
             # Generate AI response
-            ai_response = self.generate_ai_response(user_message.content, chat)
+            ai_response, context_tokens = self.generate_ai_response(
+                user_message.content, chat, message_id=user_message.id
+            )
     
             response_json = ai_response.dict()
             response_metadata = response_json['response_metadata']
@@ -134,84 +214,32 @@ class AddMessageView(APIView):
                     chat=chat,
                     user=None,  # No user for AI messages
                     content=msg_content,
-                    is_system_message=True
+                    is_system_message=True,
+                    context_tokens=context_tokens
                 )
 
-            return Response({
-                "id": user_message.id,
-                "chat": chat.id,
-                "user": request.user.email,
-                "content": user_message.content,
-                "ai_response": msg_content,  # Include AI response in the API response
-                "created_at": user_message.created_at,
-                "tokens_used": total_tokens
-            }, status=201)
+            return Response(
+                self.reply_data(request.user, chat, user_message, msg_content, total_tokens), status=201
+            )
         return Response(serializer.errors, status=400)
 
-    def generate_ai_response(self, user_message, chat):
+    def generate_ai_response(self, user_message, chat, message_id=None):
         """
         Generate an AI response using LangChain's RunnableSequence with ChatOpenAI.
+        Returns the response and the number of retrieved-context tokens in its prompt.
         """
         try:
-            # Initialize the OpenAI Chat model
-            chat_model = ChatOpenAI(
-                temperature=0.1,
-                openai_api_key=settings.OPENAI_API_KEY,
-                model="gpt-4o-mini"
-            )
-
-            # Check if Chroma DB exists and get context if available
-            if os.path.exists(CHROMA_DB_DIR):
-                context = get_relevant_context(user_message)
-            else:
-                context = "No relevant context available."
-
-            # Define the prompt template
-            prompt_template = PromptTemplate(
-                input_variables=["context", "history", "user_message"],
-                template="""
-You are a compassionate mental health professional helping a client. Do not suggest any medicines.
-Use the following context to inform your response, if relevant:
-
-{context}
-
-Conversation History:
-{history}
-Client: {user_message}
-Therapist:"""
-            )
-
-            # Create the sequence
-            chain = prompt_template | chat_model
-
-            # Get conversation history
-            history = self.get_conversation_history(chat)
+            chain = self.get_chain()
+            inputs = self.build_prompt_inputs(user_message, chat, message_id=message_id)
+            context_tokens = inputs.pop("context_tokens", None)
 
             # Run the chain with the provided inputs
-            inputs = {
-                "context": context,
-                "history": history,
-                "user_message": user_message
-            }
             response = chain.invoke(inputs)
             print(response)
-            return response  # Ensure a clean response
+            return response, context_tokens  # Ensure a clean response
         except Exception as e:
             print(f"AI response generation error: {e}")
-            return "I'm sorry, but I'm unable to provide a response at this time."
-
-    def get_conversation_history(self, chat):
-        """
-        Retrieve the conversation history for the chat.
-        """
-        messages = Message.objects.filter(chat=chat).order_by("created_at")
-        history = ""
-        for msg in messages:
-            sender = "Client" if msg.user else "Therapist"
-            history += f"{sender}: {msg.content}\n"
-        return history
-    
-
+            return "I'm sorry, but I'm unable to provide a response at this time.", None
 
 # @method_decorator(email_verified_required, name='dispatch')
 class DeleteChatView(APIView):
@@ -233,98 +261,229 @@ class DeleteChatView(APIView):
         return Response({"message": "Chat deleted successfully."}, status=status.HTTP_200_OK)
 
 
-#     class AddMessageViewStream(APIView):
-#     """
-#     View to add a message to a chat owned by the logged-in user and generate an AI response with streaming.
-#     """
-#     permission_classes = [IsAuthenticated]
-
-#     def post(self, request, chat_id, *args, **kwargs):
-#         try:
-#             chat = Chat.objects.get(id=chat_id, user=request.user)
-#         except Chat.DoesNotExist:
-#             raise PermissionDenied("You do not have permission to add messages to this chat.")
-
-#         # Add the user's message to the chat
-#         message_data = request.data.copy()
-#         message_data['chat'] = chat.id
-#         message_data['user'] = request.user.id
-
-#         serializer = MessageSerializer(data=message_data)
-#         if serializer.is_valid():
-#             user_message = serializer.save()
-
-#             # Generate streaming AI response
-#             response = self.stream_ai_response(user_message.content, chat)
-
-#             return StreamingHttpResponse(
-#                 response,
-#                 content_type="text/event-stream",
-#                 status=200
-#             )
-#         return Response(serializer.errors, status=400)
-
-#     def stream_ai_response(self, user_message, chat):
-#         """
-#         Stream an AI response using OpenAI's ChatCompletion API.
-#         """
-#         try:
-#             # Initialize the OpenAI API key
-#             openai.api_key = settings.OPENAI_API_KEY
-
-#             # Check if Chroma DB exists and get context if available
-#             if os.path.exists(CHROMA_DB_DIR):
-#                 context = get_relevant_context(user_message)
-#             else:
-#                 context = "No relevant context available."
-
-#             # Get conversation history
-#             history = self.get_conversation_history(chat)
-
-#             # Prepare the prompt
-#             prompt = f"""
-# You are a compassionate mental health professional helping a client. Do not suggest any medicines.
-# Use the following context to inform your response, if relevant:
-
-# {context}
-
-# Conversation History:
-# {history}
-# Client: {user_message}
-# Therapist:"""
-
-#             # Stream the response from OpenAI's ChatCompletion
-#             response = openai.chat.completions.create(
-#                 model="gpt-4o-mini",
-#                 messages=[{"role": "system", "content": prompt}],
-#                 temperature=0.1,
-#                 stream=True
-#             )
-
-#             for chunk in response:
-#                 chunk = chunk.model_dump(mode="json")
-#                 if 'choices' in chunk:
-#                     choice = chunk["choices"][0]
-#                     delta = choice.get("delta", {})
-#                     content = delta.get("content")
-#                     if content:
-#                         yield f"data: {content}\n\n"
-
-#             # Send a stop signal when the response is complete
-#             yield "data: [END OF RESPONSE]\n\n"
-#         except Exception as e:
-#             print(f"AI streaming error: {e}")
-#             yield "data: I'm sorry, but I'm unable to provide a response at this time.\n\n"
-
-#     def get_conversation_history(self, chat):
-#         """
-#         Retrieve the conversation history for the chat.
-#         """
-#         messages = Message.objects.filter(chat=chat).order_by("created_at")
-#         history = ""
-#         for msg in messages:
-#             sender = "Client" if msg.user else "Therapist"
-#             history += f"{sender}: {msg.content}\n"
-#         return history
+class AddMessageStreamView(AddMessageView):
+    """
+    View to add a message to a chat owned by the logged-in user and stream the AI response
+    back as Server-Sent Events while it is generated.
 
+    Events: `token` for every piece of the reply, then `done` with the saved message and
+    timings, or `error` if generation or credit accounting fails.
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
 
+    def post(self, request, chat_id, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            chat = Chat.objects.get(id=chat_id, user=request.user)
+        except Chat.DoesNotExist:
+            raise PermissionDenied("You do not have permission to add messages to this chat.")
+
+        userObj = request.user
+        if not userObj.is_premium and userObj.credits_used_today >= userObj.daily_limit:
+            return Response({'error': 'You have reached your daily limit.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Add the user's message to the chat
+        message_data = request.data.copy()
+        message_data['chat'] = chat.id
+        message_data['user'] = request.user.id
+
+        serializer = MessageSerializer(data=message_data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=400)
+        user_message = serializer.save()
+
+        response = StreamingHttpResponse(
+            self.stream_ai_response(request.user, chat, user_message, started),
+            content_type="text/event-stream",
+        )
+        # Keep proxies (nginx) from buffering the stream
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def stream_ai_response(self, user, chat, user_message, started):
+        """
+        Yield the reply token by token, then charge credits and save the AI message.
+        A reply cut short (the client left, or generation failed) is still charged
+        and saved as far as it got.
+        """
+        first_token_at = None
+        parts = []
+        usage = None
+        inputs = {}
+        context_tokens = None
+        streamed = False
+        try:
+            chain = self.get_chain(stream_usage=True)
+            inputs = self.build_prompt_inputs(user_message.content, chat, message_id=user_message.id)
+            context_tokens = inputs.pop("context_tokens", None)
+            for chunk in chain.stream(inputs):
+                if chunk.usage_metadata:
+                    usage = chunk.usage_metadata
+                if chunk.content:
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    parts.append(chunk.content)
+                    yield sse_event({'content': chunk.content}, event='token')
+            streamed = True
+        except GeneratorExit:
+            logger.info(f"Client left chat {chat.id} before the reply finished streaming.")
+            raise
+        except Exception as e:
+            logger.error(f"AI streaming error: {e}")
+            yield sse_event({'error': "I'm sorry, but I'm unable to provide a response at this time."}, event='error')
+            return
+        finally:
+            if not streamed and (parts or usage):
+                self.save_partial_reply(user, chat, inputs, parts, usage, context_tokens)
+
+        msg_content = "".join(parts).strip()
+        total_tokens = usage['total_tokens'] if usage else 0
+        creds = consume_credits(user, total_tokens)
+        if 'success' not in creds:
+            yield sse_event(creds, event='error')
+            return
+
+        ai_message = Message.objects.create(
+            chat=chat,
+            user=None,  # No user for AI messages
+            content=msg_content,
+            is_system_message=True,
+            context_tokens=context_tokens
+        )
+
+        finished = time.monotonic()
+        ttft_ms = round((first_token_at - started) * 1000, 1) if first_token_at else None
+        total_ms = round((finished - started) * 1000, 1)
+        if ttft_ms is not None:
+            metrics.observe('chat.stream.time_to_first_token_ms', ttft_ms)
+        metrics.observe('chat.stream.total_ms', total_ms)
+        logger.info(f"Streamed reply for chat {chat.id}: ttft={ttft_ms}ms total={total_ms}ms tokens={total_tokens}")
+
+        yield sse_event({
+            "id": user_message.id,
+            "ai_message_id": ai_message.id,
+            "chat": chat.id,
+            "ai_response": msg_content,
+            "created_at": user_message.created_at.isoformat(),
+            "tokens_used": total_tokens,
+            "context_tokens": context_tokens,
+            "time_to_first_token_ms": ttft_ms,
+            "total_ms": total_ms,
+        }, event='done')
+
+    def save_partial_reply(self, user, chat, inputs, parts, usage, context_tokens):
+        """
+        Charge and save a reply that stopped streaming early. Without the usage
+        report, which only comes with the last chunk, the tokens are counted
+        from the prompt and the text streamed so far.
+        """
+        msg_content = "".join(parts).strip()
+        if usage:
+            total_tokens = usage['total_tokens']
+        else:
+            try:
+                prompt = CHAT_PROMPT.format(**inputs)
+            except KeyError:
+                prompt = "\n".join(str(value) for value in inputs.values())
+            total_tokens = count_tokens(prompt) + count_tokens(msg_content)
+        creds = consume_credits(user, total_tokens)
+        if 'success' not in creds:
+            logger.warning(f"Could not charge {total_tokens} tokens of a partial reply in chat {chat.id}: {creds}")
+        if msg_content:
+            Message.objects.create(
+                chat=chat,
+                user=None,
+                content=msg_content,
+                is_system_message=True,
+                context_tokens=context_tokens
+            )
+        logger.info(f"Saved partial reply for chat {chat.id}: tokens={total_tokens}")
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAddMessageView(ChatPromptMixin, View):
+    """
+    Async version of AddMessageView for the ASGI server.
+
+    The chat lookup, history and message saves use the async ORM, retrieval runs
+    concurrently with the history fetch and the LLM is awaited with the async client,
+    so a worker is not tied up while OpenAI is generating.
+    """
+
+    async def post(self, request, chat_id, *args, **kwargs):
+        user = await self.authenticate(request)
+        if user is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+        try:
+            chat = await Chat.objects.aget(id=chat_id, user=user)
+        except Chat.DoesNotExist:
+            return JsonResponse({"detail": "You do not have permission to add messages to this chat."}, status=403)
+
+        if not user.is_premium and user.credits_used_today >= user.daily_limit:
+            return JsonResponse({'error': 'You have reached your daily limit.'}, status=400)
+
+        # Same validation as AddMessageView; the chat field is looked up in the database
+        message_data = self.get_data(request)
+        message_data['chat'] = chat.id
+        message_data['user'] = user.id
+        serializer = MessageSerializer(data=message_data)
+        if not await sync_to_async(serializer.is_valid)():
+            return JsonResponse(serializer.errors, status=400)
+        user_message = await sync_to_async(serializer.save)(user=user)
+        content = user_message.content
+
+        try:
+            inputs = await self.abuild_prompt_inputs(content, chat, message_id=user_message.id)
+            context_tokens = inputs.pop("context_tokens", None)
+            ai_response = await self.get_chain().ainvoke(inputs)
+        except Exception as e:
+            logger.error(f"AI response generation error: {e}")
+            return JsonResponse({"error": "I'm sorry, but I'm unable to provide a response at this time."}, status=503)
+
+        total_tokens = ai_response.response_metadata['token_usage']['total_tokens']
+        msg_content = ai_response.content.strip()
+
+        creds = await sync_to_async(consume_credits)(user, total_tokens)
+        if 'success' not in creds:
+            return JsonResponse(creds, status=400)
+
+        # Save AI response as a message
+        await Message.objects.acreate(
+            chat=chat,
+            user=None,  # No user for AI messages
+            content=msg_content,
+            is_system_message=True,
+            context_tokens=context_tokens
+        )
+
+        # Rendered like the DRF response of AddMessageView
+        return HttpResponse(
+            JSONRenderer().render(self.reply_data(user, chat, user_message, msg_content, total_tokens)),
+            content_type="application/json",
+            status=201,
+        )
+
+    async def authenticate(self, request):
+        """
+        Authenticate the JWT bearer token the same way the DRF views do.
+        """
+        try:
+            result = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except AuthenticationFailed:
+            return None
+        return result[0] if result else None
+
+    def get_data(self, request):
+        """
+        Read the request data from a JSON or form-encoded body.
+        """
+        if request.content_type == "application/json":
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError:
+                return {}
+            return data if isinstance(data, dict) else {}
+        return request.POST.dict()
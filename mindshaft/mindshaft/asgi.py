@@ -3,6 +3,11 @@ ASGI config for mindshaft project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with uvicorn workers under gunicorn so the async views (such as
+chats.views.AsyncAddMessageView) can keep many LLM calls in flight per process:
+
+    gunicorn mindshaft.asgi:application -k uvicorn.workers.UvicornWorker
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -14,3 +19,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mindshaft.settings")
 
 application = get_asgi_application()
+
+# Open the vector index in each worker at boot so the first chat after a deploy is not slow
+from rag.retriever import warm_up_in_background  # noqa: E402
+
+warm_up_in_background()
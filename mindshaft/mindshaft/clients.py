@@ -0,0 +1,58 @@
+"""
+Pooled HTTP clients for outbound API calls (OpenAI chat and embeddings).
+
+One sync and one async httpx client are created lazily per worker process and
+shared by every LLM and embedding client, so TCP connections and TLS sessions
+are kept alive and reused across requests instead of being set up per message.
+"""
+import os
+import threading
+
+import httpx
+from django.conf import settings
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _limits():
+    return httpx.Limits(
+        max_connections=settings.OPENAI_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.OPENAI_HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=settings.OPENAI_HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout():
+    return httpx.Timeout(
+        settings.OPENAI_HTTP_READ_TIMEOUT,
+        connect=settings.OPENAI_HTTP_CONNECT_TIMEOUT,
+    )
+
+
+def _get_client(kind, factory):
+    # Keyed by pid as well: a client inherited through fork (gunicorn --preload)
+    # shares its sockets with the parent and must not be reused.
+    key = (kind, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = factory(limits=_limits(), timeout=_timeout())
+    return client
+
+
+def get_http_client():
+    """
+    Return the process-wide pooled httpx.Client.
+    """
+    return _get_client("sync", httpx.Client)
+
+
+def get_async_http_client():
+    """
+    Return the process-wide pooled httpx.AsyncClient. Under uvicorn every worker
+    runs a single event loop, so one async client per process is enough.
+    """
+    return _get_client("async", httpx.AsyncClient)
@@ -0,0 +1,91 @@
+"""
+Lightweight in-process metrics.
+
+Counters and timing histograms are kept per process, so with several gunicorn
+workers each worker reports its own numbers through MetricsView.
+"""
+import bisect
+import threading
+from collections import defaultdict
+
+# Default histogram buckets, in milliseconds
+DEFAULT_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_histograms = {}
+
+
+class Histogram:
+    """
+    Count, sum, min, max and cumulative bucket counts of observed values.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self):
+        buckets = {}
+        running = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.bucket_counts):
+            running += count
+            buckets[str(bound)] = running
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "avg": round(self.total / self.count, 3) if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "buckets": buckets,
+        }
+
+
+def incr(name, value=1):
+    """
+    Increase the counter called name.
+    """
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS):
+    """
+    Record value in the histogram called name. Buckets are fixed on first use.
+    """
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram(buckets)
+        histogram.observe(value)
+
+
+def snapshot():
+    """
+    Return a copy of every counter and histogram of this process.
+    """
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "histograms": {name: h.as_dict() for name, h in _histograms.items()},
+        }
+
+
+def reset():
+    """
+    Drop all recorded metrics (used by tests).
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
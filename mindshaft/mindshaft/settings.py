@@ -220,6 +220,61 @@ STRIPE_SUCCESS_URL = config('STRIPE_SUCCESS_URL')
 STRIPE_FAILURE_URL = config('STRIPE_FAILURE_URL')
 STRIPE_CANCEL_URL = config('STRIPE_CANCEL_URL')
 
+# Pooled HTTP transport shared by the OpenAI chat and embedding clients
+OPENAI_HTTP_MAX_CONNECTIONS = config('OPENAI_HTTP_MAX_CONNECTIONS', default=200, cast=int)
+OPENAI_HTTP_MAX_KEEPALIVE = config('OPENAI_HTTP_MAX_KEEPALIVE', default=50, cast=int)
+OPENAI_HTTP_KEEPALIVE_EXPIRY = config('OPENAI_HTTP_KEEPALIVE_EXPIRY', default=60.0, cast=float)  # Seconds
+OPENAI_HTTP_CONNECT_TIMEOUT = config('OPENAI_HTTP_CONNECT_TIMEOUT', default=5.0, cast=float)  # Seconds
+OPENAI_HTTP_READ_TIMEOUT = config('OPENAI_HTTP_READ_TIMEOUT', default=60.0, cast=float)  # Seconds
+
+# Retrieval (RAG)
+RAG_EMBEDDING_BACKEND = config('RAG_EMBEDDING_BACKEND', default='openai')  # 'openai' or 'onnx' (local CPU model)
+RAG_EMBEDDING_MODEL = config('RAG_EMBEDDING_MODEL', default='')  # Empty uses the backend's default model
+RAG_ONNX_MODEL_DIR = config('RAG_ONNX_MODEL_DIR', default='')  # model.onnx + tokenizer.json; empty downloads all-MiniLM-L6-v2. Set RAG_EMBEDDING_MODEL with it
+RAG_ONNX_BATCH_SIZE = config('RAG_ONNX_BATCH_SIZE', default=32, cast=int)
+RAG_ONNX_THREADS = config('RAG_ONNX_THREADS', default=0, cast=int)  # Per process; 0 lets ONNX Runtime choose
+RAG_VECTOR_INDEX = config('RAG_VECTOR_INDEX', default='chroma')  # 'chroma' or 'mmap' (memory-mapped export of the collection)
+RAG_MMAP_DTYPE = config('RAG_MMAP_DTYPE', default='float16')  # 'float16' or 'int8'
+RAG_IVF_MIN_ROWS = config('RAG_IVF_MIN_ROWS', default=20000, cast=int)  # Smaller mmap indexes are scanned exactly
+RAG_IVF_LISTS = config('RAG_IVF_LISTS', default=0, cast=int)  # Clusters; 0 picks about 4 * sqrt(rows)
+RAG_IVF_NPROBE = config('RAG_IVF_NPROBE', default=8, cast=int)  # Clusters scored per query; higher is slower with better recall
+RAG_HYBRID_SEARCH = config('RAG_HYBRID_SEARCH', default=True, cast=bool)  # Fuse BM25 keyword matches with vector results
+RAG_HYBRID_CANDIDATES = config('RAG_HYBRID_CANDIDATES', default=10, cast=int)  # Results taken from each ranking before fusion
+RAG_MMR_CANDIDATES = config('RAG_MMR_CANDIDATES', default=20, cast=int)  # Vector results reranked for diversity; 0 disables reranking
+RAG_MMR_LAMBDA = config('RAG_MMR_LAMBDA', default=0.7, cast=float)  # 1 ranks by relevance only, 0 by diversity only
+RAG_RRF_K = config('RAG_RRF_K', default=60, cast=int)  # Reciprocal rank fusion constant
+RAG_CONTEXT_MAX_CHUNKS = config('RAG_CONTEXT_MAX_CHUNKS', default=5, cast=int)  # Candidates retrieved per message
+RAG_CONTEXT_MIN_SCORE = config('RAG_CONTEXT_MIN_SCORE', default='', cast=lambda value: float(value) if value != '' else None)  # Cosine similarity; empty uses the embedding model's default (rag.embeddings.DEFAULT_MIN_SCORES)
+RAG_CONTEXT_SCORE_MARGIN = config('RAG_CONTEXT_SCORE_MARGIN', default=0.05, cast=float)  # Chunks further below the best one are dropped
+RAG_CONTEXT_DEDUP_THRESHOLD = config('RAG_CONTEXT_DEDUP_THRESHOLD', default=0.7, cast=float)  # Share of a chunk already in the context that makes it a duplicate
+RAG_CONTEXT_TOKEN_BUDGET = config('RAG_CONTEXT_TOKEN_BUDGET', default=1200, cast=int)  # Retrieved context sent to the LLM
+RAG_RETRIEVAL_TIMEOUT = config('RAG_RETRIEVAL_TIMEOUT', default=2.0, cast=float)  # Seconds a turn waits for retrieval before answering without context; 0 waits indefinitely
+RAG_INDEX_GENERATIONS = config('RAG_INDEX_GENERATIONS', default=2, cast=int)  # Index generations kept on disk, the live one included; 2 allows one rollback
+RAG_INDEX_CHECK_INTERVAL = config('RAG_INDEX_CHECK_INTERVAL', default=2.0, cast=float)  # Seconds between index version checks
+RAG_WARM_UP_ON_BOOT = config('RAG_WARM_UP_ON_BOOT', default=True, cast=bool)
+RAG_RESULT_CACHE_SIZE = config('RAG_RESULT_CACHE_SIZE', default=1024, cast=int)  # Retrieval results kept per worker for the current index version; 0 disables
+RAG_QUERY_CACHE_SIZE = config('RAG_QUERY_CACHE_SIZE', default=2048, cast=int)  # Query embeddings kept in memory per worker
+RAG_QUERY_CACHE_PATH = config('RAG_QUERY_CACHE_PATH', default=os.path.join(BASE_DIR, 'rag', 'cache', 'query_embeddings.sqlite3'))  # Empty disables the disk tier
+RAG_QUERY_CACHE_MAX_MB = config('RAG_QUERY_CACHE_MAX_MB', default=256, cast=int)
+RAG_QUERY_BATCH_WAIT_MS = config('RAG_QUERY_BATCH_WAIT_MS', default=5, cast=float)  # How long a query embedding waits for others to batch with while other queries are in flight; 0 disables batching
+RAG_QUERY_BATCH_SIZE = config('RAG_QUERY_BATCH_SIZE', default=32, cast=int)  # Queries per batched embedding call
+RAG_EMBEDDING_STORE_PATH = config('RAG_EMBEDDING_STORE_PATH', default=os.path.join(BASE_DIR, 'rag', 'cache', 'chunk_embeddings.sqlite3'))  # Chunk vectors by content hash
+RAG_CHUNK_STORE_DIR = config('RAG_CHUNK_STORE_DIR', default=os.path.join(BASE_DIR, 'rag', 'cache', 'chunks'))  # Chunk text by chunk id: the mmap and BM25 indexes read hits from it, rebuilds skip PDF parsing; empty disables (Chroma only)
+RAG_CHUNK_STORE_COMPRESSION = config('RAG_CHUNK_STORE_COMPRESSION', default='zlib')  # 'zlib', 'zstd' (needs zstandard) or 'none'
+
+# Ingestion
+RAG_PARSE_WORKERS = config('RAG_PARSE_WORKERS', default=min(4, os.cpu_count() or 1), cast=int)  # PDF parsing processes; 0 parses inside the ingestion worker
+RAG_INGEST_BATCH_SIZE = config('RAG_INGEST_BATCH_SIZE', default=64, cast=int)  # Chunks embedded and written at a time
+RAG_CHUNK_MAX_TOKENS = config('RAG_CHUNK_MAX_TOKENS', default=1000, cast=int)  # The onnx model reads at most 256 of its own tokens; use ~200 with it
+RAG_CHUNK_OVERLAP = config('RAG_CHUNK_OVERLAP', default=100, cast=int)  # Tokens shared by consecutive chunks
+RAG_DEDUP_THRESHOLD = config('RAG_DEDUP_THRESHOLD', default=0.8, cast=float)  # Estimated Jaccard similarity above which a chunk is a near-duplicate; 0 disables
+
+# Chat history sent to the LLM
+CHAT_HISTORY_TOKEN_BUDGET = config('CHAT_HISTORY_TOKEN_BUDGET', default=1500, cast=int)  # Summary + recent turns
+CHAT_HISTORY_RECENT_MESSAGES = config('CHAT_HISTORY_RECENT_MESSAGES', default=10, cast=int)  # Turns kept verbatim
+CHAT_SUMMARY_BATCH_SIZE = config('CHAT_SUMMARY_BATCH_SIZE', default=20, cast=int)  # Messages folded per request
+CHAT_SUMMARY_MAX_TOKENS = config('CHAT_SUMMARY_MAX_TOKENS', default=400, cast=int)
+
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = str(config("EMAIL_HOST", default="smtp.gmail.com"))
 EMAIL_PORT = int(config("EMAIL_PORT", default=587))
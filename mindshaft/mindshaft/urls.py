@@ -9,6 +9,8 @@ from rest_framework_simplejwt.views import (
 from django.conf import settings
 from django.conf.urls.static import static
 
+from .views import MetricsView
+
 
 urlpatterns = [
     # Admin route
@@ -25,6 +27,9 @@ urlpatterns = [
     path('api/rag/', include('rag.urls')),  # Include URLs from the rag app
 
     path('api/billing/', include('billing.urls')),
+
+    # Per-worker performance metrics (admin only)
+    path('api/metrics/', MetricsView.as_view(), name='metrics'),
 ]
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
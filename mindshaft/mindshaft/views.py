@@ -0,0 +1,19 @@
+import os
+
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAdminUser
+
+from . import metrics
+
+
+class MetricsView(APIView):
+    """
+    View to expose the in-process metrics of the worker that serves the request.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        data = metrics.snapshot()
+        data["pid"] = os.getpid()
+        return Response(data)
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mindshaft.settings")
 
 application = get_wsgi_application()
+
+# Open the vector index in each worker at boot so the first chat after a deploy is not slow
+from rag.retriever import warm_up_in_background  # noqa: E402
+
+warm_up_in_background()
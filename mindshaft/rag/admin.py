@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Document, IngestionStatus
+from .models import Document, IngestionJob
 
 @admin.register(Document)
 class DocumentAdmin(admin.ModelAdmin):
@@ -8,15 +8,15 @@ class DocumentAdmin(admin.ModelAdmin):
     list_filter = ('uploaded_at',)
     ordering = ('-uploaded_at',)
 
-@admin.register(IngestionStatus)
-class IngestionStatusAdmin(admin.ModelAdmin):
-    list_display = ('id', 'is_ingesting', 'last_updated')
-    readonly_fields = ('id', 'last_updated')
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'requested_by', 'created_at', 'started_at', 'finished_at',
+                    'documents_done', 'documents_total', 'pages_parsed', 'chunks_embedded')
+    list_filter = ('status',)
+    ordering = ('-created_at',)
+    readonly_fields = ('requested_by', 'created_at', 'started_at', 'finished_at', 'updated_at', 'documents_total',
+                       'documents_done', 'pages_parsed', 'chunks_embedded', 'errors', 'summary')
 
     def has_add_permission(self, request):
-        """Prevent adding new IngestionStatus objects."""
-        return False
-
-    def has_delete_permission(self, request, obj=None):
-        """Prevent deleting the IngestionStatus object."""
+        """Jobs are created by uploads and the ingestion worker."""
         return False
@@ -0,0 +1,312 @@
+"""
+Append-only store of chunk text by chunk id.
+
+Ingestion appends every chunk it keeps. A rebuild of the index, for instance
+after the embedding model changed, replays a document's chunks from here
+instead of parsing its PDF again. Any chunk's text can be read by id without
+loading the corpus. Chunk ids are content hashes, so one store serves every
+index generation.
+
+The memory-mapped and BM25 indexes store chunk ids only and read the text of
+their hits from here.
+
+The store is two files in RAG_CHUNK_STORE_DIR:
+
+    chunks*.dat   frames back to back: codec (uint8), payload length (uint32),
+                  payload (the chunk text, compressed per frame)
+    chunks.idx    the name of the data file, then per chunk: frame offset
+                  (uint64), page (int32, -1 for none), id length (uint16), id
+
+The data file starts with MAGIC, the index with INDEX_MAGIC and the data
+file's name (an index starting with MAGIC is from before compaction existed
+and names chunks.dat). Frames are written and flushed before their index
+records, so a record never points at a partial frame, and readers ignore a
+partial record at the end. Readers memory-map the data file and pick up
+chunks appended after they opened it on their next miss.
+
+Chunks no retained index generation refers to any more are dropped by
+compact(), which copies the others into a new data file and replaces the
+index with one naming it. Readers notice the new index on their next miss;
+their mappings of the old data file stay valid.
+
+Compression is 'zlib', 'zstd' (needs the zstandard package) or 'none'
+(RAG_CHUNK_STORE_COMPRESSION). The codec is recorded per frame, so changing
+it does not affect chunks already stored.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DATA_FILE = 'chunks.dat'
+INDEX_FILE = 'chunks.idx'
+MAGIC = b'MSCHUNK1'
+INDEX_MAGIC = b'MSCHUNK2'
+DATA_NAME_LENGTH = struct.Struct('<H')
+FRAME_HEADER = struct.Struct('<BI')
+INDEX_RECORD = struct.Struct('<QiH')
+CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Compact once this share of the stored chunks is no longer referenced
+COMPACT_DEAD_FRACTION = 0.25
+
+
+def compress(codec, data):
+    if codec == CODECS['zlib']:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == CODECS['zstd']:
+        import zstandard
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def decompress(codec, data):
+    if codec == CODECS['zlib']:
+        return zlib.decompress(data)
+    if codec == CODECS['zstd']:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class ChunkStore:
+    """
+    Reader and (under the build lock) appender of a chunk store directory.
+    """
+
+    def __init__(self, directory, compression='zlib'):
+        if compression not in CODECS:
+            raise ValueError(f"Unknown chunk store compression {compression!r}; use one of {', '.join(CODECS)}.")
+        self.directory = directory
+        self.codec = CODECS[compression]
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.offsets = {}  # chunk id -> (frame offset, page)
+        self._index_position = 0
+        self._index_inode = None
+        self._map = None
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.offsets
+
+    def _refresh(self):
+        """
+        Read the index records appended since the last refresh, or the whole
+        index again if it was replaced by compaction.
+        """
+        try:
+            with open(self.index_path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._index_inode:
+                    self.offsets = {}
+                    self._index_position = 0
+                    self._index_inode = inode
+                    self._map = None
+                f.seek(self._index_position)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        position = 0
+        if not self._index_position:
+            position = self._read_header(data)
+            if position is None:
+                return
+        while position + INDEX_RECORD.size <= len(data):
+            offset, page, id_length = INDEX_RECORD.unpack_from(data, position)
+            end = position + INDEX_RECORD.size + id_length
+            if end > len(data):
+                break
+            chunk_id = data[position + INDEX_RECORD.size:end].decode('utf-8')
+            self.offsets[chunk_id] = (offset, None if page < 0 else page)
+            position = end
+        self._index_position += position
+
+    def _read_header(self, data):
+        """
+        Set the data file from the header of the index and return where its
+        records start, or None if the header is not complete yet.
+        """
+        if data[:len(MAGIC)] == MAGIC:
+            self.data_path = os.path.join(self.directory, DATA_FILE)
+            return len(MAGIC)
+        if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            return None
+        start = len(INDEX_MAGIC) + DATA_NAME_LENGTH.size
+        if len(data) < start:
+            return None
+        (name_length,) = DATA_NAME_LENGTH.unpack_from(data, len(INDEX_MAGIC))
+        if len(data) < start + name_length:
+            return None
+        self.data_path = os.path.join(self.directory, data[start:start + name_length].decode('utf-8'))
+        return start + name_length
+
+    def _raw_frame(self, offset):
+        if self._map is None or offset + FRAME_HEADER.size > len(self._map):
+            # The file grew since it was mapped
+            with open(self.data_path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        codec, length = FRAME_HEADER.unpack_from(self._map, offset)
+        return self._map[offset:offset + FRAME_HEADER.size + length]
+
+    def _frame(self, offset):
+        frame = self._raw_frame(offset)
+        codec, length = FRAME_HEADER.unpack_from(frame)
+        return decompress(codec, frame[FRAME_HEADER.size:]).decode('utf-8')
+
+    def _get(self, chunk_id):
+        if chunk_id not in self.offsets:
+            self._refresh()
+        found = self.offsets.get(chunk_id)
+        if found is None:
+            return None
+        offset, page = found
+        return self._frame(offset), page
+
+    def get(self, chunk_id):
+        """
+        Return (text, page) of a chunk, or None if it is not stored.
+        """
+        with self._lock:
+            try:
+                return self._get(chunk_id)
+            except FileNotFoundError:
+                # The data file was compacted away since the index was read
+                self._index_inode = None
+                return self._get(chunk_id)
+
+    def get_many(self, chunk_ids):
+        """
+        Return [(text, page)] of chunk_ids, in order, or None if any is not stored.
+        """
+        chunks = []
+        for chunk_id in chunk_ids:
+            chunk = self.get(chunk_id)
+            if chunk is None:
+                return None
+            chunks.append(chunk)
+        return chunks
+
+    def append(self, chunk_ids, chunks):
+        """
+        Store (text, page) chunks under their ids, skipping ids already stored.
+        Only one process may append at a time (ingestion holds the build lock).
+        Returns the number of chunks written.
+        """
+        with self._lock:
+            self._refresh()
+            new = {}
+            for chunk_id, chunk in zip(chunk_ids, chunks):
+                if chunk_id not in self.offsets:
+                    new.setdefault(chunk_id, chunk)
+            if not new:
+                return 0
+            os.makedirs(self.directory, exist_ok=True)
+            records = []
+            with open(self.data_path, 'ab') as f:
+                if not f.tell():
+                    f.write(MAGIC)
+                for chunk_id, (text, page) in new.items():
+                    payload = compress(self.codec, text.encode('utf-8'))
+                    offset = f.tell()
+                    f.write(FRAME_HEADER.pack(self.codec, len(payload)))
+                    f.write(payload)
+                    encoded_id = chunk_id.encode('utf-8')
+                    records.append(
+                        INDEX_RECORD.pack(offset, -1 if page is None else page, len(encoded_id)) + encoded_id
+                    )
+                    self.offsets[chunk_id] = (offset, page)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, 'ab') as f:
+                if not f.tell():
+                    f.write(index_header(self.data_path))
+                f.write(b''.join(records))
+                self._index_inode = os.fstat(f.fileno()).st_ino
+            # Our own records are already in offsets
+            self._index_position = os.path.getsize(self.index_path)
+            return len(new)
+
+    def compact(self, keep_ids, min_dead_fraction=COMPACT_DEAD_FRACTION):
+        """
+        Drop the chunks whose ids are not in keep_ids once they make up at least
+        min_dead_fraction of the store. The others are copied, still
+        compressed, into a new data file, and an index naming it replaces the
+        old index atomically. Only one process may compact or append at a time
+        (ingestion holds the build lock). Returns the number of chunks dropped.
+        """
+        with self._lock:
+            self._refresh()
+            kept = [chunk_id for chunk_id in self.offsets if chunk_id in keep_ids]
+            dropped = len(self.offsets) - len(kept)
+            if not dropped or dropped < min_dead_fraction * len(self.offsets):
+                return 0
+            data_path = os.path.join(self.directory, f"chunks-{uuid.uuid4().hex[:12]}.dat")
+            offsets = {}
+            records = []
+            with open(data_path, 'wb') as f:
+                f.write(MAGIC)
+                for chunk_id in kept:
+                    offset, page = self.offsets[chunk_id]
+                    offsets[chunk_id] = (f.tell(), page)
+                    f.write(self._raw_frame(offset))
+                    encoded_id = chunk_id.encode('utf-8')
+                    records.append(
+                        INDEX_RECORD.pack(offsets[chunk_id][0], -1 if page is None else page, len(encoded_id))
+                        + encoded_id
+                    )
+                f.flush()
+                os.fsync(f.fileno())
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(index_header(data_path))
+                f.write(b''.join(records))
+                f.flush()
+                os.fsync(f.fileno())
+                self._index_inode = os.fstat(f.fileno()).st_ino
+                self._index_position = f.tell()
+            os.replace(tmp_path, self.index_path)
+
+            old_data_path = self.data_path
+            self.data_path = data_path
+            self.offsets = offsets
+            self._map = None
+            os.remove(old_data_path)
+            logger.info(f"Compacted chunk store {self.directory}: {dropped} chunks dropped, {len(kept)} kept.")
+            return dropped
+
+    def size_bytes(self):
+        return sum(os.path.getsize(path) for path in (self.data_path, self.index_path) if os.path.exists(path))
+
+
+def index_header(data_path):
+    name = os.path.basename(data_path).encode('utf-8')
+    return INDEX_MAGIC + DATA_NAME_LENGTH.pack(len(name)) + name
+
+
+@lru_cache(maxsize=None)
+def _open_chunk_store(pid, directory, compression):
+    return ChunkStore(directory, compression=compression)
+
+
+def get_chunk_store():
+    """
+    Return this process's chunk store, or None if RAG_CHUNK_STORE_DIR is empty.
+    Keyed by pid, so a store opened before a fork is not shared with the workers.
+    """
+    if not settings.RAG_CHUNK_STORE_DIR:
+        return None
+    return _open_chunk_store(os.getpid(), settings.RAG_CHUNK_STORE_DIR, settings.RAG_CHUNK_STORE_COMPRESSION)
@@ -0,0 +1,299 @@
+"""
+Assembly of the retrieved chunks into the context part of the chat prompt.
+
+Retrieval returns up to RAG_CONTEXT_MAX_CHUNKS candidates with their cosine
+similarity to the query. Before they reach the prompt they are:
+
+1. filtered: chunks below RAG_CONTEXT_MIN_SCORE (by default a threshold
+   suited to the embedding model), or more than RAG_CONTEXT_SCORE_MARGIN below
+   the best one, are dropped, so the number of chunks adapts to how many are
+   actually relevant;
+2. de-duplicated: text a chunk shares with a selected neighbour (the chunker's
+   overlap) is cut, and chunks mostly made of text already selected are dropped;
+3. trimmed to RAG_CONTEXT_TOKEN_BUDGET tokens.
+
+Retrieval runs under a deadline of RAG_RETRIEVAL_TIMEOUT seconds. A turn whose
+retrieval is slower, or fails, goes ahead with NO_CONTEXT; a slow retrieval
+still finishes in the background, so the query embedding and the opened index
+are cached for the next turn. At most RETRIEVAL_THREADS retrievals run at a
+time per worker: past that a turn goes ahead with NO_CONTEXT at once instead
+of queueing behind retrievals that are already late, and a turn whose query is
+already being retrieved waits for that retrieval rather than starting another.
+"""
+import asyncio
+import logging
+import os
+import re
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+
+from django.conf import settings
+
+from mindshaft import metrics
+from .embedding_cache import normalize_query
+from .embeddings import get_context_min_score
+from .parsing import get_encoding
+from .retriever import get_retriever
+
+logger = logging.getLogger(__name__)
+
+NO_CONTEXT = "No relevant context available."
+SEPARATOR = "\n"
+WORD_PATTERN = re.compile(r"\S+")
+SHINGLE_SIZE = 3
+# Shorter runs of shared words are coincidence, not chunk overlap
+MIN_OVERLAP_WORDS = 8
+# A chunk cut to fewer tokens than this is not worth its place in the prompt
+MIN_PARTIAL_TOKENS = 50
+SENTENCE_ENDS = ".!?\n"
+TOKEN_BUCKETS = (0, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000)
+# Retrievals per worker run under the deadline at a time; a retrieval left
+# running past its deadline keeps its slot until it finishes.
+RETRIEVAL_THREADS = 8
+
+RetrievedContext = namedtuple("RetrievedContext", ["text", "tokens", "chunks"])
+
+
+def count_tokens(text):
+    """
+    Count the tokens of text.
+    """
+    if not text:
+        return 0
+    return len(get_encoding().encode(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """
+    Cut text down to at most max_tokens tokens, at a sentence end if one is in
+    the second half.
+    """
+    tokens = get_encoding().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    text = get_encoding().decode(tokens[:max_tokens])
+    end = max(text.rfind(mark) for mark in SENTENCE_ENDS)
+    if end >= len(text) // 2:
+        text = text[:end + 1]
+    return text.rstrip()
+
+
+def select_relevant(scored, min_score, margin):
+    """
+    Keep the documents of [(document, score)] scoring at least min_score and
+    within margin of the best score. Documents without a score (keyword
+    matches whose vector could not be found) are dropped.
+    """
+    scores = [score for document, score in scored if score is not None]
+    floor = max(min_score, max(scores) - margin) if scores else min_score
+    return [document for document, score in scored if score is not None and score >= floor]
+
+
+def overlap_length(ending, starting):
+    """
+    Number of words at the end of `ending` that `starting` begins with, if at
+    least MIN_OVERLAP_WORDS.
+    """
+    if not starting:
+        return 0
+    head = starting[0]
+    for length in range(min(len(ending), len(starting)), MIN_OVERLAP_WORDS - 1, -1):
+        if ending[-length] == head and ending[-length:] == starting[:length]:
+            return length
+    return 0
+
+
+def shingles(words):
+    """
+    Set of SHINGLE_SIZE-word runs of words, lowercased.
+    """
+    words = [word.lower() for word in words]
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def deduplicate(documents, threshold):
+    """
+    Return the texts of documents without the overlap they share with chunks
+    before them, skipping those whose shingles are more than threshold already
+    covered.
+    """
+    selected = []  # (source, words) of the chunks kept so far
+    seen = set()
+    texts = []
+    for document in documents:
+        text = document.page_content
+        source = document.metadata.get('id')
+        spans = [match.span() for match in WORD_PATTERN.finditer(text)]
+        words = [text[start:end] for start, end in spans]
+        front = back = 0
+        for other_source, other_words in selected:
+            if other_source == source:
+                front = max(front, overlap_length(other_words, words))
+                back = max(back, overlap_length(words, other_words))
+        if front + back >= len(words):
+            continue
+        words = words[front:len(words) - back]
+        chunk_shingles = shingles(words)
+        if len(chunk_shingles & seen) > threshold * len(chunk_shingles):
+            continue
+        selected.append((source, words))
+        seen |= chunk_shingles
+        texts.append(text[spans[front][0]:spans[len(spans) - back - 1][1]])
+    return texts
+
+
+def fit_to_budget(texts, budget):
+    """
+    Return the leading texts that fit into budget tokens; the first one that
+    does not fit is cut short if enough of it does.
+    """
+    kept = []
+    used = 0
+    for text in texts:
+        tokens = count_tokens(text) + (count_tokens(SEPARATOR) if kept else 0)
+        if used + tokens <= budget:
+            kept.append(text)
+            used += tokens
+            continue
+        remaining = budget - used - (count_tokens(SEPARATOR) if kept else 0)
+        if remaining >= MIN_PARTIAL_TOKENS:
+            kept.append(truncate_tokens(text, remaining))
+        break
+    return kept
+
+
+def assemble_context(scored):
+    """
+    Turn [(document, score)] retrieval results, best first, into the prompt
+    context as configured by the RAG_CONTEXT_* settings.
+    """
+    documents = select_relevant(scored, get_context_min_score(), settings.RAG_CONTEXT_SCORE_MARGIN)
+    texts = deduplicate(documents, settings.RAG_CONTEXT_DEDUP_THRESHOLD)
+    texts = fit_to_budget(texts, settings.RAG_CONTEXT_TOKEN_BUDGET)
+    metrics.incr('rag.context.chunks_retrieved', len(scored))
+    metrics.incr('rag.context.chunks_used', len(texts))
+    if not texts:
+        metrics.observe('rag.context.tokens', 0, buckets=TOKEN_BUCKETS)
+        return RetrievedContext(NO_CONTEXT, 0, 0)
+    text = SEPARATOR.join(texts)
+    tokens = count_tokens(text)
+    metrics.observe('rag.context.tokens', tokens, buckets=TOKEN_BUCKETS)
+    return RetrievedContext(text, tokens, len(texts))
+
+
+def no_context(reason):
+    """
+    The empty context of a turn whose retrieval did not finish: timed out,
+    failed or found every retrieval slot taken.
+    """
+    metrics.incr(f'rag.context.{reason}')
+    return RetrievedContext(NO_CONTEXT, 0, 0)
+
+
+class RetrievalPool:
+    """
+    Threads running retrievals under the deadline, with a slot per thread so
+    no retrieval ever waits in the executor's queue. Callers asking for a
+    query that is already being retrieved share its future.
+    """
+
+    def __init__(self, size):
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='retrieval')
+        self.slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._running = {}  # Normalized query: future of its retrieval
+
+    def submit(self, fn, query):
+        """
+        Return the future of fn(query), or None when every slot is taken.
+        """
+        key = normalize_query(query)
+        with self._lock:
+            future = self._running.get(key)
+            if future is not None:
+                metrics.incr('rag.context.retrievals_merged')
+                return future
+            if not self.slots.acquire(blocking=False):
+                return None
+            future = self._running[key] = self.executor.submit(fn, query)
+        future.add_done_callback(partial(self._finished, key))
+        return future
+
+    def _finished(self, key, future):
+        with self._lock:
+            if self._running.get(key) is future:
+                del self._running[key]
+        self.slots.release()
+
+
+@lru_cache(maxsize=None)
+def _retrieval_pool(pid):
+    return RetrievalPool(RETRIEVAL_THREADS)
+
+
+def _retrieve(query):
+    return assemble_context(get_retriever().similarity_search_with_scores(query, k=settings.RAG_CONTEXT_MAX_CHUNKS))
+
+
+async def _aretrieve(query):
+    scored = await get_retriever().asimilarity_search_with_scores(query, k=settings.RAG_CONTEXT_MAX_CHUNKS)
+    return assemble_context(scored)
+
+
+def _log_background_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Retrieval past its deadline failed: {task.exception()}")
+
+
+_background = set()  # Retrievals past their deadline; referenced so they are not collected
+
+
+def retrieve_context(query):
+    """
+    Retrieve the chunks relevant to the user's message and assemble them into
+    a RetrievedContext, or NO_CONTEXT past the deadline.
+    """
+    timeout = settings.RAG_RETRIEVAL_TIMEOUT
+    try:
+        if not timeout:
+            return _retrieve(query)
+        future = _retrieval_pool(os.getpid()).submit(_retrieve, query)
+        if future is None:
+            logger.warning("Every retrieval slot is taken; answering without context.")
+            return no_context('busy')
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        logger.warning(f"Retrieval took longer than {timeout}s; answering without context.")
+        return no_context('deadline_exceeded')
+    except Exception as e:
+        logger.warning(f"Retrieval failed; answering without context: {e}")
+        return no_context('retrieval_failed')
+
+
+async def aretrieve_context(query):
+    """
+    Async retrieve_context.
+    """
+    timeout = settings.RAG_RETRIEVAL_TIMEOUT
+    slots = _retrieval_pool(os.getpid()).slots
+    if not slots.acquire(blocking=False):
+        logger.warning("Every retrieval slot is taken; answering without context.")
+        return no_context('busy')
+    task = asyncio.ensure_future(_aretrieve(query))
+    task.add_done_callback(lambda task: slots.release())
+    try:
+        # shield: the retrieval keeps running when the wait times out
+        return await asyncio.wait_for(asyncio.shield(task), timeout or None)
+    except TimeoutError:
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+        task.add_done_callback(_log_background_failure)
+        logger.warning(f"Retrieval took longer than {timeout}s; answering without context.")
+        return no_context('deadline_exceeded')
+    except Exception as e:
+        logger.warning(f"Retrieval failed; answering without context: {e}")
+        return no_context('retrieval_failed')
@@ -0,0 +1,178 @@
+"""
+Near-duplicate chunk detection with MinHash and locality-sensitive hashing.
+
+Different editions and compilations of a book produce chunks that are almost,
+but not exactly, the same text. Every chunk gets a MinHash signature of its
+5-word shingles; chunks whose signatures agree on at least RAG_DEDUP_THRESHOLD
+of their values (the estimated Jaccard similarity) are near-duplicates. An LSH
+table over bands of the signatures finds the candidates, so a new chunk is only
+compared with the few chunks it shares a band with.
+
+The signatures of a generation's chunks are saved next to its collection
+(minhash.npz) and copied with it, so later runs deduplicate against the whole
+index without re-hashing it.
+"""
+import logging
+import os
+import re
+from collections import defaultdict
+
+import mmh3
+import numpy as np
+
+from .mmap_index import EXPORT_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+SIGNATURES_FILE = 'minhash.npz'
+SHINGLE_WORDS = 5
+PERMUTATIONS = 128
+# 16 bands of 8 rows: pairs with a Jaccard similarity of 0.8 share a band 95% of the time
+BANDS = 16
+ROWS = PERMUTATIONS // BANDS
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+WORD_PATTERN = re.compile(r"\w+")
+
+_rng = np.random.RandomState(20240601)
+PERMUTATION_A = _rng.randint(1, (1 << 61) - 1, size=PERMUTATIONS, dtype=np.uint64)
+PERMUTATION_B = _rng.randint(0, (1 << 61) - 1, size=PERMUTATIONS, dtype=np.uint64)
+BAND_MULTIPLIERS = _rng.randint(1, (1 << 63) - 1, size=ROWS, dtype=np.uint64) | np.uint64(1)
+
+
+def minhash(text):
+    """
+    MinHash signature (PERMUTATIONS uint32 values) of the word shingles of text.
+    """
+    words = WORD_PATTERN.findall(text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(len(words) - SHINGLE_WORDS + 1, 1))}
+    hashes = np.fromiter((mmh3.hash(shingle, signed=False) for shingle in shingles), dtype=np.uint64)
+    # One universal hash per permutation; uint64 overflow wraps, which is fine for hashing
+    values = ((hashes[:, np.newaxis] * PERMUTATION_A + PERMUTATION_B) % MERSENNE_PRIME) & MAX_HASH
+    return values.min(axis=0).astype(np.uint32)
+
+
+def band_keys(signatures):
+    """
+    One hash per band of each signature: an array of shape (n, BANDS).
+    """
+    bands = np.asarray(signatures, dtype=np.uint32).reshape(-1, BANDS, ROWS).astype(np.uint64)
+    return (bands * BAND_MULTIPLIERS).sum(axis=2)
+
+
+def document_of(chunk_id):
+    """
+    Document id part of a chunk id ("<doc>:<hash>:<n>", or "<doc>-<n>" for older chunks).
+    """
+    return chunk_id.split(':', 1)[0].split('-', 1)[0]
+
+
+class ChunkDeduplicator:
+    """
+    MinHash signatures of the chunks of an index generation and the LSH table
+    over them.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.signatures = {}  # chunk id -> signature
+        self.buckets = [defaultdict(set) for _ in range(BANDS)]  # per band: band hash -> chunk ids
+
+    @classmethod
+    def load(cls, directory, threshold, collection=None):
+        """
+        Load the signatures saved in directory. Without them, the chunks of
+        collection (if given) are hashed once.
+        """
+        deduplicator = cls(threshold)
+        path = os.path.join(directory, SIGNATURES_FILE)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                deduplicator.add_many(data['ids'].tolist(), data['signatures'])
+        elif collection is not None:
+            offset = 0
+            while True:
+                page = collection.get(include=['documents'], limit=EXPORT_PAGE_SIZE, offset=offset)
+                if not page['ids']:
+                    break
+                deduplicator.add_many(page['ids'], [minhash(text or '') for text in page['documents']])
+                offset += len(page['ids'])
+            if offset:
+                logger.info(f"Computed MinHash signatures of {offset} existing chunks.")
+        return deduplicator
+
+    def save(self, directory, keep_ids):
+        """
+        Save the signatures of the chunks in keep_ids into directory.
+        """
+        ids = [chunk_id for chunk_id in self.signatures if chunk_id in keep_ids]
+        signatures = np.array([self.signatures[chunk_id] for chunk_id in ids], dtype=np.uint32).reshape(
+            len(ids), PERMUTATIONS
+        )
+        tmp_path = os.path.join(directory, f"{SIGNATURES_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, ids=np.array(ids, dtype=str), signatures=signatures)
+        os.replace(tmp_path, os.path.join(directory, SIGNATURES_FILE))
+
+    def add_many(self, chunk_ids, signatures):
+        if not len(chunk_ids):
+            return
+        for chunk_id, signature, keys in zip(chunk_ids, signatures, band_keys(signatures).tolist()):
+            self.signatures[chunk_id] = signature
+            for band, key in enumerate(keys):
+                self.buckets[band][key].add(chunk_id)
+
+    def remove(self, chunk_ids):
+        """
+        Forget chunks. Returns {chunk id: signature} of those that were known.
+        """
+        removed = {}
+        for chunk_id in chunk_ids:
+            signature = self.signatures.pop(chunk_id, None)
+            if signature is None:
+                continue
+            removed[chunk_id] = signature
+            for band, key in enumerate(band_keys([signature])[0].tolist()):
+                bucket = self.buckets[band].get(key)
+                if bucket is not None:
+                    bucket.discard(chunk_id)
+                    if not bucket:
+                        del self.buckets[band][key]
+        return removed
+
+    def find(self, signature, keys):
+        """
+        Return the id of a known chunk near-duplicating the signature, or None.
+        """
+        candidates = set()
+        for band, key in enumerate(keys):
+            candidates |= self.buckets[band].get(key, set())
+        best = None
+        best_similarity = self.threshold
+        for chunk_id in candidates:
+            similarity = float(np.mean(self.signatures[chunk_id] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = chunk_id, similarity
+        return best
+
+    def filter(self, chunk_ids, chunks):
+        """
+        Split (text, page) chunks into those to keep and near-duplicates of
+        known chunks or of chunks before them. Kept chunks become known.
+
+        Returns (kept ids, kept chunks, dropped chunks, ids of the documents
+        the dropped chunks duplicate).
+        """
+        signatures = [minhash(text) for text, page in chunks]
+        keys = band_keys(signatures).tolist() if signatures else []
+        kept_ids, kept_chunks, dropped, duplicated = [], [], [], set()
+        for chunk_id, chunk, signature, chunk_keys in zip(chunk_ids, chunks, signatures, keys):
+            original = self.find(signature, chunk_keys)
+            if original is not None and original != chunk_id:
+                dropped.append(chunk)
+                duplicated.add(document_of(original))
+                continue
+            kept_ids.append(chunk_id)
+            kept_chunks.append(chunk)
+            self.add_many([chunk_id], [signature])
+        return kept_ids, kept_chunks, dropped, duplicated
@@ -0,0 +1,314 @@
+"""
+Embedding caches.
+
+Query embeddings use two tiers: a bounded in-process LRU and a SQLite file
+shared by all workers on the host, trimmed by size. Keys are a hash of the
+embedding model and the normalized query, so common openers ("I feel anxious")
+are embedded once and then served without a network round-trip.
+
+Ingestion uses a content-addressed store: chunk vectors keyed by the hash of
+the model and the chunk text, kept without eviction.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from langchain_core.embeddings import Embeddings
+
+from mindshaft import metrics
+
+logger = logging.getLogger(__name__)
+
+# Only refresh a disk entry's access time when it is older than this (seconds),
+# so hits do not turn into writes.
+TOUCH_AFTER = 3600
+# Check the disk tier's size every this many writes per process
+EVICT_CHECK_EVERY = 64
+
+
+def normalize_query(text):
+    """
+    Collapse whitespace and case so trivially different queries share an entry.
+    """
+    return " ".join(text.split()).lower()
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def pack_vector(vector):
+    return array("f", vector).tobytes()
+
+
+def unpack_vector(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded least-recently-used mapping.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskVectorCache:
+    """
+    SQLite-backed vector cache shared between processes. When max_bytes is set the
+    least recently used entries are evicted once the stored vectors exceed it.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS vectors ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS vectors_accessed ON vectors (accessed)")
+
+    def _connect(self):
+        # One connection per thread and process; sqlite connections are not shareable
+        key = (os.getpid(), threading.get_ident())
+        if getattr(self._local, "key", None) != key:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.key = key
+        return self._local.connection
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT vector, accessed FROM vectors WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > TOUCH_AFTER:
+            self._connect().execute("UPDATE vectors SET accessed = ? WHERE key = ?", (now, key))
+        return unpack_vector(row[0])
+
+    def get_many(self, keys):
+        """
+        Return a dict of key -> vector for the keys that are stored.
+        """
+        found = {}
+        keys = list(keys)
+        # Stay below SQLite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._connect().execute(
+                f"SELECT key, vector FROM vectors WHERE key IN ({placeholders})", batch
+            )
+            for key, blob in rows:
+                found[key] = unpack_vector(blob)
+        return found
+
+    def set(self, key, vector):
+        self.set_many([(key, vector)])
+
+    def set_many(self, items):
+        now = time.time()
+        rows = []
+        for key, vector in items:
+            blob = pack_vector(vector)
+            rows.append((key, blob, len(blob), now))
+        connection = self._connect()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO vectors (key, vector, size, accessed) VALUES (?, ?, ?, ?)", rows
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        self._writes += len(rows)
+        if self.max_bytes and self._writes >= EVICT_CHECK_EVERY:
+            self._writes = 0
+            self.evict()
+
+    def size_bytes(self):
+        return self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM vectors").fetchone()[0]
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache is under 90% of max_bytes.
+        """
+        connection = self._connect()
+        excess = self.size_bytes() - int(self.max_bytes * 0.9)
+        evicted = 0
+        while excess > 0:
+            rows = connection.execute(
+                "SELECT key, size FROM vectors ORDER BY accessed LIMIT 256"
+            ).fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, size in rows:
+                keys.append(key)
+                excess -= size
+                if excess <= 0:
+                    break
+            connection.execute(f"DELETE FROM vectors WHERE key IN ({','.join('?' * len(keys))})", keys)
+            evicted += len(keys)
+        if evicted:
+            metrics.incr("rag.query_embedding_cache.evicted", evicted)
+            logger.info(f"Evicted {evicted} vectors from {self.path}.")
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves embed_query from the memory and disk tiers
+    before calling the wrapped client. Document embeddings pass straight through.
+    """
+
+    def __init__(self, embeddings, model, memory_size, disk_cache=None):
+        self.embeddings = embeddings
+        self.model = model
+        self.memory = LRUCache(memory_size)
+        self.disk = disk_cache
+
+    def _lookup_memory(self, text):
+        key = cache_key(self.model, normalize_query(text))
+        vector = self.memory.get(key)
+        if vector is not None:
+            metrics.incr("rag.query_embedding_cache.memory_hits")
+        return key, vector
+
+    def _lookup_disk(self, key):
+        vector = None
+        if self.disk is not None:
+            try:
+                vector = self.disk.get(key)
+            except sqlite3.Error as e:
+                logger.warning(f"Query embedding disk cache read failed: {e}")
+            if vector is not None:
+                metrics.incr("rag.query_embedding_cache.disk_hits")
+                self.memory.set(key, vector)
+                return vector
+        metrics.incr("rag.query_embedding_cache.misses")
+        return None
+
+    def _store_disk(self, key, vector):
+        if self.disk is not None:
+            try:
+                self.disk.set(key, vector)
+            except sqlite3.Error as e:
+                logger.warning(f"Query embedding disk cache write failed: {e}")
+
+    def embed_query(self, text):
+        key, vector = self._lookup_memory(text)
+        if vector is None:
+            vector = self._lookup_disk(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(" ".join(text.split()))
+            self.memory.set(key, vector)
+            self._store_disk(key, vector)
+        return vector
+
+    async def aembed_query(self, text):
+        key, vector = self._lookup_memory(text)
+        if vector is None and self.disk is not None:
+            # SQLite reads and writes stay off the event loop
+            vector = await asyncio.to_thread(self._lookup_disk, key)
+        elif vector is None:
+            vector = self._lookup_disk(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(" ".join(text.split()))
+            self.memory.set(key, vector)
+            if self.disk is not None:
+                await asyncio.to_thread(self._store_disk, key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embeddings.aembed_documents(texts)
+
+    def stats(self):
+        counters = metrics.snapshot()["counters"]
+        return {
+            "memory_entries": len(self.memory),
+            "memory_hits": counters.get("rag.query_embedding_cache.memory_hits", 0),
+            "disk_hits": counters.get("rag.query_embedding_cache.disk_hits", 0),
+            "misses": counters.get("rag.query_embedding_cache.misses", 0),
+        }
+
+
+class ContentAddressedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper for ingestion. Every chunk vector is stored under the hash
+    of the model and the exact chunk text, and embed_documents only sends texts
+    it has never seen to the wrapped client, so re-ingesting an unchanged corpus
+    makes no embedding calls.
+    """
+
+    def __init__(self, embeddings, model, store):
+        self.embeddings = embeddings
+        self.model = model
+        self.store = store
+
+    def embed_documents(self, texts):
+        keys = [cache_key(self.model, text) for text in texts]
+        vectors = self.store.get_many(set(keys))
+
+        # Embed each unseen text once, even if it repeats within the batch
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+
+        metrics.incr("rag.chunk_embedding_store.hits", len(texts) - len(missing))
+        metrics.incr("rag.chunk_embedding_store.misses", len(missing))
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), new_vectors))
+            self.store.set_many(computed.items())
+            vectors.update(computed)
+            logger.info(f"Embedded {len(missing)} new chunks, reused {len(texts) - len(missing)}.")
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
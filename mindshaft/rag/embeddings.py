@@ -0,0 +1,135 @@
+"""
+Embedding clients used for ingestion and retrieval.
+
+The backend is chosen with RAG_EMBEDDING_BACKEND: 'openai' calls the OpenAI
+API, 'onnx' runs a sentence-embedding model locally on the CPU. Cache keys and
+the index record the model name, so switching backends never mixes vectors
+from different models.
+"""
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from langchain_openai import OpenAIEmbeddings
+
+from mindshaft.clients import get_async_http_client, get_http_client
+from .embedding_cache import CachedQueryEmbeddings, ContentAddressedEmbeddings, DiskVectorCache
+from .onnx_embeddings import ONNX_MODEL, OnnxEmbeddings
+from .query_batching import BatchingEmbeddings
+
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+
+# Model used by each backend unless RAG_EMBEDDING_MODEL names another
+DEFAULT_MODELS = {
+    'openai': EMBEDDING_MODEL,
+    'onnx': ONNX_MODEL,
+}
+
+# Cosine similarity a chunk needs to reach the prompt, per model, unless
+# RAG_CONTEXT_MIN_SCORE is set. Each model spreads its similarities differently.
+DEFAULT_MIN_SCORES = {
+    EMBEDDING_MODEL: 0.7,
+    ONNX_MODEL: 0.3,
+}
+
+
+def get_embedding_model():
+    """
+    Name of the configured embedding model.
+    """
+    backend = settings.RAG_EMBEDDING_BACKEND
+    if backend not in DEFAULT_MODELS:
+        raise ValueError(f"Unknown RAG_EMBEDDING_BACKEND {backend!r}; use one of {', '.join(DEFAULT_MODELS)}.")
+    if backend == 'onnx' and settings.RAG_ONNX_MODEL_DIR and not settings.RAG_EMBEDDING_MODEL:
+        # The index records this name; the default one would hide a change of model
+        raise ImproperlyConfigured("RAG_ONNX_MODEL_DIR is set, so RAG_EMBEDDING_MODEL must name the model in it.")
+    return settings.RAG_EMBEDDING_MODEL or DEFAULT_MODELS[backend]
+
+
+def get_context_min_score():
+    """
+    Minimum similarity of the chunks put into the prompt: RAG_CONTEXT_MIN_SCORE,
+    or the configured model's default. Models without one only get the score
+    margin applied.
+    """
+    if settings.RAG_CONTEXT_MIN_SCORE is not None:
+        return settings.RAG_CONTEXT_MIN_SCORE
+    return DEFAULT_MIN_SCORES.get(get_embedding_model(), 0.0)
+
+
+def index_embedding_model(metadata):
+    """
+    Model recorded in a collection's (or manifest's) metadata. Indexes built
+    before it was recorded were all made with the OpenAI model.
+    """
+    return (metadata or {}).get('embedding_model') or EMBEDDING_MODEL
+
+
+def get_embeddings(model=None):
+    """
+    Return the shared embeddings client of the configured backend for this worker.
+    """
+    return _get_embeddings(settings.RAG_EMBEDDING_BACKEND, model or get_embedding_model(), os.getpid())
+
+
+@lru_cache(maxsize=None)
+def _get_embeddings(backend, model, pid):
+    if backend == 'onnx':
+        kwargs = {'model_dir': settings.RAG_ONNX_MODEL_DIR} if settings.RAG_ONNX_MODEL_DIR else {}
+        return OnnxEmbeddings(
+            batch_size=settings.RAG_ONNX_BATCH_SIZE,
+            threads=settings.RAG_ONNX_THREADS,
+            **kwargs
+        )
+    return OpenAIEmbeddings(
+        openai_api_key=settings.OPENAI_API_KEY,
+        model=model,
+        http_client=get_http_client(),
+        http_async_client=get_async_http_client(),
+    )
+
+
+def get_query_embeddings(model=None):
+    """
+    Return the embeddings client used for chat queries: the shared client behind
+    the query batcher and the memory and disk query caches.
+    """
+    return _get_query_embeddings(model or get_embedding_model(), os.getpid())
+
+
+@lru_cache(maxsize=None)
+def _get_query_embeddings(model, pid):
+    disk_cache = None
+    if settings.RAG_QUERY_CACHE_PATH:
+        disk_cache = DiskVectorCache(
+            settings.RAG_QUERY_CACHE_PATH,
+            max_bytes=settings.RAG_QUERY_CACHE_MAX_MB * 1024 * 1024,
+        )
+    return CachedQueryEmbeddings(
+        BatchingEmbeddings(
+            get_embeddings(model),
+            max_wait_ms=settings.RAG_QUERY_BATCH_WAIT_MS,
+            max_size=settings.RAG_QUERY_BATCH_SIZE,
+        ),
+        model=model,
+        memory_size=settings.RAG_QUERY_CACHE_SIZE,
+        disk_cache=disk_cache,
+    )
+
+
+def get_document_embeddings(model=None):
+    """
+    Return the embeddings client used for ingestion: the shared client behind the
+    content-addressed chunk store, so only never-seen chunks are embedded.
+    """
+    return _get_document_embeddings(model or get_embedding_model(), os.getpid())
+
+
+@lru_cache(maxsize=None)
+def _get_document_embeddings(model, pid):
+    return ContentAddressedEmbeddings(
+        get_embeddings(model),
+        model=model,
+        store=DiskVectorCache(settings.RAG_EMBEDDING_STORE_PATH),
+    )
@@ -0,0 +1,259 @@
+"""
+Generations of the vector index.
+
+The index root (CHROMA_DB_DIR) holds one directory per generation, each with
+its own Chroma collection, manifest and derived indexes, and a CURRENT file
+naming the live one. Ingestion builds the next generation beside the live one,
+from scratch or from a copy of it, checks it and makes it live by replacing
+CURRENT atomically. The copy is made with reflinks where the filesystem has
+them (Btrfs, XFS), so it shares data blocks with the live generation until
+either is written to; elsewhere it is a plain copy, which costs time in
+proportion to the Chroma files. Workers switch on their next version check; nothing they
+have open is modified or deleted under them.
+
+HISTORY lists the generations that went live, oldest first, so
+`rollback_vector_index` can make the previous one live again. Only the newest
+RAG_INDEX_GENERATIONS are kept.
+
+Documents deleted since the live generation was built are listed in
+TOMBSTONES at the root; retrievers leave their chunks out of every search until
+a generation without them goes live.
+
+An index root written before generations existed is read as a generation of
+its own (named LEGACY) until a newer one goes live and it is pruned.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+POINTER_FILE = 'CURRENT'
+HISTORY_FILE = 'HISTORY'
+LOCK_FILE = 'BUILD_LOCK'
+TOMBSTONE_FILE = 'TOMBSTONES'
+TOMBSTONE_LOCK_FILE = 'TOMBSTONES_LOCK'
+# Index root files that belong to no generation
+BOOKKEEPING_FILES = (POINTER_FILE, HISTORY_FILE, LOCK_FILE, TOMBSTONE_FILE, TOMBSTONE_LOCK_FILE)
+PREFIX = 'gen-'
+LEGACY = '.'
+CHROMA_FILE = 'chroma.sqlite3'
+# Rebuilt in every new generation rather than copied
+DERIVED_PREFIXES = ('mmap-', 'bm25-')
+DERIVED_FILES = ('MMAP_INDEX', 'LEXICAL_INDEX', 'INDEX_VERSION')
+# ioctl cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def read_current(root):
+    """
+    Name of the live generation, or None if there is none.
+    """
+    try:
+        with open(os.path.join(root, POINTER_FILE), encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return LEGACY if os.path.exists(os.path.join(root, CHROMA_FILE)) else None
+
+
+def live_generation(root):
+    """
+    Directory of the live generation, or None if there is none.
+    """
+    name = read_current(root)
+    if name is None:
+        return None
+    path = os.path.normpath(os.path.join(root, name))
+    return path if os.path.isdir(path) else None
+
+
+def read_history(root):
+    try:
+        with open(os.path.join(root, HISTORY_FILE), encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def _write(root, file_name, text):
+    tmp_path = os.path.join(root, f"{file_name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, os.path.join(root, file_name))
+
+
+@contextmanager
+def build_lock(root, blocking=True):
+    """
+    Hold the root's build lock, so one process at a time creates, activates,
+    prunes or writes to generations. Yields whether the lock is held: without
+    blocking, False when another process has it.
+    """
+    with _file_lock(root, LOCK_FILE, blocking) as locked:
+        yield locked
+
+
+@contextmanager
+def _file_lock(root, file_name, blocking=True):
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, file_name), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _copy_ignore(root):
+    def ignore(directory, names):
+        ignored = {name for name in names if name.startswith(DERIVED_PREFIXES) or name in DERIVED_FILES}
+        if os.path.normpath(directory) == os.path.normpath(root):
+            # Copying a legacy root: leave out the generations and their bookkeeping
+            ignored |= {
+                name for name in names
+                if name.startswith(PREFIX) or name in BOOKKEEPING_FILES
+            }
+        return ignored
+    return ignore
+
+
+def read_tombstones(root):
+    """
+    Ids (strings) of the documents deleted since the live generation was built.
+    """
+    try:
+        with open(os.path.join(root, TOMBSTONE_FILE), encoding='utf-8') as f:
+            return frozenset(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        return frozenset()
+
+
+def _update_tombstones(root, update):
+    with _file_lock(root, TOMBSTONE_LOCK_FILE):
+        tombstones = read_tombstones(root)
+        updated = update(tombstones)
+        if updated != tombstones:
+            _write(root, TOMBSTONE_FILE, "".join(f"{doc_id}\n" for doc_id in sorted(updated)))
+
+
+def add_tombstone(root, doc_id):
+    """
+    Hide a deleted document from retrieval until a generation without it is live.
+    """
+    _update_tombstones(root, lambda tombstones: tombstones | {str(doc_id)})
+
+
+def prune_tombstones(root, indexed):
+    """
+    Forget the tombstones of documents that are not among `indexed` (the
+    document ids of the live generation) any more.
+    """
+    indexed = {str(doc_id) for doc_id in indexed}
+    _update_tombstones(root, lambda tombstones: tombstones & indexed)
+
+
+def clone_file(source, destination):
+    """
+    copytree copy_function: a reflink of source where the filesystem supports
+    it, a regular copy otherwise.
+    """
+    try:
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except OSError:
+        return shutil.copy2(source, destination)
+    shutil.copystat(source, destination)
+    return destination
+
+
+def create_generation(root, copy_from=None):
+    """
+    Create the directory of a new generation, empty or holding a copy of the
+    Chroma collection and manifest of copy_from. Returns its path.
+    """
+    name = f"{PREFIX}{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(root, name)
+    if copy_from is None:
+        os.makedirs(path)
+    else:
+        shutil.copytree(copy_from, path, ignore=_copy_ignore(root), copy_function=clone_file)
+    return path
+
+
+def generation_name(root, path):
+    name = os.path.relpath(path, root)
+    return LEGACY if name == os.curdir else name
+
+
+def activate_generation(root, path, keep=2):
+    """
+    Make the generation at path live and prune all but the newest `keep`.
+    """
+    name = generation_name(root, path)
+    history = read_history(root)
+    current = read_current(root)
+    if current is not None and (not history or history[-1] != current):
+        history.append(current)
+    history.append(name)
+    _write(root, HISTORY_FILE, "\n".join(history) + "\n")
+    _write(root, POINTER_FILE, name)
+    logger.info(f"Generation {name} of {root} is live.")
+    prune_generations(root, keep)
+
+
+def rollback_generation(root):
+    """
+    Make the generation that was live before the current one live again.
+    Returns its name.
+    """
+    history = read_history(root)
+    current = read_current(root)
+    while history and history[-1] == current:
+        history.pop()
+    if not history or not os.path.isdir(os.path.join(root, history[-1])):
+        raise ValueError("There is no previous index generation to roll back to.")
+    previous = history[-1]
+    _write(root, HISTORY_FILE, "\n".join(history) + "\n")
+    _write(root, POINTER_FILE, previous)
+    logger.info(f"Rolled {root} back to generation {previous}.")
+    return previous
+
+
+def prune_generations(root, keep):
+    """
+    Delete the generations that are neither live nor among the newest `keep`
+    of HISTORY, including unfinished builds. Must run under build_lock.
+    """
+    history = read_history(root)
+    kept = set(history[-max(keep, 1):])
+    kept.add(read_current(root))
+    _write(root, HISTORY_FILE, "".join(f"{name}\n" for name in history if name in kept))
+
+    for entry in os.listdir(root):
+        if entry.startswith(PREFIX) and entry not in kept:
+            shutil.rmtree(os.path.join(root, entry), ignore_errors=True)
+    if LEGACY not in kept and os.path.exists(os.path.join(root, CHROMA_FILE)):
+        for entry in os.listdir(root):
+            if entry.startswith(PREFIX) or entry in BOOKKEEPING_FILES:
+                continue
+            path = os.path.join(root, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+
+
+def discard_generation(root, path):
+    """
+    Delete a generation that never went live.
+    """
+    if generation_name(root, path) not in (read_current(root), LEGACY):
+        shutil.rmtree(path, ignore_errors=True)
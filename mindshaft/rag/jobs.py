@@ -0,0 +1,90 @@
+"""
+Running queued ingestion jobs.
+
+Uploads only save the files and queue an IngestionJob; the run_ingestion_worker
+command claims jobs one at a time and runs ingest_documents with a progress
+reporter that keeps the job row up to date, so clients can poll it.
+"""
+import logging
+
+from django.utils import timezone
+
+from .models import IngestionJob
+from .utils import IngestionProgress, ingest_documents
+
+logger = logging.getLogger(__name__)
+
+# Keep the error list of a job bounded when a whole library fails to parse
+MAX_JOB_ERRORS = 100
+
+
+class JobProgress(IngestionProgress):
+    """
+    Records ingestion progress on an IngestionJob. ingest_documents reports from
+    a single thread, so plain saves are enough.
+    """
+
+    def __init__(self, job):
+        self.job = job
+
+    def started(self, documents_total):
+        self.job.documents_total = documents_total
+        self.job.save(update_fields=['documents_total', 'updated_at'])
+
+    def chunks_added(self, doc_id, pages, chunks):
+        self.job.pages_parsed += pages
+        self.job.chunks_embedded += chunks
+        self.job.save(update_fields=['pages_parsed', 'chunks_embedded', 'updated_at'])
+
+    def document_done(self, doc_id):
+        self.job.documents_done += 1
+        self.job.save(update_fields=['documents_done', 'updated_at'])
+
+    def document_failed(self, doc_id, error):
+        self.job.documents_done += 1
+        if len(self.job.errors) < MAX_JOB_ERRORS:
+            self.job.errors.append({'document_id': doc_id, 'error': error})
+        self.job.save(update_fields=['documents_done', 'errors', 'updated_at'])
+
+
+def run_job(job):
+    """
+    Run a claimed job to completion and record the outcome on it.
+    """
+    logger.info(f"Starting ingestion job {job.pk}.")
+    try:
+        job.summary = ingest_documents(progress=JobProgress(job))
+        job.status = IngestionJob.SUCCEEDED
+    except Exception as e:
+        logger.exception(f"Ingestion job {job.pk} failed.")
+        job.errors.append({'document_id': None, 'error': str(e)})
+        job.status = IngestionJob.FAILED
+    job.finished_at = timezone.now()
+    job.save()
+    logger.info(f"Ingestion job {job.pk} {job.status}: {job.summary}")
+    return job
+
+
+def run_pending_jobs():
+    """
+    Run queued jobs until the queue is empty. Returns how many were run.
+    """
+    count = 0
+    while True:
+        job = IngestionJob.claim_next()
+        if job is None:
+            return count
+        run_job(job)
+        count += 1
+
+
+def fail_abandoned_jobs():
+    """
+    Mark jobs left running by a worker that died as failed. Only call this when
+    no other worker can be running, i.e. when the single worker starts.
+    """
+    return IngestionJob.objects.filter(status=IngestionJob.RUNNING).update(
+        status=IngestionJob.FAILED,
+        finished_at=timezone.now(),
+        errors=[{'document_id': None, 'error': "The worker stopped before the job finished."}],
+    )
@@ -0,0 +1,308 @@
+"""
+BM25 keyword index over the chunks of the vector collection.
+
+Dense embeddings match specific terms ("ADHD", "CBT", a book title) poorly,
+so retrieval also ranks chunks lexically and fuses both rankings. The index is
+rebuilt from the Chroma collection after ingestion and stored as flat files;
+like the memory-mapped vector index it holds chunk ids only and reads the text
+of its hits from the chunk store:
+
+    meta.json        format, row counts, average chunk length and BM25 parameters
+    vocabulary.json  term -> [first posting, document frequency]
+    postings.bin     int32 rows of every term's postings, term after term
+    frequencies.bin  uint16 term frequency of every posting
+    lengths.bin      int32 length of every chunk in terms
+    ids.bin, id_offsets.bin, id_order.bin
+                     chunk ids by row and rows by id (see mmap_index.IdTable)
+    delta_*          vocabulary, postings, frequencies and lengths of the
+                     chunks added since the base
+    deleted.bin      int64 base rows whose chunks are gone, sorted
+
+Like the memory-mapped index, ingestion updates it incrementally: the base
+files of the previous build are hard-linked and only added chunks are indexed,
+until the changes reach MAX_CHANGED_FRACTION of the base and it starts over.
+
+Postings, lengths and ids are memory-mapped, so a query only touches the
+postings of its own terms; a lookup takes well under a millisecond.
+"""
+import json
+import logging
+import os
+import re
+import shutil
+import uuid
+from array import array
+from collections import Counter, namedtuple
+
+import numpy as np
+
+from .mmap_index import (
+    DELTA, MAX_CHANGED_FRACTION, IdTable, chunk_document, current_build, iter_collection, link_files, open_memmap,
+    plan_update, publish_build, read_meta, store_missing_chunks, write_ids,
+)
+
+logger = logging.getLogger(__name__)
+
+POINTER_FILE = 'LEXICAL_INDEX'
+# Version of the file layout; builds in another one are rebuilt, not read
+FORMAT = 3
+INCLUDE = ['documents', 'metadatas']
+# Files of the base, shared with the next build by hard links
+BASE_FILES = ('vocabulary.json', 'postings.bin', 'frequencies.bin', 'lengths.bin')
+TOKEN_PATTERN = re.compile(r"\w+")
+# Words too common in therapy conversations and books to tell chunks apart
+STOPWORDS = frozenset("""
+a about after again all also am an and any are as at be because been before being but by can could did do does
+doing don down during each feel feeling few for from further get had has have having he her here hers him his how
+i if in into is it its just like me more most my no nor not now of off on once only or other our out over own really
+same she should so some such than that the their them then there these they this those through to too under until
+up very was we were what when where which while who whom why will with would you your
+""".split())
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text):
+    """
+    Lowercased word tokens without stopwords.
+    """
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def build_lexical_index(
+    index_dir, collection, chunk_store, previous=None, max_changed_fraction=MAX_CHANGED_FRACTION
+):
+    """
+    Index every chunk of a Chroma collection into a new build under index_dir
+    and make it current, storing chunk text in chunk_store. Returns the number
+    of chunks.
+
+    previous is the directory of an earlier build of the same collection. As
+    with build_mmap_index, its postings become the base of the new build,
+    hard-linked; only the chunks added since are read from Chroma and indexed
+    into delta postings, and base rows of removed chunks are marked deleted. A
+    full build is made when previous is None or in another format, or when
+    the changes exceed max_changed_fraction of its rows.
+    """
+    name = f"bm25-{uuid.uuid4().hex}"
+    build_dir = os.path.join(index_dir, name)
+    os.makedirs(build_dir)
+
+    try:
+        meta = None
+        if previous is not None:
+            meta = update_build(build_dir, previous, collection, chunk_store, max_changed_fraction)
+        if meta is None:
+            count, total_length, ids = write_segment(
+                build_dir, '', iter_collection(collection, INCLUDE), chunk_store
+            )
+            write_ids(build_dir, ids)
+            meta = {
+                'format': FORMAT, 'count': count, 'base': count, 'delta': 0, 'deleted': 0,
+                'base_length': total_length, 'average_length': total_length / max(count, 1),
+            }
+        with open(os.path.join(build_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    publish_build(index_dir, name, POINTER_FILE)
+    logger.info(
+        f"Built BM25 index {build_dir} ({meta['count']} chunks, "
+        f"{meta['delta']} added and {meta['deleted']} deleted since the base)."
+    )
+    return meta['count']
+
+
+def update_build(build_dir, previous_dir, collection, chunk_store, max_changed_fraction):
+    """
+    Fill build_dir with the base of the build in previous_dir plus delta
+    postings. Returns the meta, or None, having written nothing, when a full
+    build is due.
+    """
+    previous = read_meta(previous_dir)
+    if previous is None or previous['format'] != FORMAT:
+        return None
+    plan = plan_update(previous_dir, previous['base'], collection, max_changed_fraction)
+    if plan is None:
+        return None
+    base_ids, deleted, delta_ids = plan
+
+    link_files(previous_dir, build_dir, BASE_FILES)
+    delta, delta_length, delta_ids = write_segment(
+        build_dir, DELTA, iter_collection(collection, INCLUDE, delta_ids), chunk_store
+    )
+    np.asarray(deleted, dtype=np.int64).tofile(os.path.join(build_dir, 'deleted.bin'))
+    write_ids(build_dir, base_ids + delta_ids, deleted)
+
+    lengths = open_memmap(os.path.join(build_dir, 'lengths.bin'), np.int32)
+    total_length = previous['base_length'] - int(lengths[deleted].sum()) + delta_length
+    count = len(base_ids) - len(deleted) + delta
+    return {
+        **previous, 'count': count, 'delta': delta, 'deleted': len(deleted),
+        'average_length': total_length / max(count, 1),
+    }
+
+
+def write_segment(build_dir, segment, pages, chunk_store):
+    """
+    Index the chunks of collection.get() pages into the files of a segment
+    ('' for the base, DELTA for the delta), rows numbered from 0 in page
+    order. Returns (count, total length in terms, chunk ids).
+    """
+    postings = {}  # term -> (array of rows, array of frequencies)
+    lengths = array('i')
+    ids = []
+    for page in pages:
+        for text in page['documents']:
+            terms = Counter(tokenize(text or ''))
+            for term, frequency in terms.items():
+                entry = postings.get(term)
+                if entry is None:
+                    entry = postings[term] = (array('i'), array('H'))
+                entry[0].append(len(lengths))
+                entry[1].append(min(frequency, 65535))
+            lengths.append(sum(terms.values()))
+        store_missing_chunks(chunk_store, page)
+        ids.extend(page['ids'])
+
+    vocabulary = {}
+    position = 0
+    with open(os.path.join(build_dir, f'{segment}postings.bin'), 'wb') as postings_file, \
+            open(os.path.join(build_dir, f'{segment}frequencies.bin'), 'wb') as frequencies_file:
+        for term, (rows, frequencies) in postings.items():
+            vocabulary[term] = [position, len(rows)]
+            rows.tofile(postings_file)
+            frequencies.tofile(frequencies_file)
+            position += len(rows)
+
+    with open(os.path.join(build_dir, f'{segment}vocabulary.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocabulary, f)
+    with open(os.path.join(build_dir, f'{segment}lengths.bin'), 'wb') as f:
+        lengths.tofile(f)
+    return len(lengths), sum(lengths), ids
+
+
+# The postings of one segment; its rows start at first_row
+Segment = namedtuple('Segment', ['vocabulary', 'postings', 'frequencies', 'lengths', 'first_row'])
+
+
+def open_segment(build_dir, segment, first_row):
+    with open(os.path.join(build_dir, f'{segment}vocabulary.json'), encoding='utf-8') as f:
+        vocabulary = json.load(f)
+    return Segment(
+        vocabulary,
+        open_memmap(os.path.join(build_dir, f'{segment}postings.bin'), np.int32),
+        open_memmap(os.path.join(build_dir, f'{segment}frequencies.bin'), np.uint16),
+        open_memmap(os.path.join(build_dir, f'{segment}lengths.bin'), np.int32),
+        first_row,
+    )
+
+
+class LexicalIndex:
+    """
+    Read side of a BM25 build; the text of the hits comes from chunk_store.
+    Rows are numbered across the base and then the delta. Document
+    frequencies still count deleted base rows until the next full build,
+    which shifts scores a little but not which chunks match.
+    """
+
+    def __init__(self, build_dir, chunk_store=None):
+        self.build_dir = build_dir
+        self.chunk_store = chunk_store
+        with open(os.path.join(build_dir, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.average_length = self.meta['average_length'] or 1
+        self.segments = [open_segment(build_dir, '', 0)]
+        if self.meta['delta']:
+            self.segments.append(open_segment(build_dir, DELTA, self.meta['base']))
+        self.deleted = np.empty(0, dtype=np.int64)
+        if self.meta['deleted']:
+            self.deleted = np.fromfile(os.path.join(build_dir, 'deleted.bin'), dtype=np.int64)
+        self.id_table = IdTable(build_dir)
+
+    @classmethod
+    def open(cls, index_dir, chunk_store=None):
+        """
+        Open the current build of index_dir, or return None if there is none
+        (or it is in an older format).
+        """
+        build_dir = current_build(index_dir, POINTER_FILE, FORMAT)
+        if build_dir is None:
+            return None
+        return cls(build_dir, chunk_store)
+
+    def top_k(self, query, k, deleted=()):
+        """
+        Return [(row, score)] of the k best BM25 matches, best first, leaving
+        out the chunks of the `deleted` document ids.
+        """
+        rows = []
+        weights = []
+        for term in set(tokenize(query)):
+            entries = [
+                (segment, segment.vocabulary[term]) for segment in self.segments if term in segment.vocabulary
+            ]
+            if not entries:
+                continue
+            document_frequency = sum(frequency for segment, (start, frequency) in entries)
+            idf = np.log(1 + max(self.count - document_frequency + 0.5, 0.5) / (document_frequency + 0.5))
+            for segment, (start, segment_frequency) in entries:
+                term_rows = segment.postings[start:start + segment_frequency]
+                frequencies = segment.frequencies[start:start + segment_frequency].astype(np.float32)
+                norm = K1 * (1 - B + B * segment.lengths[term_rows] / self.average_length)
+                rows.append(term_rows.astype(np.int64) + segment.first_row)
+                weights.append(idf * frequencies * (K1 + 1) / (frequencies + norm))
+        if not rows:
+            return []
+
+        # Sum the weights of rows matched by several terms
+        rows, inverse = np.unique(np.concatenate(rows), return_inverse=True)
+        weights = np.bincount(inverse, weights=np.concatenate(weights))
+        excluded = self.deleted
+        if deleted:
+            excluded = np.concatenate([excluded, self.id_table.document_rows(deleted)])
+        if len(excluded):
+            kept = ~np.isin(rows, excluded)
+            rows, weights = rows[kept], weights[kept]
+        k = min(k, len(rows))
+        if not k:
+            return []
+        best = np.argpartition(-weights, k - 1)[:k]
+        best = best[np.argsort(-weights[best])]
+        return [(int(rows[i]), float(weights[i])) for i in best]
+
+    def search(self, query, k=4, deleted=()):
+        """
+        Return the k best matching chunks as LangChain documents, leaving out
+        those missing from the chunk store.
+        """
+        documents = []
+        for row, score in self.top_k(query, k, deleted):
+            chunk_id = self.id_table.id(row)
+            chunk = self.chunk_store.get(chunk_id)
+            if chunk is None:
+                logger.warning(f"Chunk {chunk_id} of {self.build_dir} is not in the chunk store.")
+                continue
+            documents.append(chunk_document(chunk_id, chunk))
+        return documents
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=60):
+    """
+    Fuse ranked lists of documents: each document scores the sum of
+    1 / (rrf_k + rank) over the lists it appears in. Documents are matched by
+    chunk id, so chunks with the same text in different books stay apart;
+    documents without an id are matched by their text.
+    """
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = document.id or document.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            documents.setdefault(key, document)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [documents[key] for key in best]
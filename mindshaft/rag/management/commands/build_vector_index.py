@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.chunk_store import get_chunk_store
+from rag.generations import build_lock, live_generation
+from rag.lexical_index import build_lexical_index
+from rag.retriever import mark_index_updated
+from rag.utils import CHROMA_DB_DIR, build_vector_index, open_vector_store
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the indexes derived from the Chroma collection of the live generation: the memory-mapped '
+        'vector index (RAG_VECTOR_INDEX=mmap) and the BM25 index (RAG_HYBRID_SEARCH). New builds replace '
+        'the old ones atomically.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dtype', choices=['float16', 'int8'], help='Overrides RAG_MMAP_DTYPE')
+        parser.add_argument('--lists', type=int, help='IVF clusters; overrides RAG_IVF_LISTS')
+        parser.add_argument('--iterations', type=int, default=20, help='k-means iterations')
+        parser.add_argument('--exact', action='store_true', help='Do not cluster; every query scans all rows')
+
+    def handle(self, *args, **options):
+        with build_lock(CHROMA_DB_DIR):
+            self.build(options)
+
+    def build(self, options):
+        directory = live_generation(CHROMA_DB_DIR)
+        if directory is None:
+            raise CommandError("There is no vector index yet. Run an ingestion first.")
+        chunk_store = get_chunk_store()
+        if chunk_store is None:
+            raise CommandError("The derived indexes read chunk text from the chunk store; set RAG_CHUNK_STORE_DIR.")
+        vector_store = open_vector_store(directory)
+
+        if settings.RAG_VECTOR_INDEX == 'mmap':
+            overrides = {'iterations': options['iterations']}
+            if options['dtype']:
+                overrides['dtype'] = options['dtype']
+            if options['lists'] is not None:
+                overrides['nlist'] = options['lists']
+                overrides['min_rows'] = 0
+            if options['exact']:
+                overrides['min_rows'] = float('inf')
+            meta = build_vector_index(vector_store, directory, chunk_store, **overrides)
+            self.stdout.write(self.style.SUCCESS(
+                f"Built memory-mapped index with {meta['count']} vectors ({meta['dtype']}, {meta['nlist']} IVF lists)."
+            ))
+
+        if settings.RAG_HYBRID_SEARCH:
+            count = build_lexical_index(directory, vector_store._collection, chunk_store)
+            self.stdout.write(self.style.SUCCESS(f"Built BM25 index with {count} chunks."))
+
+        mark_index_updated(directory)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.generations import build_lock, read_current, read_history, rollback_generation
+from rag.utils import CHROMA_DB_DIR
+
+
+class Command(BaseCommand):
+    help = (
+        'Make the previous generation of the vector index live again. Workers switch to it on their next '
+        'query; the next ingestion builds on top of it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list', action='store_true', help='Show the generations on disk and exit')
+
+    def handle(self, *args, **options):
+        with build_lock(CHROMA_DB_DIR):
+            current = read_current(CHROMA_DB_DIR)
+            if options['list']:
+                for name in read_history(CHROMA_DB_DIR):
+                    self.stdout.write(f"{name}{' (live)' if name == current else ''}")
+                return
+            try:
+                previous = rollback_generation(CHROMA_DB_DIR)
+            except ValueError as e:
+                raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f"Rolled back from {current} to {previous}."))
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rag.jobs import fail_abandoned_jobs, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued document ingestion jobs. Run a single worker; ingestion writes to one local index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the jobs that are queued now and exit')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        abandoned = fail_abandoned_jobs()
+        if abandoned:
+            self.stderr.write(self.style.WARNING(f"Marked {abandoned} abandoned job(s) as failed."))
+
+        if options['once']:
+            count = run_pending_jobs()
+            self.stdout.write(self.style.SUCCESS(f"Ran {count} ingestion job(s)."))
+            return
+
+        self.stdout.write("Waiting for ingestion jobs...")
+        try:
+            while True:
+                if not run_pending_jobs():
+                    time.sleep(options['poll_interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping ingestion worker.")
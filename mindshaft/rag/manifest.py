@@ -0,0 +1,168 @@
+"""
+Ingestion manifest: what is in the vector index, per document.
+
+The manifest lives next to the index it describes (manifest.json in the index
+directory), so the two are always removed, copied or replaced together. For
+each document it records the file's content hash, the ids of its chunks in the
+collection and when it was ingested; ingestion compares it with the Document
+table to work out which documents are new, changed or removed.
+"""
+import hashlib
+import json
+import os
+
+from django.utils.timezone import now
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_sha256(path, block_size=1024 * 1024):
+    """
+    Hash a file's content without reading it into memory at once.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestionManifest:
+    """
+    Mapping of document id -> {file_hash, size, mtime, chunk_ids, duplicate_of, ingested_at}.
+    """
+
+    def __init__(self, index_dir, documents=None, chunking=None, embedding_model=None):
+        self.index_dir = index_dir
+        self.documents = documents or {}
+        self.chunking = chunking  # Chunker options the chunks were made with
+        self.embedding_model = embedding_model  # Model the vectors were made with
+
+    @property
+    def path(self):
+        return os.path.join(self.index_dir, MANIFEST_FILE)
+
+    @classmethod
+    def exists(cls, index_dir):
+        return os.path.exists(os.path.join(index_dir, MANIFEST_FILE))
+
+    @classmethod
+    def load(cls, index_dir):
+        try:
+            with open(os.path.join(index_dir, MANIFEST_FILE), encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        return cls(index_dir, data.get('documents', {}), data.get('chunking'), data.get('embedding_model'))
+
+    def save(self):
+        """
+        Write the manifest atomically so a crash never leaves a half-written file.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'embedding_model': self.embedding_model,
+                'chunking': self.chunking,
+                'documents': self.documents,
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, doc_id):
+        return self.documents.get(str(doc_id))
+
+    def record(self, doc_id, file_hash, size, mtime, chunk_ids, duplicate_of=()):
+        self.documents[str(doc_id)] = {
+            'file_hash': file_hash,
+            'size': size,
+            'mtime': mtime,
+            'chunk_ids': chunk_ids,
+            # Documents holding the chunks this one's near-duplicates were dropped for
+            'duplicate_of': sorted(duplicate_of),
+            'ingested_at': now().isoformat(),
+        }
+
+    def remove(self, doc_id):
+        return self.documents.pop(str(doc_id), None)
+
+    def document_ids(self):
+        return set(self.documents)
+
+    def dependents(self, doc_ids):
+        """
+        Ids of the documents that dropped near-duplicates of chunks of doc_ids,
+        directly or through other documents, excluding doc_ids themselves.
+        """
+        doc_ids = {str(doc_id) for doc_id in doc_ids}
+        found = set()
+        while True:
+            new = {
+                doc_id for doc_id, entry in self.documents.items()
+                if doc_id not in doc_ids and doc_id not in found
+                and (doc_ids | found).intersection(entry.get('duplicate_of', ()))
+            }
+            if not new:
+                return found
+            found |= new
+
+    def chunk_count(self):
+        return sum(len(entry['chunk_ids']) for entry in self.documents.values())
+
+
+class DocumentChange:
+    """
+    A document that has to be (re)ingested, with what is known about its file.
+    """
+
+    def __init__(self, document, file_hash, size, mtime, previous=None):
+        self.document = document
+        self.file_hash = file_hash
+        self.size = size
+        self.mtime = mtime
+        self.previous = previous  # Manifest entry of the version being replaced
+
+
+def plan_changes(documents, manifest, force=False):
+    """
+    Compare the Document rows with the manifest.
+
+    Returns (changes, removed_ids, unchanged_count). Files whose size and mtime
+    match the manifest are not hashed again. With force every document counts
+    as changed, and documents that dropped near-duplicates of a changed or
+    removed one are re-ingested with it.
+    """
+    changes = []
+    unchanged = {}  # doc id -> (document, entry)
+    seen = set()
+    for doc in documents:
+        doc_id = str(doc.id)
+        seen.add(doc_id)
+        entry = manifest.get(doc_id)
+        try:
+            path = doc.file.path
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            # Missing file: keep whatever is indexed and try again next run
+            continue
+
+        if not force and entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            unchanged[doc_id] = (doc, entry)
+            continue
+
+        file_hash = file_sha256(path)
+        if not force and entry and entry['file_hash'] == file_hash:
+            # Touched but identical; just remember the new stat
+            entry['size'] = stat.st_size
+            entry['mtime'] = stat.st_mtime
+            unchanged[doc_id] = (doc, entry)
+            continue
+
+        changes.append(DocumentChange(doc, file_hash, stat.st_size, stat.st_mtime, previous=entry))
+
+    removed = manifest.document_ids() - seen
+    for doc_id in manifest.dependents({str(change.document.id) for change in changes} | removed):
+        if doc_id in unchanged:
+            doc, entry = unchanged.pop(doc_id)
+            changes.append(DocumentChange(doc, entry['file_hash'], entry['size'], entry['mtime'], previous=entry))
+    return changes, removed, len(unchanged)
@@ -0,0 +1,713 @@
+"""
+Read-only, memory-mapped vector index built from the Chroma collection.
+
+Chroma stays the index ingestion writes to. After ingestion its vectors are
+exported into a directory of flat files:
+
+    meta.json      format, dtype, dimension, row counts and embedding model
+    vectors.bin    normalized vectors, one row per chunk, float16 or int8
+    scales.bin     float32 per-row scale factors (int8 only)
+    ids.bin        chunk id of every row, UTF-8, back to back
+    id_offsets.bin int64 start offset of every id, plus the end
+    id_order.bin   int64 rows sorted by chunk id, to find a row by id
+    centroids.bin  float32 cluster centroids (IVF builds only)
+    lists.bin      int64 first row of every cluster, plus the end (IVF builds only)
+    delta_*.bin    vectors, scales and lists of the rows added since the base
+    deleted.bin    int64 base rows whose chunks are gone, sorted
+
+Every file is opened with np.memmap, so all workers of a host share the same
+pages through the OS page cache and a query is one vectorized dot product over
+the matrix. Chunk text is not copied into the build: the text and page of the
+k best rows are read from the chunk store (rag.chunk_store) by id, and the
+build adds any chunk of the collection the store does not have yet.
+
+Large builds are clustered IVF-style: spherical k-means centroids are trained
+with NumPy on a sample of the vectors, rows are stored grouped by their nearest
+centroid, and a query only scores the rows of the `nprobe` clusters closest to
+it. nprobe trades recall for latency; probing every cluster is an exact scan.
+
+Ingestion updates the build incrementally. The base files (vectors, scales,
+centroids, lists) of the previous generation's build are hard-linked into the
+new build, the chunks added since are written as a delta grouped by the same
+centroids, and base rows of removed chunks are listed in deleted.bin, so an
+upload costs in proportion to what changed rather than to the corpus. Once the
+delta and deleted rows reach MAX_CHANGED_FRACTION of the base, the next build
+is a full one that re-trains the centroids. Only the id table is rewritten
+every time; it holds a few dozen bytes per chunk.
+
+Each build goes into a new directory and a pointer file is replaced atomically,
+so readers never see a half-written index; mappings of the previous build stay
+valid until the workers reopen.
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import uuid
+
+import numpy as np
+from langchain.schema import Document as LangChainDocument
+
+logger = logging.getLogger(__name__)
+
+POINTER_FILE = 'MMAP_INDEX'
+# Version of the file layout; builds in another one are rebuilt, not read
+FORMAT = 3
+DTYPES = ('float16', 'int8')
+# Rows scored per step, to bound the float32 copy of the matrix
+SCORE_BLOCK_ROWS = 8192
+# Rows read from Chroma per step while building
+EXPORT_PAGE_SIZE = 2000
+INCLUDE = ['embeddings', 'documents', 'metadatas']
+# Prefix of the files of the rows added since the base
+DELTA = 'delta_'
+# Files of the base, shared with the next build by hard links
+BASE_FILES = ('vectors.bin', 'scales.bin', 'centroids.bin', 'lists.bin')
+# Share of the base that may be added or deleted before a build starts over
+MAX_CHANGED_FRACTION = 0.25
+
+
+def read_pointer(index_dir, pointer_file=POINTER_FILE):
+    """
+    Return the directory of the current build, or None if there is none.
+    """
+    try:
+        with open(os.path.join(index_dir, pointer_file), encoding='utf-8') as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    path = os.path.join(index_dir, name)
+    return path if os.path.isdir(path) else None
+
+
+def current_build(index_dir, pointer_file=POINTER_FILE, build_format=FORMAT):
+    """
+    Return the directory of the current build if it has the given format, or None.
+    """
+    build_dir = read_pointer(index_dir, pointer_file)
+    if build_dir is None:
+        return None
+    try:
+        with open(os.path.join(build_dir, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return build_dir if meta.get('format') == build_format else None
+
+
+def open_memmap(path, dtype):
+    # np.memmap cannot map empty files
+    if not os.path.getsize(path):
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def write_ids(build_dir, ids, deleted=()):
+    """
+    Write the chunk ids of a build in row order, and its rows sorted by id,
+    leaving out the deleted rows.
+    """
+    encoded = [chunk_id.encode('utf-8') for chunk_id in ids]
+    with open(os.path.join(build_dir, 'ids.bin'), 'wb') as f:
+        f.write(b''.join(encoded))
+    lengths = np.asarray([len(chunk_id) for chunk_id in encoded], dtype=np.int64)
+    np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64).tofile(os.path.join(build_dir, 'id_offsets.bin'))
+    deleted = set(deleted)
+    order = sorted((row for row in range(len(encoded)) if row not in deleted), key=encoded.__getitem__)
+    np.asarray(order, dtype=np.int64).tofile(os.path.join(build_dir, 'id_order.bin'))
+
+
+class IdTable:
+    """
+    Chunk ids of a build by row, and rows by id through a binary search of the
+    sorted order. All three files stay memory-mapped, so opening a table reads
+    nothing and a lookup touches O(log rows) ids. Deleted rows are left out of
+    the sorted order, so they are never found by id.
+    """
+
+    def __init__(self, build_dir):
+        self.ids = open_memmap(os.path.join(build_dir, 'ids.bin'), np.uint8)
+        self.offsets = open_memmap(os.path.join(build_dir, 'id_offsets.bin'), np.int64)
+        self.order = open_memmap(os.path.join(build_dir, 'id_order.bin'), np.int64)
+
+    def __len__(self):
+        return len(self.order)
+
+    def _encoded(self, row):
+        return self.ids[self.offsets[row]:self.offsets[row + 1]].tobytes()
+
+    def id(self, row):
+        return self._encoded(row).decode('utf-8')
+
+    def _position(self, key):
+        """
+        Position in the sorted order of the first id not below key (bytes).
+        """
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._encoded(self.order[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def row(self, chunk_id):
+        """
+        Row of chunk_id, or None if it is not in the build.
+        """
+        key = chunk_id.encode('utf-8')
+        position = self._position(key)
+        if position < len(self.order) and self._encoded(self.order[position]) == key:
+            return int(self.order[position])
+        return None
+
+    def document_rows(self, doc_ids):
+        """
+        Rows of the chunks of the given documents, found by the "<document id>:"
+        prefix of their chunk ids.
+        """
+        rows = []
+        for doc_id in doc_ids:
+            prefix = f"{doc_id}:".encode('utf-8')
+            # Every id with the prefix sorts between it and the prefix followed by 0xff
+            rows.append(self.order[self._position(prefix):self._position(prefix + b'\xff')])
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(rows).astype(np.int64)
+
+
+def chunk_document(chunk_id, chunk):
+    """
+    LangChain document of a chunk id and its (text, page) from the chunk store.
+    """
+    text, page = chunk
+    return LangChainDocument(page_content=text, metadata={'id': chunk_id.split(':', 1)[0], 'page': page}, id=chunk_id)
+
+
+def store_missing_chunks(chunk_store, page):
+    """
+    Add the chunks of a page of collection.get() results the chunk store does
+    not have yet, such as those indexed before the store was enabled.
+    """
+    missing = [i for i, chunk_id in enumerate(page['ids']) if chunk_id not in chunk_store]
+    if missing:
+        chunk_store.append(
+            [page['ids'][i] for i in missing],
+            [(page['documents'][i], (page['metadatas'][i] or {}).get('page')) for i in missing],
+        )
+
+
+def iter_collection(collection, include, ids=None):
+    """
+    Yield collection.get() pages of up to EXPORT_PAGE_SIZE chunks: all of the
+    collection in its order, or those with the given ids.
+    """
+    if ids is None:
+        offset = 0
+        while True:
+            page = collection.get(include=include, limit=EXPORT_PAGE_SIZE, offset=offset)
+            if not page['ids']:
+                return
+            yield page
+            offset += len(page['ids'])
+    else:
+        for start in range(0, len(ids), EXPORT_PAGE_SIZE):
+            yield collection.get(ids=ids[start:start + EXPORT_PAGE_SIZE], include=include)
+
+
+def read_meta(build_dir):
+    try:
+        with open(os.path.join(build_dir, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def plan_update(previous_dir, base_rows, collection, max_changed_fraction):
+    """
+    Work out how a new build can reuse the base rows of the build in
+    previous_dir for the chunks now in the collection. Returns (chunk id of
+    every base row, base rows whose chunk is gone, ids of the chunks not in the
+    base), or None when the delta and the deleted rows together would exceed
+    max_changed_fraction of the base and a full build is due.
+
+    Chunk ids are content hashes, so a base row whose id is in the collection
+    still holds that chunk's vector and text.
+    """
+    table = IdTable(previous_dir)
+    base_ids = [table.id(row) for row in range(base_rows)]
+    current = [chunk_id for page in iter_collection(collection, []) for chunk_id in page['ids']]
+    present = set(current)
+    deleted = [row for row, chunk_id in enumerate(base_ids) if chunk_id not in present]
+    in_base = set(base_ids)
+    delta_ids = [chunk_id for chunk_id in current if chunk_id not in in_base]
+    if len(delta_ids) + len(deleted) > max_changed_fraction * base_rows:
+        return None
+    return base_ids, deleted, delta_ids
+
+
+def link_files(source_dir, build_dir, names):
+    """
+    Hard-link the files `names` of source_dir that exist into build_dir, or
+    copy them across filesystems. Build files are never written after
+    publishing, so builds can share them.
+    """
+    for name in names:
+        source = os.path.join(source_dir, name)
+        if not os.path.exists(source):
+            continue
+        try:
+            os.link(source, os.path.join(build_dir, name))
+        except OSError:
+            shutil.copyfile(source, os.path.join(build_dir, name))
+
+
+def build_mmap_index(
+    index_dir, collection, embedding_model, chunk_store, dtype='float16', nlist=0, min_rows=0, iterations=20,
+    previous=None, max_changed_fraction=MAX_CHANGED_FRACTION,
+):
+    """
+    Export every vector of a Chroma collection into a new build under
+    index_dir and make it current, storing chunk text in chunk_store. Builds
+    of at least min_rows rows are clustered into nlist lists (0 picks about
+    4 * sqrt(rows)). Returns the meta of the build.
+
+    previous is the directory of an earlier build of the same collection (say,
+    in the generation this one was copied from). Its rows become the base of
+    the new build: their files are hard-linked, only the chunks added since
+    are read from Chroma and written as a delta, grouped by the base's
+    centroids, and base rows whose chunks are gone are marked deleted. A full
+    build is made instead when previous is None or in another format, dtype or
+    embedding model, when it is not clustered but now should be, or when the
+    changes exceed max_changed_fraction of its rows.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {', '.join(DTYPES)}")
+    name = f"mmap-{uuid.uuid4().hex}"
+    build_dir = os.path.join(index_dir, name)
+    os.makedirs(build_dir)
+
+    try:
+        meta = None
+        if previous is not None:
+            meta = update_build(
+                build_dir, previous, collection, embedding_model, chunk_store, dtype, min_rows, max_changed_fraction
+            )
+        if meta is None:
+            meta = full_build(build_dir, collection, embedding_model, chunk_store, dtype, nlist, min_rows, iterations)
+        with open(os.path.join(build_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+    except Exception:
+        shutil.rmtree(build_dir, ignore_errors=True)
+        raise
+
+    publish_build(index_dir, name, POINTER_FILE)
+    logger.info(
+        f"Built memory-mapped index {build_dir} ({meta['count']} rows, {dtype}, {meta['nlist']} lists, "
+        f"{meta['delta']} added and {meta['deleted']} deleted since the base)."
+    )
+    return meta
+
+
+def full_build(build_dir, collection, embedding_model, chunk_store, dtype, nlist, min_rows, iterations):
+    count, dim, ids = export_rows(iter_collection(collection, INCLUDE), build_dir, '', dtype, chunk_store)
+    meta = {
+        'format': FORMAT, 'dtype': dtype, 'dim': dim, 'count': count, 'base': count, 'delta': 0, 'deleted': 0,
+        'embedding_model': embedding_model, 'nlist': 0,
+    }
+    if count and count >= min_rows:
+        nlist = nlist or int(4 * count ** 0.5)
+        meta['nlist'], order = cluster_build(build_dir, meta, min(nlist, count), iterations)
+        ids = [ids[row] for row in order]
+    write_ids(build_dir, ids)
+    return meta
+
+
+def update_build(
+    build_dir, previous_dir, collection, embedding_model, chunk_store, dtype, min_rows, max_changed_fraction,
+):
+    """
+    Fill build_dir with the base of the build in previous_dir plus a delta.
+    Returns the meta, or None, having written nothing, when a full build is due.
+    """
+    previous = read_meta(previous_dir)
+    if previous is None or (previous['format'], previous['dtype'], previous['embedding_model']) != (
+        FORMAT, dtype, embedding_model
+    ):
+        return None
+    plan = plan_update(previous_dir, previous['base'], collection, max_changed_fraction)
+    if plan is None:
+        return None
+    base_ids, deleted, delta_ids = plan
+    count = len(base_ids) - len(deleted) + len(delta_ids)
+    if not previous['nlist'] and count and count >= min_rows:
+        return None
+
+    link_files(previous_dir, build_dir, BASE_FILES)
+    delta, dim, delta_ids = export_rows(
+        iter_collection(collection, INCLUDE, delta_ids), build_dir, DELTA, dtype, chunk_store
+    )
+    if delta and dim != previous['dim']:
+        raise ValueError(f"New vectors have {dim} dimensions, the base {previous['dim']}.")
+    meta = {
+        **previous, 'count': count, 'delta': delta, 'deleted': len(deleted),
+    }
+    if meta['nlist'] and delta:
+        centroids = np.fromfile(os.path.join(build_dir, 'centroids.bin'), dtype=np.float32).reshape(
+            meta['nlist'], meta['dim']
+        )
+        vectors, scales = open_rows(build_dir, meta, DELTA)
+        labels = assign_lists(vectors, scales, centroids)
+        order = np.argsort(labels, kind='stable')
+        lists = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=meta['nlist']))]).astype(np.int64)
+        reorder_rows(build_dir, DELTA, vectors, scales, order)
+        lists.tofile(os.path.join(build_dir, f'{DELTA}lists.bin'))
+        delta_ids = [delta_ids[row] for row in order]
+    np.asarray(deleted, dtype=np.int64).tofile(os.path.join(build_dir, 'deleted.bin'))
+    write_ids(build_dir, base_ids + delta_ids, deleted)
+    return meta
+
+
+def publish_build(index_dir, name, pointer_file):
+    """
+    Point pointer_file at the build directory `name` and delete the older
+    builds with the same prefix. Open mappings of those stay valid after unlinking.
+    """
+    tmp_path = os.path.join(index_dir, f"{pointer_file}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(name)
+    os.replace(tmp_path, os.path.join(index_dir, pointer_file))
+
+    prefix = name.split('-', 1)[0] + '-'
+    for entry in os.listdir(index_dir):
+        if entry.startswith(prefix) and entry != name:
+            shutil.rmtree(os.path.join(index_dir, entry), ignore_errors=True)
+
+
+def export_rows(pages, build_dir, segment, dtype, chunk_store):
+    """
+    Write the vectors of collection.get() pages to the files of a segment
+    ('' for the base, DELTA for the delta) in page order. Returns (count, dim,
+    chunk ids).
+    """
+    count = 0
+    dim = 0
+    ids = []
+    with open(os.path.join(build_dir, f'{segment}vectors.bin'), 'wb') as vectors_file, \
+            open(os.path.join(build_dir, f'{segment}scales.bin'), 'wb') as scales_file:
+        for page in pages:
+            if not page['ids']:
+                continue
+            vectors = np.asarray(page['embeddings'], dtype=np.float32)
+            dim = vectors.shape[1]
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            if dtype == 'int8':
+                scales = np.abs(vectors).max(axis=1) / 127
+                quantized = np.round(vectors / np.clip(scales[:, None], 1e-12, None))
+                vectors_file.write(quantized.astype(np.int8).tobytes())
+                scales_file.write(scales.astype(np.float32).tobytes())
+            else:
+                vectors_file.write(vectors.astype(np.float16).tobytes())
+
+            store_missing_chunks(chunk_store, page)
+            ids.extend(page['ids'])
+            count += len(page['ids'])
+    return count, dim, ids
+
+
+def open_rows(build_dir, meta, segment=''):
+    """
+    Memory-map the vectors (and int8 scales) of a segment of a build, or
+    return (None, None) if it has no rows.
+    """
+    rows = meta['delta'] if segment == DELTA else meta['base']
+    if not rows:
+        return None, None
+    vectors = np.memmap(
+        os.path.join(build_dir, f'{segment}vectors.bin'), dtype=meta['dtype'], mode='r', shape=(rows, meta['dim'])
+    )
+    scales = None
+    if meta['dtype'] == 'int8':
+        scales = np.memmap(os.path.join(build_dir, f'{segment}scales.bin'), dtype=np.float32, mode='r')
+    return vectors, scales
+
+
+def rows_float32(vectors, scales, rows):
+    """
+    Rows (a slice or index array) as float32 unit vectors.
+    """
+    block = vectors[rows].astype(np.float32)
+    if scales is not None:
+        block *= scales[rows][:, None]
+    return block
+
+
+def seed_centroids(sample, nlist, rng):
+    """
+    k-means++ seeding by cosine distance, over a subset of the sample to keep
+    it cheap for large nlist.
+    """
+    seeds = sample[rng.choice(len(sample), size=min(len(sample), nlist * 8), replace=False)]
+    chosen = [int(rng.integers(len(seeds)))]
+    closest = seeds @ seeds[chosen[0]]
+    for _ in range(1, nlist):
+        weights = np.clip(1 - closest, 0, None) ** 2
+        total = weights.sum()
+        index = int(rng.choice(len(seeds), p=weights / total)) if total > 0 else int(rng.integers(len(seeds)))
+        chosen.append(index)
+        closest = np.maximum(closest, seeds @ seeds[index])
+    return seeds[chosen].copy()
+
+
+def train_centroids(vectors, scales, nlist, iterations, seed=0):
+    """
+    Spherical k-means on a sample of the rows: centroids are unit vectors and
+    rows join the centroid with the highest dot product.
+    """
+    rng = np.random.default_rng(seed)
+    count = len(vectors)
+    sample_rows = np.sort(rng.choice(count, size=min(count, nlist * 64), replace=False))
+    sample = rows_float32(vectors, scales, sample_rows)
+    centroids = seed_centroids(sample, nlist, rng)
+
+    for _ in range(iterations):
+        labels = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        sizes = np.bincount(labels, minlength=nlist)
+        empty = sizes == 0
+        # Re-seed empty clusters with random sample rows
+        sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+        centroids = sums / np.clip(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12, None)
+    return centroids.astype(np.float32)
+
+
+def assign_lists(vectors, scales, centroids):
+    """
+    The cluster of every row: the centroid with the highest dot product.
+    """
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCORE_BLOCK_ROWS):
+        block = rows_float32(vectors, scales, slice(start, start + SCORE_BLOCK_ROWS))
+        labels[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def reorder_rows(build_dir, segment, vectors, scales, order):
+    """
+    Rewrite the vectors (and scales) of a segment with row order[i] as row i.
+    """
+    with open(os.path.join(build_dir, f'{segment}vectors.tmp'), 'wb') as vectors_file, \
+            open(os.path.join(build_dir, f'{segment}scales.tmp'), 'wb') as scales_file:
+        for start in range(0, len(order), SCORE_BLOCK_ROWS):
+            rows = order[start:start + SCORE_BLOCK_ROWS]
+            vectors_file.write(np.ascontiguousarray(vectors[rows]).tobytes())
+            if scales is not None:
+                scales_file.write(np.ascontiguousarray(scales[rows]).tobytes())
+    del vectors, scales
+
+    for name in ('vectors', 'scales'):
+        os.replace(os.path.join(build_dir, f'{segment}{name}.tmp'), os.path.join(build_dir, f'{segment}{name}.bin'))
+
+
+def cluster_build(build_dir, meta, nlist, iterations):
+    """
+    Train centroids, then rewrite the build's rows grouped by cluster and write
+    the centroids and list boundaries. Returns (nlist, the old row of every new row).
+    """
+    vectors, scales = open_rows(build_dir, meta)
+    centroids = train_centroids(vectors, scales, nlist, iterations)
+    labels = assign_lists(vectors, scales, centroids)
+    order = np.argsort(labels, kind='stable')
+    lists = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))]).astype(np.int64)
+    reorder_rows(build_dir, '', vectors, scales, order)
+    del vectors, scales
+
+    centroids.tofile(os.path.join(build_dir, 'centroids.bin'))
+    lists.tofile(os.path.join(build_dir, 'lists.bin'))
+    return nlist, order
+
+
+class MmapIndex:
+    """
+    Cosine search over a memory-mapped build, exact or over the nprobe nearest
+    clusters of an IVF build. Offers the subset of the LangChain vector store
+    interface the retriever uses; the text of the hits comes from chunk_store.
+
+    Rows are numbered across the base and then the delta; deleted base rows
+    are never returned.
+    """
+
+    def __init__(self, build_dir, embedding_function, chunk_store=None, nprobe=8):
+        self.build_dir = build_dir
+        self.embedding_function = embedding_function
+        self.chunk_store = chunk_store
+        self.nprobe = nprobe
+        with open(os.path.join(build_dir, 'meta.json'), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.count = self.meta['count']
+        self.base = self.meta['base']
+        self.delta = self.meta['delta']
+        self.dim = self.meta['dim']
+        self.nlist = self.meta.get('nlist', 0)
+        self.embedding_model = self.meta['embedding_model']
+        self.vectors, self.scales = open_rows(build_dir, self.meta)
+        self.delta_vectors, self.delta_scales = open_rows(build_dir, self.meta, DELTA)
+        self.centroids = None
+        self.lists = None
+        self.delta_lists = None
+        if self.nlist:
+            self.centroids = np.fromfile(os.path.join(build_dir, 'centroids.bin'), dtype=np.float32).reshape(
+                self.nlist, self.dim
+            )
+            self.lists = np.fromfile(os.path.join(build_dir, 'lists.bin'), dtype=np.int64)
+            if self.delta:
+                self.delta_lists = np.fromfile(os.path.join(build_dir, f'{DELTA}lists.bin'), dtype=np.int64)
+        self.deleted = np.empty(0, dtype=np.int64)
+        if self.meta['deleted']:
+            self.deleted = np.fromfile(os.path.join(build_dir, 'deleted.bin'), dtype=np.int64)
+        self.id_table = IdTable(build_dir)
+
+    @classmethod
+    def open(cls, index_dir, embedding_function, chunk_store=None, nprobe=8):
+        """
+        Open the current build of index_dir, or return None if there is none
+        (or it is in an older format).
+        """
+        build_dir = current_build(index_dir)
+        if build_dir is None:
+            return None
+        return cls(build_dir, embedding_function, chunk_store=chunk_store, nprobe=nprobe)
+
+    def candidate_ranges(self, query):
+        """
+        Row ranges to score: the lists of the nprobe nearest clusters in the
+        base and the delta, or everything.
+        """
+        if not self.nlist or self.nprobe >= self.nlist:
+            ranges = [(0, self.base), (self.base, self.base + self.delta)]
+        else:
+            closeness = self.centroids @ query
+            probed = sorted(np.argpartition(-closeness, self.nprobe - 1)[:self.nprobe])
+            ranges = [(int(self.lists[i]), int(self.lists[i + 1])) for i in probed]
+            if self.delta_lists is not None:
+                ranges += [
+                    (self.base + int(self.delta_lists[i]), self.base + int(self.delta_lists[i + 1])) for i in probed
+                ]
+        return [(start, end) for start, end in ranges if end > start]
+
+    def segment(self, row):
+        """
+        (vectors, scales, first row) of the segment holding row.
+        """
+        if row < self.base:
+            return self.vectors, self.scales, 0
+        return self.delta_vectors, self.delta_scales, self.base
+
+    def row_vectors(self, rows):
+        """
+        Rows (an index array) as float32 unit vectors.
+        """
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        in_base = rows < self.base
+        if in_base.any():
+            vectors[in_base] = rows_float32(self.vectors, self.scales, rows[in_base])
+        if not in_base.all():
+            vectors[~in_base] = rows_float32(self.delta_vectors, self.delta_scales, rows[~in_base] - self.base)
+        return vectors
+
+    def scores(self, query_vector):
+        """
+        Return (rows, cosine similarities) for the candidate rows of the query.
+        """
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        rows = []
+        scores = []
+        for range_start, range_end in self.candidate_ranges(query):
+            vectors, scales, first = self.segment(range_start)
+            for start in range(range_start, range_end, SCORE_BLOCK_ROWS):
+                end = min(start + SCORE_BLOCK_ROWS, range_end)
+                block = vectors[start - first:end - first].astype(np.float32) @ query
+                if scales is not None:
+                    block *= scales[start - first:end - first]
+                rows.append(np.arange(start, end))
+                scores.append(block)
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        if len(self.deleted):
+            kept = ~np.isin(rows, self.deleted)
+            rows, scores = rows[kept], scores[kept]
+        return rows, scores
+
+    def vectors_by_ids(self, chunk_ids):
+        """
+        Return {chunk id: unit vector} of the rows with the given ids.
+        """
+        found = {}
+        for chunk_id in chunk_ids:
+            row = self.id_table.row(chunk_id)
+            if row is not None:
+                found[chunk_id] = row
+        if not found:
+            return {}
+        return dict(zip(found, self.row_vectors(np.asarray(list(found.values()), dtype=np.int64))))
+
+    def top_k(self, query_vector, k, deleted=()):
+        """
+        Return [(row, score)] of the k most similar rows, best first, leaving
+        out the chunks of the `deleted` document ids.
+        """
+        if not self.count:
+            return []
+        rows, scores = self.scores(query_vector)
+        if deleted:
+            kept = ~np.isin(rows, self.id_table.document_rows(deleted))
+            rows, scores = rows[kept], scores[kept]
+        k = min(k, len(rows))
+        if not k:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(int(rows[i]), float(scores[i])) for i in best]
+
+    def to_documents(self, best):
+        """
+        Return [(row, document, score)] of [(row, score)], leaving out rows
+        whose chunk is missing from the chunk store.
+        """
+        documents = []
+        for row, score in best:
+            chunk_id = self.id_table.id(row)
+            chunk = self.chunk_store.get(chunk_id)
+            if chunk is None:
+                logger.warning(f"Chunk {chunk_id} of {self.build_dir} is not in the chunk store.")
+                continue
+            documents.append((row, chunk_document(chunk_id, chunk), score))
+        return documents
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, deleted=()):
+        return [(document, score) for row, document, score in self.to_documents(self.top_k(embedding, k, deleted))]
+
+    def similarity_search_by_vector_with_embeddings(self, embedding, k=4, deleted=()):
+        """
+        Return ([(document, score)], unit vectors of those documents).
+        """
+        found = self.to_documents(self.top_k(embedding, k, deleted))
+        if not found:
+            return [], np.empty((0, self.dim), dtype=np.float32)
+        rows = np.array([row for row, document, score in found], dtype=np.int64)
+        return [(document, score) for row, document, score in found], self.row_vectors(rows)
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        return [document for document, score in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    async def asimilarity_search_by_vector(self, embedding, k=4):
+        # NumPy releases the GIL for the dot product
+        return await asyncio.to_thread(self.similarity_search_by_vector, embedding, k)
+
+    def similarity_search(self, query, k=4):
+        return self.similarity_search_by_vector(self.embedding_function.embed_query(query), k)
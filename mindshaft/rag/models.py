@@ -1,6 +1,8 @@
 # rag/models.py
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
 
 class Document(models.Model):
     """
@@ -13,18 +15,93 @@ class Document(models.Model):
     def __str__(self):
         return self.title
 
-class IngestionStatus(models.Model):
-    is_ingesting = models.BooleanField(default=False)
-    last_updated = models.DateTimeField(auto_now=True)
+class IngestionJob(models.Model):
+    """
+    One run of the ingestion worker, with its progress.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    documents_total = models.PositiveIntegerField(default=0)
+    documents_done = models.PositiveIntegerField(default=0)
+    pages_parsed = models.PositiveIntegerField(default=0)
+    chunks_embedded = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)
+    summary = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
 
     def __str__(self):
-        return f"Ingestion in progress: {self.is_ingesting}"
+        return f"Ingestion job {self.pk} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, user=None):
+        """
+        Queue an ingestion run. Ingestion always brings the whole index up to
+        date, so a job that is still waiting is reused instead of adding another.
+        """
+        with transaction.atomic():
+            job = cls.objects.select_for_update().filter(status=cls.QUEUED).order_by('created_at').first()
+            if job is None:
+                job = cls.objects.create(requested_by=user)
+        return job
 
-    def save(self, *args, **kwargs):
-        self.pk = 1  # Ensure singleton
-        super().save(*args, **kwargs)
+    @classmethod
+    def claim_next(cls):
+        """
+        Mark the oldest queued job as running and return it, or None if the queue
+        is empty. Rows locked by another worker are skipped.
+        """
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status=cls.QUEUED)
+                .order_by('created_at')
+                .first()
+            )
+            if job is None:
+                return None
+            job.status = cls.RUNNING
+            job.started_at = timezone.now()
+            job.save(update_fields=['status', 'started_at', 'updated_at'])
+        return job
 
     @classmethod
-    def get_status(cls):
-        obj, created = cls.objects.get_or_create(pk=1)
-        return obj
\ No newline at end of file
+    def is_running(cls):
+        return cls.objects.filter(status=cls.RUNNING).exists()
+
+    @property
+    def is_finished(self):
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    @property
+    def duration(self):
+        """
+        Seconds spent running so far, or in total once finished.
+        """
+        if self.started_at is None:
+            return None
+        end = self.finished_at or timezone.now()
+        return (end - self.started_at).total_seconds()
+
+    @property
+    def chunks_per_second(self):
+        duration = self.duration
+        if not duration:
+            return None
+        return round(self.chunks_embedded / duration, 2)
@@ -0,0 +1,108 @@
+"""
+Local sentence embeddings with ONNX Runtime.
+
+Runs a sentence-transformers style model (all-MiniLM-L6-v2 by default) on the
+CPU: texts are tokenized with `tokenizers`, run through the ONNX graph in
+batches, mean-pooled over the attention mask and L2-normalized. A short query
+embeds in a few milliseconds with no network call.
+
+The model directory must hold model.onnx and tokenizer.json. The default is
+the copy Chroma downloads for its own default embedding function, fetched on
+first use if it is missing.
+"""
+import logging
+import os
+from functools import cached_property
+
+import numpy as np
+from chromadb.utils.embedding_functions.onnx_mini_lm_l6_v2 import ONNXMiniLM_L6_V2
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+ONNX_MODEL = ONNXMiniLM_L6_V2.MODEL_NAME
+DEFAULT_MODEL_DIR = os.path.join(ONNXMiniLM_L6_V2.DOWNLOAD_PATH, ONNXMiniLM_L6_V2.EXTRACTED_FOLDER_NAME)
+
+
+def ensure_default_model():
+    """
+    Download and unpack the default model into DEFAULT_MODEL_DIR if it is not there.
+    """
+    # Chroma's own downloader, which verifies the archive's checksum
+    ONNXMiniLM_L6_V2()._download_model_if_not_exists()
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    LangChain embeddings backed by an ONNX Runtime session on the CPU.
+    """
+
+    def __init__(self, model_dir=DEFAULT_MODEL_DIR, batch_size=32, max_length=256, threads=0):
+        self.model_dir = model_dir
+        self.batch_size = batch_size
+        self.max_length = max_length  # Tokens; longer texts are truncated
+        self.threads = threads  # 0 lets ONNX Runtime choose
+
+    @cached_property
+    def tokenizer(self):
+        from tokenizers import Tokenizer
+
+        if self.model_dir == DEFAULT_MODEL_DIR:
+            ensure_default_model()
+        tokenizer = Tokenizer.from_file(os.path.join(self.model_dir, "tokenizer.json"))
+        tokenizer.enable_truncation(max_length=self.max_length)
+        # Pad to the longest text of each batch, not to max_length
+        tokenizer.enable_padding(pad_id=tokenizer.token_to_id("[PAD]") or 0, pad_token="[PAD]")
+        return tokenizer
+
+    @cached_property
+    def session(self):
+        import onnxruntime
+
+        if self.model_dir == DEFAULT_MODEL_DIR:
+            ensure_default_model()
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.log_severity_level = 3
+        session = onnxruntime.InferenceSession(
+            os.path.join(self.model_dir, "model.onnx"),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        logger.info(f"Loaded ONNX embedding model from {self.model_dir}.")
+        return session
+
+    @cached_property
+    def input_names(self):
+        return {model_input.name for model_input in self.session.get_inputs()}
+
+    def _embed_batch(self, texts):
+        encoded = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, inputs)[0]
+
+        # Mean over the real tokens, then unit length
+        mask = attention_mask[:, :, np.newaxis].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled / np.clip(norms, 1e-12, None)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        # Batch texts of similar length together to keep padding small
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            indexes = order[start:start + self.batch_size]
+            batch = self._embed_batch([texts[i] for i in indexes])
+            for i, vector in zip(indexes, batch):
+                vectors[i] = vector.astype(np.float32).tolist()
+        return vectors
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0].astype(np.float32).tolist()
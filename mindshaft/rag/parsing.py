@@ -0,0 +1,203 @@
+"""
+PDF parsing and chunking for ingestion, run in separate processes.
+
+Parsing and tokenizing are CPU-bound pure Python, so threads only ever used
+about one core. The functions here run in a process pool and must stay free of
+Django imports: the pool uses the spawn start method, and every worker imports
+this module on its own.
+
+Chunking is done by TokenChunker, which encodes each page once and cuts chunks
+across page boundaries, with overlap and at sentence breaks where possible.
+
+Documents are streamed rather than loaded whole: pages are read lazily and
+their chunk texts are sent to the ingestion process in batches through a
+bounded queue. A worker blocks when the queue is full, so memory is bounded by
+the batch size and queue length instead of the size of the largest book.
+"""
+import multiprocessing
+import os
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import tiktoken
+from langchain_community.document_loaders import PyPDFLoader
+
+# Defaults for the chunk size and overlap, in tokens
+MAX_TOKENS = 1000
+# Chunks are sized in the embedding model's tokens
+ENCODING_MODEL = 'text-embedding-ada-002'
+# A token ending in one of these ends a sentence
+SENTENCE_ENDS = (b'.', b'!', b'?', b'\n')
+
+# Queue messages, as (kind, key, payload)
+BATCH = 'batch'  # payload: (pages_read, [(chunk_text, page), ...])
+DONE = 'done'  # payload: the worker's peak RSS in MB
+ERROR = 'error'  # payload: error message
+
+_queue = None
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=ENCODING_MODEL):
+    """
+    Tokenizer for model, loaded once per process.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+class TokenChunker:
+    """
+    Splits a stream of page texts into chunks of at most max_tokens tokens.
+
+    Every page is encoded once, as it is added. Chunks run across page
+    boundaries, so a book does not end up with a short fragment per page, and
+    consecutive chunks share `overlap` tokens. A chunk ends after the last
+    sentence break in its second half when there is one, otherwise at exactly
+    max_tokens. Chunks are (text, page) pairs, page being where the chunk starts.
+    """
+
+    def __init__(self, encoding, max_tokens=MAX_TOKENS, overlap=0):
+        if not 0 <= overlap < max_tokens // 2:
+            raise ValueError("overlap must be at least 0 and less than half of max_tokens")
+        self.encoding = encoding
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+        self.tokens = []
+        self.pages = []
+        self.carried = 0  # Leading tokens already emitted as the previous chunk's overlap
+        self._breaks = {}
+
+    def add(self, text, page=None):
+        """
+        Add a page and yield the chunks it completes.
+        """
+        tokens = self.encoding.encode_ordinary(text + "\n")
+        self.tokens.extend(tokens)
+        self.pages.extend([page] * len(tokens))
+        while len(self.tokens) >= self.max_tokens:
+            chunk = self._emit(self._cut())
+            if chunk:
+                yield chunk
+
+    def flush(self):
+        """
+        Yield whatever is left once the document has ended.
+        """
+        if len(self.tokens) > self.carried:
+            chunk = self._emit(len(self.tokens), final=True)
+            if chunk:
+                yield chunk
+        self.tokens = []
+        self.pages = []
+        self.carried = 0
+
+    def _is_break(self, token):
+        is_break = self._breaks.get(token)
+        if is_break is None:
+            is_break = self._breaks[token] = self.encoding.decode_single_token_bytes(token).rstrip(b" ").endswith(
+                SENTENCE_ENDS
+            )
+        return is_break
+
+    def _cut(self):
+        for end in range(self.max_tokens, self.max_tokens // 2, -1):
+            if self._is_break(self.tokens[end - 1]):
+                return end
+        return self.max_tokens
+
+    def _emit(self, end, final=False):
+        text = self.encoding.decode(self.tokens[:end]).strip()
+        page = self.pages[0]
+        start = end if final else end - self.overlap
+        self.tokens = self.tokens[start:]
+        self.pages = self.pages[start:]
+        self.carried = end - start
+        return (text, page) if text else None
+
+
+def iter_pdf_batches(file_path, batch_size, max_tokens=MAX_TOKENS, overlap=0):
+    """
+    Read a PDF one page at a time and yield (pages_read, chunks) whenever
+    batch_size chunks are ready. pages_read counts the pages since the previous
+    batch; the last batch may be short or empty. Chunks are (text, page) pairs.
+    """
+    chunker = TokenChunker(get_encoding(), max_tokens, overlap)
+    batch = []
+    pages = 0
+    for index, page in enumerate(PyPDFLoader(file_path).lazy_load()):
+        pages += 1
+        batch.extend(chunker.add(page.page_content, page.metadata.get('page', index)))
+        while len(batch) >= batch_size:
+            yield pages, batch[:batch_size]
+            batch = batch[batch_size:]
+            pages = 0
+    batch.extend(chunker.flush())
+    while len(batch) > batch_size:
+        yield pages, batch[:batch_size]
+        batch = batch[batch_size:]
+        pages = 0
+    yield pages, batch
+
+
+def peak_rss_mb():
+    """
+    Highest resident set size of this process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def rss_mb():
+    """
+    Current resident set size of this process in MB, or the peak where /proc is missing.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def set_event_queue(queue):
+    """
+    Pool initializer: the queue workers send their batches through.
+    """
+    global _queue
+    _queue = queue
+
+
+def stream_pdf(key, file_path, batch_size, max_tokens=MAX_TOKENS, overlap=0):
+    """
+    Pool task: send a document's chunk batches, then DONE or ERROR, tagged with key.
+    """
+    try:
+        for pages, chunks in iter_pdf_batches(file_path, batch_size, max_tokens, overlap):
+            _queue.put((BATCH, key, (pages, chunks)))
+    except Exception as e:
+        _queue.put((ERROR, key, str(e)))
+    else:
+        _queue.put((DONE, key, peak_rss_mb()))
+
+
+def parse_queue(workers):
+    """
+    Bounded queue between the parsing workers and the ingestion process.
+    """
+    return multiprocessing.get_context('spawn').Queue(maxsize=workers * 2)
+
+
+def parse_executor(workers, queue):
+    """
+    Process pool for stream_pdf. Spawned rather than forked: the ingestion
+    process holds database connections and Chroma's threads, neither of which
+    survives a fork.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=set_event_queue,
+        initargs=(queue,),
+    )
@@ -0,0 +1,151 @@
+"""
+Micro-batching of chat query embeddings.
+
+Under load many requests each need one query embedded at about the same time.
+BatchingEmbeddings holds the first query of a batch for up to
+RAG_QUERY_BATCH_WAIT_MS, or until RAG_QUERY_BATCH_SIZE queries have joined it,
+then embeds the whole batch with one embed_documents call and hands every
+caller its own vector. The thread that opened the batch makes the call; the
+others wait for their result. A query that arrives while no other query is in
+flight is sent straight away, so a quiet server never pays the wait.
+
+Async callers are batched on their own event loop: the first query schedules
+a flush with loop.call_later and the batch is sent with aembed_documents, so
+they never wait on a thread and the async HTTP client is kept.
+
+It sits behind the query caches, so only cache misses are batched.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+from mindshaft import metrics
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+# Time the first query of a batch waited for the others, in milliseconds
+WAIT_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50)
+
+
+class BatchingEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that sends concurrent embed_query calls to the wrapped
+    client as one batch. Document embeddings pass straight through.
+    """
+
+    def __init__(self, embeddings, max_wait_ms=5, max_size=32):
+        self.embeddings = embeddings
+        self.max_wait = max_wait_ms / 1000
+        self.max_size = max_size
+        self._condition = threading.Condition()
+        self._batch = None  # [(text, future)] of the batch still taking queries
+        self._in_flight = 0  # Threads inside embed_query
+        # Per event loop: [batch, time opened, flush handle] of its open batch
+        self._async_batches = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+        self._sending = set()  # Flush tasks in flight; referenced so they are not collected
+
+    def embed_query(self, text):
+        if self.max_wait <= 0 or self.max_size <= 1:
+            return self.embeddings.embed_query(text)
+        future = Future()
+        with self._condition:
+            self._in_flight += 1
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = []
+            batch.append((text, future))
+            # Alone means nobody is coming to join; don't hold the query
+            if len(batch) >= self.max_size or self._in_flight == 1:
+                self._batch = None
+                self._condition.notify_all()
+            if leader:
+                started = time.monotonic()
+                deadline = started + self.max_wait
+                while self._batch is batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._batch = None
+                        break
+                    self._condition.wait(remaining)
+        try:
+            if leader:
+                self._send(batch, (time.monotonic() - started) * 1000)
+            return future.result()
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+
+    async def aembed_query(self, text):
+        if self.max_wait <= 0 or self.max_size <= 1:
+            return await self.embeddings.aembed_query(text)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._async_lock:
+            pending = self._async_batches.get(loop)
+            if pending is None:
+                pending = self._async_batches[loop] = [[], loop.time(), None]
+                pending[2] = loop.call_later(self.max_wait, self._flush, loop, pending)
+        pending[0].append((text, future))
+        if len(pending[0]) >= self.max_size:
+            pending[2].cancel()
+            self._flush(loop, pending)
+        return await future
+
+    def _flush(self, loop, pending):
+        """
+        Close an event loop's open batch and start sending it.
+        """
+        with self._async_lock:
+            if self._async_batches.get(loop) is not pending:
+                return
+            del self._async_batches[loop]
+        batch, opened, handle = pending
+        task = loop.create_task(self._asend(batch, (loop.time() - opened) * 1000))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    def _observe(self, batch, waited_ms):
+        metrics.observe("rag.query_batch.size", len(batch), buckets=BATCH_SIZE_BUCKETS)
+        metrics.observe("rag.query_batch.wait_ms", waited_ms, buckets=WAIT_BUCKETS)
+        metrics.incr("rag.query_batch.calls")
+        logger.debug(f"Embedding {len(batch)} queries in one call after {waited_ms:.1f}ms.")
+        return list(dict.fromkeys(text for text, future in batch))
+
+    def _send(self, batch, waited_ms):
+        texts = self._observe(batch, waited_ms)
+        try:
+            vectors = dict(zip(texts, self.embeddings.embed_documents(texts)))
+        except Exception as e:
+            for text, future in batch:
+                future.set_exception(e)
+            return
+        for text, future in batch:
+            future.set_result(vectors[text])
+
+    async def _asend(self, batch, waited_ms):
+        texts = self._observe(batch, waited_ms)
+        try:
+            vectors = dict(zip(texts, await self.embeddings.aembed_documents(texts)))
+        except Exception as e:
+            for text, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for text, future in batch:
+            # A caller that was cancelled (its request timed out) no longer waits
+            if not future.done():
+                future.set_result(vectors[text])
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts):
+        return await self.embeddings.aembed_documents(texts)
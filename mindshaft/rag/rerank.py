@@ -0,0 +1,65 @@
+"""
+Diversity reranking of vector search results.
+
+Neighbouring chunks of the same book are often all near the query and would
+fill every slot with the same passage. Maximal marginal relevance picks the
+results one at a time, each maximizing
+
+    lambda_mult * similarity to the query
+    - (1 - lambda_mult) * highest similarity to a result already picked
+
+over a larger candidate set. The candidates' pairwise similarities come from
+one matrix product, so a pick is a few vector operations over the candidates.
+"""
+import logging
+import time
+
+import numpy as np
+
+from mindshaft import metrics
+
+logger = logging.getLogger(__name__)
+
+# Reranking takes well under a millisecond; buckets in milliseconds
+RERANK_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 25)
+
+
+def maximal_marginal_relevance(similarities, vectors, k, lambda_mult=0.5):
+    """
+    Return the indexes of the k candidates picked by MMR, in pick order.
+    `similarities` holds each candidate's similarity to the query and
+    `vectors` their unit vectors, one per row.
+    """
+    similarities = np.asarray(similarities, dtype=np.float32)
+    count = len(similarities)
+    k = min(k, count)
+    if not k:
+        return []
+    vectors = np.asarray(vectors, dtype=np.float32)
+    pairwise = vectors @ vectors.T
+    relevance = lambda_mult * similarities
+
+    picked = [int(np.argmax(similarities))]
+    redundancy = pairwise[picked[0]].copy()  # Highest similarity to a picked candidate
+    available = np.ones(count, dtype=bool)
+    available[picked[0]] = False
+    for _ in range(k - 1):
+        scores = np.where(available, relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(redundancy, pairwise[best], out=redundancy)
+    return picked
+
+
+def mmr_rerank(scored, vectors, k, lambda_mult=0.5):
+    """
+    Pick k of the [(document, score)] candidates with MMR. Documents keep their
+    metadata and their similarity to the query as the score.
+    """
+    started = time.perf_counter()
+    picked = maximal_marginal_relevance([score for document, score in scored], vectors, k, lambda_mult)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    metrics.observe('rag.rerank_ms', elapsed_ms, buckets=RERANK_BUCKETS)
+    logger.debug(f"MMR picked {len(picked)} of {len(scored)} candidates in {elapsed_ms:.3f}ms.")
+    return [scored[i] for i in picked]
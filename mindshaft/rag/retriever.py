@@ -0,0 +1,390 @@
+"""
+Long-lived handle on the vector index used for retrieval: the Chroma
+collection, or its memory-mapped export when RAG_VECTOR_INDEX is 'mmap'. With
+RAG_HYBRID_SEARCH the BM25 index built next to it is queried as well and the
+two rankings are fused. Vector results are reranked for diversity with maximal
+marginal relevance when RAG_MMR_CANDIDATES is set.
+
+The collection is opened lazily once per worker and reused across requests.
+The index lives in generations (see rag.generations). When another generation
+goes live, or the version marker inside the live one changes, the handle
+reopens the index on the next query, so workers always read the current index
+without reopening it per message. Documents deleted since the live generation
+was built (its tombstones) are filtered out of every search, so a delete takes
+effect on the next check without waiting for the rebuild.
+
+Results are cached per worker by normalized query and k, keyed on the index
+version (the live generation, its version marker and the tombstones). Ingestion and deletes
+change the version, so a repeated query skips the embedding call and the
+search without ever being answered from an older index.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import numpy as np
+from chromadb.api.client import SharedSystemClient
+from django.conf import settings
+from langchain.schema import Document as LangChainDocument
+from langchain_chroma import Chroma
+
+from mindshaft import metrics
+from .chunk_store import get_chunk_store
+from .embedding_cache import LRUCache, normalize_query
+from .generations import live_generation, read_tombstones
+from .embeddings import get_embedding_model, get_query_embeddings, index_embedding_model
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .mmap_index import MmapIndex
+from .rerank import mmr_rerank
+
+logger = logging.getLogger(__name__)
+
+CHROMA_DB_DIR = os.path.join(settings.BASE_DIR, 'rag', 'chroma_db')
+COLLECTION_NAME = 'documents'
+VERSION_FILE = 'INDEX_VERSION'
+
+WARM_UP_QUERY = "I feel anxious"
+
+# What one search reads, swapped in as a whole when the index changes
+IndexSnapshot = namedtuple("IndexSnapshot", ["store", "lexical", "version", "deleted"])
+
+
+def vector_search_with_embeddings(store, embedding, k, deleted=()):
+    """
+    Return ([(document, cosine similarity)], unit vectors) of the k chunks of
+    store nearest to embedding, best first, leaving out the chunks of the
+    `deleted` document ids.
+    """
+    if isinstance(store, MmapIndex):
+        return store.similarity_search_by_vector_with_embeddings(embedding, k, deleted)
+    # Chroma reports squared L2 distances; compare the vectors themselves instead
+    result = store._collection.query(
+        query_embeddings=[embedding],
+        n_results=k,
+        where={'id': {'$nin': sorted(deleted)}} if deleted else None,
+        include=['documents', 'metadatas', 'embeddings'],
+    )
+    if not result['ids'][0]:
+        return [], np.empty((0, len(embedding)), dtype=np.float32)
+    vectors = np.asarray(result['embeddings'][0], dtype=np.float32)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    query = np.asarray(embedding, dtype=np.float32)
+    similarities = vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    scored = [
+        (LangChainDocument(page_content=text, metadata=metadata or {}, id=chunk_id), float(similarity))
+        for chunk_id, text, metadata, similarity in zip(
+            result['ids'][0], result['documents'][0], result['metadatas'][0], similarities
+        )
+    ]
+    return scored, vectors
+
+
+def similarities_by_ids(store, embedding, chunk_ids):
+    """
+    Return {chunk id: cosine similarity to embedding} of the chunks of store
+    with the given ids; ids not in the store are left out.
+    """
+    if isinstance(store, MmapIndex):
+        found = store.vectors_by_ids(chunk_ids)
+    else:
+        result = store._collection.get(ids=list(chunk_ids), include=['embeddings'])
+        found = dict(zip(result['ids'], result['embeddings']))
+    if not found:
+        return {}
+    vectors = np.asarray(list(found.values()), dtype=np.float32)
+    vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+    query = np.asarray(embedding, dtype=np.float32)
+    similarities = vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+    return dict(zip(found, similarities.tolist()))
+
+
+def vector_search_with_scores(store, embedding, k, deleted=()):
+    """
+    Return [(document, cosine similarity)] of the k chunks of store nearest to
+    embedding, best first, leaving out the chunks of the `deleted` document ids.
+    """
+    if isinstance(store, MmapIndex):
+        return store.similarity_search_by_vector_with_score(embedding, k, deleted)
+    return vector_search_with_embeddings(store, embedding, k, deleted)[0]
+
+
+def read_index_version(persist_directory=CHROMA_DB_DIR):
+    """
+    Return the version marker of the index, or None if there is no index.
+    """
+    try:
+        with open(os.path.join(persist_directory, VERSION_FILE), encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        # Indexes written before the marker existed still count as an index
+        return "initial" if os.path.isdir(persist_directory) else None
+
+
+def current_index_version(persist_directory=CHROMA_DB_DIR):
+    """
+    Return (live generation directory, its version marker, the tombstones), or
+    None if there is no index.
+    """
+    directory = live_generation(persist_directory)
+    if directory is None:
+        return None
+    return directory, read_index_version(directory), read_tombstones(persist_directory)
+
+
+def mark_index_updated(persist_directory=CHROMA_DB_DIR):
+    """
+    Write a new version marker so every worker reopens the index on its next query.
+    """
+    os.makedirs(persist_directory, exist_ok=True)
+    tmp_path = os.path.join(persist_directory, f"{VERSION_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(uuid.uuid4().hex)
+    os.replace(tmp_path, os.path.join(persist_directory, VERSION_FILE))
+
+
+class Retriever:
+    """
+    Lazily opened, reloadable vector store handle shared by all requests of a worker.
+    The store is a Chroma collection or an MmapIndex; both are queried through
+    vector_search_with_scores.
+    """
+
+    def __init__(self, persist_directory=CHROMA_DB_DIR, collection_name=COLLECTION_NAME):
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = None
+        self._results = LRUCache(settings.RAG_RESULT_CACHE_SIZE)  # (version, query, k) -> results
+
+    def _open(self, version):
+        """
+        Return the IndexSnapshot of version, or None if there is no index.
+        """
+        if self._snapshot is not None and self._snapshot.store is not None:
+            # Chroma caches clients per path; drop them so the new files are read
+            SharedSystemClient.clear_system_cache()
+        if version is None:
+            return None
+        directory, marker, deleted = version
+        store = self._open_store(directory, marker)
+        lexical = None
+        if store is not None and settings.RAG_HYBRID_SEARCH:
+            chunk_store = get_chunk_store()
+            lexical = LexicalIndex.open(directory, chunk_store) if chunk_store is not None else None
+            if lexical is None:
+                logger.warning(f"No BM25 index in {directory} or no chunk store; using vector search only.")
+        return IndexSnapshot(store, lexical, version, deleted)
+
+    def _open_store(self, directory, marker):
+        chunk_store = get_chunk_store()
+        if settings.RAG_VECTOR_INDEX == 'mmap' and chunk_store is not None:
+            index = MmapIndex.open(directory, get_query_embeddings(), chunk_store, nprobe=settings.RAG_IVF_NPROBE)
+            if index is not None and index.embedding_model == get_embedding_model():
+                logger.info(f"Opened memory-mapped index {index.build_dir} ({index.count} rows, {index.nlist} lists).")
+                return index
+        if settings.RAG_VECTOR_INDEX == 'mmap':
+            logger.warning(f"No current memory-mapped index in {directory} or no chunk store; using Chroma.")
+        store = Chroma(
+            collection_name=self.collection_name,
+            persist_directory=directory,
+            embedding_function=get_query_embeddings(),
+            create_collection_if_not_exists=False,
+        )
+        indexed_model = index_embedding_model(store._collection.metadata)
+        if indexed_model != get_embedding_model():
+            # Querying would compare vectors of different models; wait for the rebuild
+            logger.error(
+                f"Vector index {directory} was built with {indexed_model}, "
+                f"not {get_embedding_model()}. Re-run ingestion."
+            )
+            return None
+        logger.info(f"Opened vector index {directory} (version {marker}, {indexed_model}).")
+        return store
+
+    def get_snapshot(self):
+        """
+        Return the IndexSnapshot to search, or None if no index has been built
+        yet. Its store, BM25 index and version always belong together.
+        """
+        now = time.monotonic()
+        interval = settings.RAG_INDEX_CHECK_INTERVAL
+        if self._checked_at is not None and now - self._checked_at < interval:
+            return self._snapshot
+
+        with self._lock:
+            if self._checked_at is None or now - self._checked_at >= interval:
+                version = current_index_version(self.persist_directory)
+                current = self._snapshot.version if self._snapshot is not None else None
+                if self._checked_at is None or version != current:
+                    if version is not None and current is not None and version[:2] == current[:2]:
+                        # Only the tombstones changed: same files, other filter
+                        snapshot = self._snapshot._replace(version=version, deleted=version[2])
+                    else:
+                        try:
+                            snapshot = self._open(version)
+                        except Exception as e:
+                            logger.error(f"Could not open vector index {self.persist_directory}: {e}")
+                            snapshot = None
+                    # One assignment, so a search never pairs one version's store with another's key
+                    self._snapshot = snapshot
+                    self._results.clear()
+                self._checked_at = now
+            return self._snapshot
+
+    def get_store(self):
+        """
+        Return the open vector store, or None if no index has been built yet.
+        """
+        snapshot = self.get_snapshot()
+        return snapshot.store if snapshot is not None else None
+
+    def is_available(self):
+        return self.get_store() is not None
+
+    def similarity_search(self, query, k=3):
+        return [document for document, score in self.similarity_search_with_scores(query, k=k)]
+
+    async def asimilarity_search(self, query, k=3):
+        return [document for document, score in await self.asimilarity_search_with_scores(query, k=k)]
+
+    def similarity_search_with_scores(self, query, k=3):
+        """
+        Return [(document, score)] of the k best chunks, best first. The score is
+        the cosine similarity to the query, or None for chunks only BM25 found.
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is None or snapshot.store is None:
+            return []
+        key = (snapshot.version, normalize_query(query), k)
+        cached = self._cached_results(key)
+        if cached is not None:
+            return cached
+        query_embedding = get_query_embeddings().embed_query(query)
+        scored = self._search(snapshot, query, query_embedding, k)
+        self._cache_results(key, scored)
+        return scored
+
+    async def asimilarity_search_with_scores(self, query, k=3):
+        # Reopening the index after a change reads files and may wait on the lock
+        snapshot = await asyncio.to_thread(self.get_snapshot)
+        if snapshot is None or snapshot.store is None:
+            return []
+        key = (snapshot.version, normalize_query(query), k)
+        cached = self._cached_results(key)
+        if cached is not None:
+            return cached
+        query_embedding = await get_query_embeddings().aembed_query(query)
+        # The lookup itself is local and CPU-bound
+        scored = await asyncio.to_thread(self._search, snapshot, query, query_embedding, k)
+        self._cache_results(key, scored)
+        return scored
+
+    def _cached_results(self, key):
+        if not self._results.maxsize:
+            return None
+        cached = self._results.get(key)
+        if cached is None:
+            metrics.incr('rag.result_cache.misses')
+            return None
+        metrics.incr('rag.result_cache.hits')
+        # Fresh documents, so callers cannot change the cached ones
+        return [
+            (LangChainDocument(page_content=text, metadata=dict(metadata), id=chunk_id), score)
+            for chunk_id, text, metadata, score in cached
+        ]
+
+    def _cache_results(self, key, scored):
+        # Results of an index that was swapped out during the search are not kept
+        snapshot = self._snapshot
+        if self._results.maxsize and snapshot is not None and key[0] == snapshot.version:
+            self._results.set(key, [
+                (document.id, document.page_content, dict(document.metadata), score) for document, score in scored
+            ])
+
+    def _search(self, snapshot, query, query_embedding, k):
+        store, lexical, deleted = snapshot.store, snapshot.lexical, snapshot.deleted
+        candidates = k if lexical is None else max(k, settings.RAG_HYBRID_CANDIDATES)
+        scored = self._vector_search(store, query_embedding, candidates, deleted)
+        if lexical is None:
+            return scored
+        return self._fuse(store, query_embedding, scored, lexical, query, k, candidates, deleted)
+
+    def _vector_search(self, store, query_embedding, k, deleted=()):
+        """
+        The k nearest chunks; with RAG_MMR_CANDIDATES above k, that many are
+        fetched and k of them picked for diversity.
+        """
+        fetch_k = settings.RAG_MMR_CANDIDATES
+        if fetch_k <= k:
+            return vector_search_with_scores(store, query_embedding, k, deleted)
+        scored, vectors = vector_search_with_embeddings(store, query_embedding, fetch_k, deleted)
+        return mmr_rerank(scored, vectors, k, settings.RAG_MMR_LAMBDA)
+
+    def _fuse(self, store, query_embedding, scored, lexical, query, k, candidates, deleted=()):
+        """
+        Combine the vector and BM25 rankings with reciprocal rank fusion. Chunks
+        only BM25 found get their cosine similarity to the query as well, so
+        the context thresholds apply to them too.
+        """
+        scores = {document.id or document.page_content: score for document, score in scored}
+        fused = reciprocal_rank_fusion(
+            [[document for document, score in scored], lexical.search(query, k=candidates, deleted=deleted)],
+            k,
+            rrf_k=settings.RAG_RRF_K,
+        )
+        unscored = [document.id for document in fused if document.id and document.id not in scores]
+        if unscored:
+            scores.update(similarities_by_ids(store, query_embedding, unscored))
+        return [(document, scores.get(document.id or document.page_content)) for document in fused]
+
+    def warm_up(self):
+        """
+        Open the index and run one query so the HNSW index is loaded and the
+        embedding connection is established before the first chat arrives.
+        """
+        started = time.monotonic()
+        try:
+            if self.is_available():
+                self.similarity_search(WARM_UP_QUERY, k=1)
+            logger.info(f"Retriever warm-up finished in {time.monotonic() - started:.2f}s.")
+        except Exception as e:
+            logger.warning(f"Retriever warm-up failed: {e}")
+
+
+_retrievers = {}
+_retrievers_lock = threading.Lock()
+
+
+def get_retriever():
+    """
+    Return the retriever of this worker process. Keyed by pid so a handle opened
+    before a fork (gunicorn --preload) is never shared with the workers.
+    """
+    pid = os.getpid()
+    retriever = _retrievers.get(pid)
+    if retriever is None:
+        with _retrievers_lock:
+            retriever = _retrievers.get(pid)
+            if retriever is None:
+                if _retrievers:
+                    # Forked from a process that opened the index: Chroma caches its
+                    # clients per path, not per process, so drop the inherited ones
+                    # instead of sharing their SQLite connection and threads.
+                    SharedSystemClient.clear_system_cache()
+                    _retrievers.clear()
+                retriever = _retrievers[pid] = Retriever()
+    return retriever
+
+
+def warm_up_in_background():
+    """
+    Worker boot hook: warm the retriever up without delaying startup.
+    """
+    if not settings.RAG_WARM_UP_ON_BOOT:
+        return
+    threading.Thread(target=get_retriever().warm_up, name="retriever-warm-up", daemon=True).start()
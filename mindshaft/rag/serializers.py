@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Document
+from .models import Document, IngestionJob
 
 class DocumentSerializer(serializers.ModelSerializer):
 
@@ -9,3 +9,17 @@ class DocumentSerializer(serializers.ModelSerializer):
         model = Document
         fields = ['id', 'title', 'uploaded_at']
         read_only_fields = ['id', 'uploaded_at', 'title']
+
+
+class IngestionJobSerializer(serializers.ModelSerializer):
+    duration = serializers.FloatField(read_only=True)
+    chunks_per_second = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = IngestionJob
+        fields = [
+            'id', 'status', 'created_at', 'started_at', 'finished_at', 'duration',
+            'documents_total', 'documents_done', 'pages_parsed', 'chunks_embedded',
+            'chunks_per_second', 'errors', 'summary',
+        ]
+        read_only_fields = fields
@@ -1,3 +1,1449 @@
-from django.test import TestCase
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest.mock import patch
 
-# Create your tests here.
+import numpy as np
+import tiktoken
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from langchain.schema import Document as LangChainDocument
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from rest_framework.test import APIClient
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+from mindshaft import metrics
+from users.models import CustomUser
+from .chunk_store import ChunkStore, get_chunk_store
+from .context import NO_CONTEXT, RetrievalPool, aretrieve_context, assemble_context, retrieve_context
+from .dedup import minhash
+from .generations import build_lock, live_generation, read_tombstones
+from .jobs import run_pending_jobs
+from .lexical_index import LexicalIndex, build_lexical_index, reciprocal_rank_fusion
+from .manifest import IngestionManifest
+from .mmap_index import MmapIndex, build_mmap_index, read_pointer
+from .models import Document, IngestionJob
+from .onnx_embeddings import OnnxEmbeddings
+from .rerank import maximal_marginal_relevance
+from .parsing import TokenChunker, set_event_queue
+from .query_batching import BatchingEmbeddings
+from .utils import add_documents_to_chroma, document_chunk_ids, ingest_documents
+from .embeddings import get_embedding_model
+from .embedding_cache import CachedQueryEmbeddings, ContentAddressedEmbeddings, DiskVectorCache
+from .retriever import Retriever, get_retriever, mark_index_updated, read_index_version
+
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    """
+    Fake embeddings that remember how many texts were sent to the "API".
+    """
+    calls: int = 0
+    texts_embedded: int = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        self.texts_embedded += 1
+        return super().embed_query(text)
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        self.texts_embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+class RagTestCase(TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, ignore_errors=True)
+        self.embeddings = DeterministicFakeEmbedding(size=16)
+        patcher = patch("rag.retriever.get_query_embeddings", return_value=self.embeddings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        chunk_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, chunk_dir, ignore_errors=True)
+        chunks = override_settings(RAG_CHUNK_STORE_DIR=chunk_dir)
+        chunks.enable()
+        self.addCleanup(chunks.disable)
+        self.chunk_store = get_chunk_store()
+
+    def build_index(self, texts):
+        store = Chroma(
+            collection_name="documents",
+            persist_directory=self.index_dir,
+            embedding_function=self.embeddings,
+        )
+        store.add_texts(texts)
+        mark_index_updated(self.index_dir)
+        return store
+
+
+@override_settings(RAG_INDEX_CHECK_INTERVAL=0)
+class RetrieverTest(RagTestCase):
+    def test_missing_index_returns_nothing(self):
+        retriever = Retriever(persist_directory=f"{self.index_dir}/missing")
+
+        self.assertFalse(retriever.is_available())
+        self.assertEqual(retriever.similarity_search("anxiety"), [])
+
+    def test_store_is_opened_once(self):
+        self.build_index(["Breathing exercises help with anxiety."])
+        retriever = Retriever(persist_directory=self.index_dir)
+
+        store = retriever.get_store()
+
+        self.assertIsNotNone(store)
+        self.assertIs(retriever.get_store(), store)
+        self.assertEqual(
+            retriever.similarity_search("Breathing exercises help with anxiety.", k=1)[0].page_content,
+            "Breathing exercises help with anxiety.",
+        )
+
+    def test_store_is_reopened_when_index_changes(self):
+        self.build_index(["First text."])
+        retriever = Retriever(persist_directory=self.index_dir)
+        store = retriever.get_store()
+        version = read_index_version(self.index_dir)
+
+        mark_index_updated(self.index_dir)
+
+        self.assertNotEqual(read_index_version(self.index_dir), version)
+        self.assertIsNot(retriever.get_store(), store)
+
+    def test_scores_are_cosine_similarities(self):
+        self.build_index(["Breathing exercises help with anxiety.", "Sleep hygiene improves mood."])
+        retriever = Retriever(persist_directory=self.index_dir)
+
+        with self.settings(RAG_HYBRID_SEARCH=False):
+            (best, score), (other, other_score) = retriever.similarity_search_with_scores(
+                "Breathing exercises help with anxiety.", k=2
+            )
+
+        self.assertEqual(best.page_content, "Breathing exercises help with anxiety.")
+        self.assertAlmostEqual(score, 1.0, places=4)
+        self.assertLess(other_score, score)
+
+    def test_repeated_query_is_served_from_the_result_cache(self):
+        metrics.reset()
+        self.build_index(["Breathing exercises help with anxiety.", "Sleep hygiene improves mood."])
+        retriever = Retriever(persist_directory=self.index_dir)
+        embeddings = CountingEmbeddings(size=16)
+
+        with patch("rag.retriever.get_query_embeddings", return_value=embeddings):
+            first = retriever.similarity_search_with_scores("Breathing exercises help with anxiety.", k=2)
+            first[0][0].metadata["changed"] = True
+            second = retriever.similarity_search_with_scores("  breathing EXERCISES help with anxiety. ", k=2)
+            self.assertEqual(embeddings.calls, 1)
+            self.assertEqual([(d.page_content, s) for d, s in second], [(d.page_content, s) for d, s in first])
+            self.assertNotIn("changed", second[0][0].metadata)
+            self.assertEqual(metrics.snapshot()["counters"]["rag.result_cache.hits"], 1)
+
+            # A new index version is searched again
+            mark_index_updated(self.index_dir)
+            retriever.similarity_search_with_scores("Breathing exercises help with anxiety.", k=2)
+            self.assertEqual(embeddings.calls, 2)
+
+    def test_results_of_a_search_racing_a_reopen_are_not_cached(self):
+        self.build_index(["Breathing exercises help with anxiety.", "Sleep hygiene improves mood."])
+        retriever = Retriever(persist_directory=self.index_dir)
+        embeddings = CountingEmbeddings(size=16)
+        search = retriever._search
+
+        def search_while_the_index_changes(snapshot, *args):
+            mark_index_updated(self.index_dir)
+            self.assertNotEqual(retriever.get_snapshot().version, snapshot.version)
+            return search(snapshot, *args)
+
+        with patch("rag.retriever.get_query_embeddings", return_value=embeddings):
+            with patch.object(retriever, "_search", side_effect=search_while_the_index_changes):
+                retriever.similarity_search_with_scores("Breathing exercises help with anxiety.", k=2)
+            retriever.similarity_search_with_scores("Breathing exercises help with anxiety.", k=2)
+
+        # The first search read the old index, so the second one was not answered from it
+        self.assertEqual(embeddings.calls, 2)
+
+    def test_forked_worker_drops_the_inherited_chroma_clients(self):
+        master = Retriever(persist_directory=self.index_dir)
+        with patch("rag.retriever._retrievers", {1: master}) as retrievers, \
+                patch("rag.retriever.os.getpid", return_value=2), \
+                patch("rag.retriever.SharedSystemClient.clear_system_cache") as clear:
+            worker = get_retriever()
+
+            self.assertIs(get_retriever(), worker)
+            self.assertEqual(retrievers, {2: worker})
+        self.assertIsNot(worker, master)
+        clear.assert_called_once()
+
+    def test_index_of_another_embedding_model_is_not_queried(self):
+        self.build_index(["Breathing exercises help with anxiety."])
+
+        with self.settings(RAG_EMBEDDING_BACKEND="onnx"):
+            retriever = Retriever(persist_directory=self.index_dir)
+
+            self.assertFalse(retriever.is_available())
+
+
+class MmapIndexTest(RagTestCase):
+    texts = [
+        "Breathing exercises help with anxiety.",
+        "Sleep hygiene improves mood.",
+        "Journaling can reduce rumination.",
+        "Exercise releases endorphins.",
+    ]
+
+    def build_mmap(self, dtype="float16"):
+        store = self.build_index(self.texts)
+        build_mmap_index(self.index_dir, store._collection, "text-embedding-ada-002", self.chunk_store, dtype=dtype)
+        return store
+
+    def test_nearest_text_is_itself(self):
+        for dtype in ("float16", "int8"):
+            with self.subTest(dtype=dtype):
+                store = self.build_mmap(dtype)
+                index = MmapIndex.open(self.index_dir, self.embeddings, self.chunk_store)
+
+                for text in self.texts:
+                    self.assertEqual(index.similarity_search(text, k=1)[0].page_content, text)
+                    self.assertEqual(len(index.similarity_search(text, k=3)), 3)
+                store.delete_collection()
+
+    def test_rebuild_replaces_previous_build(self):
+        self.build_mmap()
+        first = read_pointer(self.index_dir)
+
+        store = Chroma(collection_name="documents", persist_directory=self.index_dir, embedding_function=self.embeddings)
+        store.add_texts(["Gratitude lists lift mood."])
+        build_mmap_index(self.index_dir, store._collection, "text-embedding-ada-002", self.chunk_store)
+
+        self.assertNotEqual(read_pointer(self.index_dir), first)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(MmapIndex.open(self.index_dir, self.embeddings).count, 5)
+
+    @override_settings(RAG_VECTOR_INDEX="mmap", RAG_INDEX_CHECK_INTERVAL=0)
+    def test_retriever_uses_the_mmap_index(self):
+        self.build_mmap()
+
+        retriever = Retriever(persist_directory=self.index_dir)
+
+        self.assertIsInstance(retriever.get_store(), MmapIndex)
+        self.assertEqual(retriever.similarity_search(self.texts[2], k=1)[0].page_content, self.texts[2])
+
+
+class LexicalIndexTest(RagTestCase):
+    texts = [
+        "Breathing exercises help with anxiety.",
+        "CBT teaches you to challenge unhelpful thoughts.",
+        "Adults with ADHD often struggle with time management.",
+        "Sleep hygiene improves mood.",
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.store = self.build_index(self.texts)
+        build_lexical_index(self.index_dir, self.store._collection, self.chunk_store)
+
+    def test_rare_terms_rank_first(self):
+        index = LexicalIndex.open(self.index_dir, self.chunk_store)
+
+        self.assertEqual(index.search("How do I manage my adhd?", k=1)[0].page_content, self.texts[2])
+        self.assertEqual(index.search("I feel really", k=3), [])
+
+    def test_fusion_rewards_agreement(self):
+        a, b, c = (LangChainDocument(page_content=text) for text in "abc")
+
+        fused = reciprocal_rank_fusion([[a, b, c], [b, c]], k=2)
+
+        self.assertEqual([doc.page_content for doc in fused], ["b", "c"])
+
+    def test_fusion_keeps_same_text_of_different_chunks_apart(self):
+        first = LangChainDocument(page_content="Breathe slowly.", id="1:a:0")
+        second = LangChainDocument(page_content="Breathe slowly.", id="2:a:0")
+
+        fused = reciprocal_rank_fusion([[first], [second]], k=2)
+
+        self.assertEqual([doc.id for doc in fused], ["1:a:0", "2:a:0"])
+
+    @override_settings(RAG_INDEX_CHECK_INTERVAL=0, RAG_HYBRID_SEARCH=True)
+    def test_retriever_finds_keyword_matches(self):
+        retriever = Retriever(persist_directory=self.index_dir)
+
+        self.assertEqual(retriever.similarity_search("what is CBT", k=1)[0].page_content, self.texts[1])
+
+
+    @override_settings(RAG_INDEX_CHECK_INTERVAL=0, RAG_HYBRID_SEARCH=True, RAG_HYBRID_CANDIDATES=1, RAG_MMR_CANDIDATES=0)
+    def test_keyword_matches_get_their_cosine_similarity(self):
+        for vector_index in ("chroma", "mmap"):
+            with self.settings(RAG_VECTOR_INDEX=vector_index):
+                if vector_index == "mmap":
+                    build_mmap_index(self.index_dir, self.store._collection, "text-embedding-ada-002", self.chunk_store)
+                retriever = Retriever(persist_directory=self.index_dir)
+
+                scored = retriever.similarity_search_with_scores("what is CBT", k=2)
+
+            # One vector candidate, so one of the two is a keyword-only match
+            self.assertEqual(len(scored), 2)
+
+            query = np.asarray(self.embeddings.embed_query("what is CBT"))
+            for document, score in scored:
+                vector = np.asarray(self.embeddings.embed_query(document.page_content))
+                expected = vector @ query / np.linalg.norm(vector) / np.linalg.norm(query)
+                self.assertAlmostEqual(score, expected, places=2)
+            self.assertIn(self.texts[1], [document.page_content for document, score in scored])
+
+
+class FakeCollection:
+    """
+    Just enough of a Chroma collection for building mmap indexes. It holds the
+    given rows of vectors (all of them by default), as chunks "row-<row>".
+    """
+
+    def __init__(self, vectors, metadata=None, rows=None):
+        self.vectors = vectors
+        self.metadata = metadata
+        self.rows = list(range(len(vectors))) if rows is None else list(rows)
+
+    def get(self, include=None, limit=None, offset=0, ids=None):
+        if ids is None:
+            rows = self.rows[offset:offset + limit]
+        else:
+            present = set(self.rows)
+            rows = [row for row in (int(chunk_id.split("-")[1]) for chunk_id in ids) if row in present]
+        return {
+            "ids": [f"row-{row}" for row in rows],
+            "embeddings": [self.vectors[row] for row in rows],
+            "documents": [f"text {row}" for row in rows],
+            "metadatas": [{"row": row} for row in rows],
+        }
+
+
+class IvfIndexTest(TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.index_dir, ignore_errors=True)
+        rng = np.random.default_rng(1)
+        # Three well separated topics of 300 chunks each
+        self.centers = np.eye(16)[:3]
+        self.vectors = np.concatenate([center + rng.normal(scale=0.05, size=(300, 16)) for center in self.centers])
+        self.chunk_store = ChunkStore(os.path.join(self.index_dir, "chunks"))
+        self.meta = build_mmap_index(self.index_dir, FakeCollection(self.vectors), "test-model", self.chunk_store, nlist=3)
+
+    def open(self, nprobe):
+        return MmapIndex.open(self.index_dir, None, self.chunk_store, nprobe=nprobe)
+
+    def test_rows_are_grouped_by_cluster(self):
+        index = self.open(nprobe=1)
+
+        self.assertEqual(self.meta["nlist"], 3)
+        self.assertEqual(sorted(np.diff(index.lists).tolist()), [300, 300, 300])
+        # Ids moved together with their vectors
+        for row in (0, 450, 899):
+            original = int(index.id_table.id(row).split("-")[1])
+            self.assertTrue(np.allclose(index.vectors[row], self.vectors[original] / np.linalg.norm(self.vectors[original]), atol=1e-2))
+
+    def test_rows_are_found_by_chunk_id(self):
+        index = self.open(nprobe=1)
+
+        found = index.vectors_by_ids(["row-450", "row-7", "missing"])
+
+        self.assertEqual(set(found), {"row-450", "row-7"})
+        for chunk_id, vector in found.items():
+            original = self.vectors[int(chunk_id.split("-")[1])]
+            self.assertTrue(np.allclose(vector, original / np.linalg.norm(original), atol=1e-2))
+
+    def test_probing_one_cluster_finds_the_exact_results(self):
+        exact = self.open(nprobe=3)
+        probed = self.open(nprobe=1)
+
+        for query in self.vectors[[5, 305, 605]]:
+            self.assertEqual(
+                [row for row, score in probed.top_k(query, 3)],
+                [row for row, score in exact.top_k(query, 3)],
+            )
+            self.assertEqual(len(probed.scores(query)[0]), 300)
+
+    def test_text_of_the_hits_comes_from_the_chunk_store(self):
+        index = self.open(nprobe=1)
+
+        [(document, score)] = index.similarity_search_by_vector_with_score(self.vectors[450], k=1)
+
+        self.assertEqual(document.page_content, "text 450")
+        self.assertEqual(document.id, "row-450")
+        self.assertFalse(os.path.exists(os.path.join(index.build_dir, "records.bin")))
+
+    def test_update_adds_a_delta_to_the_previous_build(self):
+        previous = read_pointer(self.index_dir)
+        rng = np.random.default_rng(2)
+        vectors = np.concatenate([self.vectors, self.centers[2] + rng.normal(scale=0.05, size=(20, 16))])
+        collection = FakeCollection(vectors, rows=[row for row in range(920) if row not in (5, 305)])
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+
+        meta = build_mmap_index(index_dir, collection, "test-model", self.chunk_store, nlist=3, previous=previous)
+
+        self.assertEqual((meta["count"], meta["delta"], meta["deleted"], meta["nlist"]), (918, 20, 2, 3))
+        build_dir = read_pointer(index_dir)
+        for name in ("vectors.bin", "centroids.bin", "lists.bin"):
+            self.assertTrue(os.path.samefile(os.path.join(previous, name), os.path.join(build_dir, name)))
+        self.assertEqual(self.chunk_store.get("row-905"), ("text 905", None))
+
+        exact = MmapIndex.open(index_dir, None, self.chunk_store, nprobe=3)
+        probed = MmapIndex.open(index_dir, None, self.chunk_store, nprobe=1)
+        [(document, score)] = exact.similarity_search_by_vector_with_score(vectors[905], k=1)
+        self.assertEqual(document.id, "row-905")
+        self.assertEqual(
+            [row for row, score in probed.top_k(vectors[905], 5)], [row for row, score in exact.top_k(vectors[905], 5)]
+        )
+        self.assertEqual(len(probed.scores(vectors[305])[0]), 299)
+        self.assertEqual(len(probed.scores(vectors[605])[0]), 320)
+        self.assertEqual(set(exact.vectors_by_ids(["row-5", "row-6", "row-910"])), {"row-6", "row-910"})
+        self.assertNotIn("row-305", [document.id for document, score in exact.similarity_search_by_vector_with_score(
+            vectors[305], k=3
+        )])
+
+    def test_large_changes_make_a_full_build(self):
+        previous = read_pointer(self.index_dir)
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+
+        meta = build_mmap_index(
+            index_dir, FakeCollection(self.vectors, rows=range(600)), "test-model", self.chunk_store, nlist=2,
+            previous=previous,
+        )
+
+        self.assertEqual((meta["count"], meta["base"], meta["delta"], meta["nlist"]), (600, 600, 0, 2))
+        self.assertFalse(os.path.samefile(
+            os.path.join(previous, "vectors.bin"), os.path.join(read_pointer(index_dir), "vectors.bin")
+        ))
+
+    def test_small_indexes_are_not_clustered(self):
+        meta = build_mmap_index(
+            self.index_dir, FakeCollection(self.vectors[:10]), "test-model", self.chunk_store, min_rows=100
+        )
+
+        self.assertEqual(meta["nlist"], 0)
+        self.assertEqual(len(self.open(nprobe=1).scores(self.vectors[0])[0]), 10)
+
+
+class MmrRerankTest(RagTestCase):
+    def test_near_duplicates_make_room_for_other_results(self):
+        vectors = np.array([[1.0, 0.0], [0.99, 0.141], [0.6, 0.8]])
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        self.assertEqual(maximal_marginal_relevance([0.9, 0.89, 0.7], vectors, 2, lambda_mult=0.5), [0, 2])
+        self.assertEqual(maximal_marginal_relevance([0.9, 0.89, 0.7], vectors, 2, lambda_mult=1.0), [0, 1])
+        self.assertEqual(maximal_marginal_relevance([0.9, 0.89, 0.7], vectors, 5), [0, 2, 1])
+
+    @override_settings(RAG_INDEX_CHECK_INTERVAL=0, RAG_HYBRID_SEARCH=False, RAG_MMR_CANDIDATES=4)
+    def test_retriever_reranks_a_larger_candidate_set(self):
+        texts = ["Breathing exercises help with anxiety.", "Sleep hygiene improves mood.", "Exercise lifts mood."]
+        store = Chroma(collection_name="documents", persist_directory=self.index_dir, embedding_function=self.embeddings)
+        store.add_texts(texts, metadatas=[{"id": "1", "page": page} for page in range(3)])
+        mark_index_updated(self.index_dir)
+        metrics.reset()
+
+        results = Retriever(persist_directory=self.index_dir).similarity_search_with_scores(texts[0], k=2)
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0][0].page_content, texts[0])
+        self.assertEqual(results[0][0].metadata, {"id": "1", "page": 0})
+        self.assertEqual(metrics.snapshot()["histograms"]["rag.rerank_ms"]["count"], 1)
+
+
+class ChunkStoreTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_chunks_are_read_back_by_id(self):
+        for compression in ("zlib", "none"):
+            directory = os.path.join(self.directory, compression)
+            store = ChunkStore(directory, compression=compression)
+
+            written = store.append(["1:a:0", "1:b:0", "1:a:0"], [("first", 0), ("second é", 3), ("first", 0)])
+            self.assertEqual(written, 2)
+            self.assertEqual(store.append(["1:a:0"], [("first", 0)]), 0)
+
+            reopened = ChunkStore(directory)
+            self.assertEqual(len(reopened), 2)
+            self.assertEqual(reopened.get("1:b:0"), ("second é", 3))
+            self.assertEqual(reopened.get_many(["1:a:0", "1:b:0"]), [("first", 0), ("second é", 3)])
+            self.assertIsNone(reopened.get("missing"))
+            self.assertIsNone(reopened.get_many(["1:a:0", "missing"]))
+
+    def test_text_is_compressed(self):
+        text = "Breathing exercises help with anxiety. " * 100
+        store = ChunkStore(self.directory)
+        store.append(["1:a:0"], [(text, 0)])
+
+        self.assertLess(store.size_bytes(), len(text) // 5)
+
+    def test_readers_see_later_appends(self):
+        reader = ChunkStore(self.directory)
+        writer = ChunkStore(self.directory)
+        writer.append(["1:a:0"], [("first", 0)])
+        self.assertEqual(reader.get("1:a:0"), ("first", 0))
+
+        writer.append(["1:b:0"], [("second", 1)])
+
+        self.assertEqual(reader.get("1:b:0"), ("second", 1))
+
+    def test_compaction_keeps_only_referenced_chunks(self):
+        writer = ChunkStore(self.directory)
+        writer.append(["1:a:0", "1:b:0", "2:a:0", "2:b:0"], [("one", 0), ("two", 1), ("three", 0), ("four", 1)])
+        reader = ChunkStore(self.directory)
+        self.assertEqual(reader.get("1:a:0"), ("one", 0))
+        size = writer.size_bytes()
+
+        self.assertEqual(writer.compact({"1:a:0", "1:b:0"}), 2)
+        writer.append(["3:a:0"], [("five", 0)])
+
+        self.assertLess(writer.size_bytes(), size)
+        self.assertEqual(len(ChunkStore(self.directory)), 3)
+        self.assertEqual(reader.get("1:b:0"), ("two", 1))
+        self.assertEqual(reader.get("3:a:0"), ("five", 0))
+        self.assertIsNone(reader.get("2:a:0"))
+
+    def test_a_few_unreferenced_chunks_are_left_alone(self):
+        store = ChunkStore(self.directory)
+        store.append([f"1:{i}:0" for i in range(5)], [(f"text {i}", i) for i in range(5)])
+
+        self.assertEqual(store.compact({f"1:{i}:0" for i in range(4)}), 0)
+        self.assertEqual(len(store), 5)
+
+    def test_partial_index_record_is_ignored(self):
+        ChunkStore(self.directory).append(["1:a:0"], [("first", 0)])
+        with open(os.path.join(self.directory, "chunks.idx"), "ab") as f:
+            f.write(b"\x00\x01")
+
+        store = ChunkStore(self.directory)
+
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get("1:a:0"), ("first", 0))
+
+
+class QueryEmbeddingCacheTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.path = f"{self.cache_dir}/query_embeddings.sqlite3"
+        self.embeddings = CountingEmbeddings(size=8)
+
+    def make_cache(self, **kwargs):
+        return CachedQueryEmbeddings(
+            self.embeddings, model="test-model", memory_size=2, disk_cache=DiskVectorCache(self.path, **kwargs)
+        )
+
+    def test_repeated_query_is_served_from_memory(self):
+        cache = self.make_cache()
+
+        first = cache.embed_query("I feel anxious")
+        second = cache.embed_query("  i FEEL   anxious ")
+
+        self.assertEqual(self.embeddings.calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats()["memory_hits"], 1)
+
+    def test_disk_tier_is_shared_between_workers(self):
+        self.make_cache().embed_query("I feel anxious")
+
+        vector = self.make_cache().embed_query("I feel anxious")
+
+        self.assertEqual(self.embeddings.calls, 1)
+        self.assertEqual(len(vector), 8)
+        self.assertEqual(metrics.snapshot()["counters"]["rag.query_embedding_cache.disk_hits"], 1)
+
+    def test_async_disk_tier_runs_off_the_event_loop(self):
+        self.make_cache().embed_query("I feel anxious")
+        cache = self.make_cache()
+        threads = []
+        get = cache.disk.get
+
+        def record_thread(key):
+            threads.append(threading.current_thread())
+            return get(key)
+
+        with patch.object(cache.disk, "get", side_effect=record_thread):
+            vector = asyncio.run(cache.aembed_query("I feel anxious"))
+
+        self.assertEqual(len(vector), 8)
+        self.assertEqual(self.embeddings.calls, 1)
+        self.assertNotEqual(threads, [threading.main_thread()])
+
+    def test_memory_tier_is_bounded(self):
+        cache = self.make_cache()
+        for text in ("one", "two", "three"):
+            cache.embed_query(text)
+
+        self.assertEqual(len(cache.memory), 2)
+
+    def test_disk_tier_is_evicted_by_size(self):
+        disk = DiskVectorCache(self.path, max_bytes=8 * 4 * 10)
+        disk.set_many([(f"key-{i}", [0.0] * 8) for i in range(100)])
+        disk.evict()
+
+        self.assertLessEqual(disk.size_bytes(), 8 * 4 * 10)
+
+
+class QueryBatchingTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.embeddings = CountingEmbeddings(size=8)
+
+    def test_concurrent_queries_share_one_call(self):
+        batcher = BatchingEmbeddings(self.embeddings, max_wait_ms=5000, max_size=4)
+        texts = ["one", "two", "three", "one"]
+        release = threading.Event()
+        embed_documents = CountingEmbeddings.embed_documents
+
+        def slow_embed_documents(texts):
+            release.wait(5)
+            return embed_documents(self.embeddings, texts)
+
+        # The queries arrive while the first one is still being embedded
+        with patch.object(CountingEmbeddings, "embed_documents", side_effect=slow_embed_documents), \
+                ThreadPoolExecutor(max_workers=5) as pool:
+            first = pool.submit(batcher.embed_query, "zero")
+            while not batcher._in_flight:
+                time.sleep(0.001)
+            queries = [pool.submit(batcher.embed_query, text) for text in texts]
+            while batcher._in_flight < 5:
+                time.sleep(0.001)
+            release.set()
+            first.result()
+            vectors = [query.result() for query in queries]
+
+        self.assertEqual(self.embeddings.calls, 2)
+        self.assertEqual(self.embeddings.texts_embedded, 4)
+        self.assertEqual(vectors, [CountingEmbeddings(size=8).embed_query(text) for text in texts])
+        histograms = metrics.snapshot()["histograms"]
+        self.assertEqual(histograms["rag.query_batch.size"]["max"], 4)
+        self.assertEqual(histograms["rag.query_batch.wait_ms"]["count"], 2)
+
+    def test_async_queries_are_batched_on_the_event_loop(self):
+        batcher = BatchingEmbeddings(self.embeddings, max_wait_ms=5000, max_size=3)
+
+        async def turns():
+            return await asyncio.gather(*(batcher.aembed_query(text) for text in ("one", "two", "one")))
+
+        # The blocking path is never used
+        with patch.object(BatchingEmbeddings, "embed_query", side_effect=AssertionError):
+            vectors = asyncio.run(turns())
+
+        self.assertEqual(self.embeddings.calls, 1)
+        self.assertEqual(self.embeddings.texts_embedded, 2)
+        self.assertEqual(vectors, [CountingEmbeddings(size=8).embed_query(text) for text in ("one", "two", "one")])
+
+    def test_lone_async_query_is_sent_after_the_wait(self):
+        batcher = BatchingEmbeddings(self.embeddings, max_wait_ms=1, max_size=4)
+
+        self.assertEqual(len(asyncio.run(batcher.aembed_query("one"))), 8)
+        self.assertEqual(metrics.snapshot()["histograms"]["rag.query_batch.size"]["max"], 1)
+
+    def test_lone_query_is_sent_without_waiting(self):
+        batcher = BatchingEmbeddings(self.embeddings, max_wait_ms=5000, max_size=4)
+
+        self.assertEqual(len(batcher.embed_query("one")), 8)
+        self.assertEqual(self.embeddings.calls, 1)
+        self.assertLess(metrics.snapshot()["histograms"]["rag.query_batch.wait_ms"]["max"], 1000)
+        self.assertEqual(batcher._in_flight, 0)
+
+    def test_errors_reach_every_caller(self):
+        batcher = BatchingEmbeddings(self.embeddings, max_wait_ms=50, max_size=2)
+
+        with patch.object(CountingEmbeddings, "embed_documents", side_effect=RuntimeError("rate limited")):
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                futures = [pool.submit(batcher.embed_query, text) for text in ("one", "two")]
+                for future in futures:
+                    with self.assertRaisesMessage(RuntimeError, "rate limited"):
+                        future.result()
+
+
+class ContentAddressedEmbeddingsTest(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.embeddings = CountingEmbeddings(size=8)
+        self.store = ContentAddressedEmbeddings(
+            self.embeddings, model="test-model", store=DiskVectorCache(f"{self.cache_dir}/chunks.sqlite3")
+        )
+
+    def test_only_new_chunks_are_embedded(self):
+        first = self.store.embed_documents(["chunk a", "chunk b"])
+        second = self.store.embed_documents(["chunk b", "chunk c", "chunk c"])
+
+        self.assertEqual(self.embeddings.texts_embedded, 3)
+        # Stored vectors are float32
+        self.assertTrue(np.allclose(first[1], second[0]))
+        self.assertEqual(second[1], second[2])
+
+    def test_unchanged_corpus_makes_no_calls(self):
+        self.store.embed_documents(["chunk a", "chunk b"])
+        calls = self.embeddings.calls
+
+        self.store.embed_documents(["chunk a", "chunk b"])
+
+        self.assertEqual(self.embeddings.calls, calls)
+
+
+class FakeSession:
+    """
+    Stands in for an ONNX Runtime session: the hidden state of a token is the
+    one-hot vector of its id.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="input_ids"), SimpleNamespace(name="attention_mask")]
+
+    def run(self, outputs, inputs):
+        return [np.eye(self.size, dtype=np.float32)[inputs["input_ids"]]]
+
+
+class OnnxEmbeddingsTest(TestCase):
+    def setUp(self):
+        model_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, model_dir, ignore_errors=True)
+        vocab = {"[PAD]": 0, "[UNK]": 1, "i": 2, "feel": 3, "anxious": 4, "calm": 5}
+        tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+        tokenizer.pre_tokenizer = Whitespace()
+        tokenizer.save(f"{model_dir}/tokenizer.json")
+        self.embeddings = OnnxEmbeddings(model_dir=model_dir, batch_size=2)
+        self.embeddings.session = FakeSession(len(vocab))
+
+    def test_vectors_are_mean_pooled_and_normalized(self):
+        vector = np.array(self.embeddings.embed_query("i feel"))
+
+        self.assertAlmostEqual(float(np.linalg.norm(vector)), 1.0, places=5)
+        self.assertTrue(np.allclose(vector[2:4], 2 ** -0.5))
+
+    def test_padding_and_batching_do_not_change_vectors(self):
+        texts = ["i feel anxious calm", "calm", "i feel", "anxious"]
+
+        vectors = self.embeddings.embed_documents(texts)
+
+        for text, vector in zip(texts, vectors):
+            self.assertTrue(np.allclose(vector, self.embeddings.embed_query(text)))
+
+    def test_custom_model_dir_needs_a_model_name(self):
+        with self.settings(RAG_EMBEDDING_BACKEND="onnx", RAG_ONNX_MODEL_DIR="/models/e5-small", RAG_EMBEDDING_MODEL=""):
+            with self.assertRaises(ImproperlyConfigured):
+                get_embedding_model()
+        with self.settings(RAG_EMBEDDING_BACKEND="onnx", RAG_ONNX_MODEL_DIR="/models/e5-small", RAG_EMBEDDING_MODEL="e5-small"):
+            self.assertEqual(get_embedding_model(), "e5-small")
+
+
+def byte_encoding():
+    """
+    One token per byte, so chunker tests need no downloaded vocabulary.
+    """
+    return tiktoken.Encoding(
+        name="bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={}
+    )
+
+
+class TokenChunkerTest(TestCase):
+    def chunk(self, pages, **kwargs):
+        chunker = TokenChunker(byte_encoding(), **kwargs)
+        chunks = []
+        for page, text in enumerate(pages):
+            chunks.extend(chunker.add(text, page))
+        chunks.extend(chunker.flush())
+        return chunks
+
+    def test_short_pages_are_merged(self):
+        chunks = self.chunk(["First page.", "Second page."], max_tokens=100)
+
+        self.assertEqual(chunks, [("First page.\nSecond page.", 0)])
+
+    def test_chunks_end_at_sentence_breaks(self):
+        chunks = self.chunk(["One two three. Four five six seven eight"], max_tokens=24)
+
+        self.assertEqual(chunks[0], ("One two three.", 0))
+        self.assertTrue(all(len(text) <= 24 for text, page in chunks))
+
+    def test_consecutive_chunks_overlap(self):
+        chunks = self.chunk(["abcdefghijklmnopqrstuvwxyz"], max_tokens=10, overlap=3)
+
+        self.assertEqual([text for text, page in chunks], ["abcdefghij", "hijklmnopq", "opqrstuvwx", "vwxyz"])
+
+    def test_each_page_is_encoded_once(self):
+        encoding = byte_encoding()
+        chunker = TokenChunker(encoding, max_tokens=8, overlap=2)
+        with patch.object(encoding, "encode_ordinary", wraps=encoding.encode_ordinary) as encode:
+            for page in range(5):
+                list(chunker.add(f"Page {page} has some text.", page))
+            chunks = list(chunker.flush())
+
+        self.assertEqual(encode.call_count, 5)
+        self.assertEqual(chunks[-1][1], 4)
+
+
+def chunk(text, doc_id="1"):
+    return LangChainDocument(page_content=text, metadata={"id": doc_id, "page": 0})
+
+
+@override_settings(
+    RAG_CONTEXT_MIN_SCORE=0.7,
+    RAG_CONTEXT_SCORE_MARGIN=0.05,
+    RAG_CONTEXT_DEDUP_THRESHOLD=0.7,
+    RAG_CONTEXT_TOKEN_BUDGET=1000,
+)
+@patch("rag.context.get_encoding", new=byte_encoding)
+class ContextAssemblyTest(TestCase):
+    def test_weak_matches_are_dropped(self):
+        context = assemble_context([
+            (chunk("Breathing slowly calms the body."), 0.9),
+            (chunk("Grounding uses the five senses."), 0.87),
+            (chunk("Sleep needs a regular schedule."), 0.8),
+            (chunk("Tax returns are due in April."), 0.5),
+        ])
+
+        self.assertEqual(context.chunks, 2)
+        self.assertEqual(context.text, "Breathing slowly calms the body.\nGrounding uses the five senses.")
+        self.assertEqual(context.tokens, len(context.text))
+
+    def test_threshold_defaults_to_the_embedding_models(self):
+        scored = [(chunk("Breathing slowly calms the body."), 0.42)]
+
+        with self.settings(RAG_CONTEXT_MIN_SCORE=None, RAG_EMBEDDING_BACKEND="onnx", RAG_EMBEDDING_MODEL=""):
+            self.assertEqual(assemble_context(scored).chunks, 1)
+        with self.settings(RAG_CONTEXT_MIN_SCORE=None, RAG_EMBEDDING_BACKEND="openai", RAG_EMBEDDING_MODEL=""):
+            self.assertEqual(assemble_context(scored).chunks, 0)
+
+    def test_matches_without_a_score_are_dropped(self):
+        context = assemble_context([(chunk("Breathing slowly calms the body."), 0.9), (chunk("What is CBT?"), None)])
+
+        self.assertEqual(context.chunks, 1)
+
+    def test_nothing_relevant_gives_no_context(self):
+        self.assertEqual(assemble_context([(chunk("Tax returns are due in April."), 0.5)]), (NO_CONTEXT, 0, 0))
+        self.assertEqual(assemble_context([]), (NO_CONTEXT, 0, 0))
+
+    def test_chunk_overlap_is_sent_once(self):
+        first = "one two three four five six seven eight nine ten eleven twelve"
+        second = "five six seven eight nine ten eleven twelve thirteen fourteen"
+
+        context = assemble_context([(chunk(second), 0.9), (chunk(first), 0.9)])
+
+        self.assertEqual(context.text, f"{second}\none two three four")
+
+    def test_overlap_of_other_documents_is_kept(self):
+        first = "one two three four five six seven eight nine ten eleven twelve"
+        second = "five six seven eight nine ten eleven twelve thirteen fourteen fifteen sixteen seventeen eighteen"
+
+        context = assemble_context([(chunk(first, "1"), 0.9), (chunk(second, "2"), 0.9)])
+
+        self.assertEqual(context.text, f"{first}\n{second}")
+
+    def test_near_duplicates_are_dropped(self):
+        text = "Breathing slowly for a few minutes calms the body and the mind. Try it before bed."
+
+        context = assemble_context([
+            (chunk(text, "1"), 0.9),
+            (chunk(text.replace("calms", "relaxes"), "2"), 0.89),
+        ])
+
+        self.assertEqual(context.text, text)
+
+    def test_context_fits_the_token_budget(self):
+        sentences = " ".join(f"Sentence number {i} is here." for i in range(40))
+
+        with self.settings(RAG_CONTEXT_TOKEN_BUDGET=300):
+            context = assemble_context([(chunk(sentences, "1"), 0.9), (chunk(sentences[::-1], "2"), 0.9)])
+
+        self.assertLessEqual(context.tokens, 300)
+        self.assertEqual(context.chunks, 1)
+        self.assertTrue(context.text.endswith("."))
+
+
+class SlowRetriever:
+    """
+    Retriever that blocks until released, then finds one chunk.
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.finished = threading.Event()
+
+    def similarity_search_with_scores(self, query, k=4):
+        self.release.wait(5)
+        self.finished.set()
+        return [(chunk("Breathing slowly calms the body."), 0.9)]
+
+    async def asimilarity_search_with_scores(self, query, k=4):
+        return await asyncio.to_thread(self.similarity_search_with_scores, query, k)
+
+
+@override_settings(RAG_RETRIEVAL_TIMEOUT=0.05, RAG_CONTEXT_MIN_SCORE=0.7)
+@patch("rag.context.get_encoding", new=byte_encoding)
+class RetrievalDeadlineTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.retriever = SlowRetriever()
+        patcher = patch("rag.context.get_retriever", return_value=self.retriever)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.retriever.release.set)
+
+    def test_slow_retrieval_gives_no_context(self):
+        self.assertEqual(retrieve_context("breathing"), (NO_CONTEXT, 0, 0))
+        self.assertEqual(metrics.snapshot()["counters"]["rag.context.deadline_exceeded"], 1)
+
+        # It finishes in the background
+        self.retriever.release.set()
+        self.assertTrue(self.retriever.finished.wait(5))
+
+    def test_async_slow_retrieval_gives_no_context(self):
+        async def turn():
+            context = await aretrieve_context("breathing")
+            self.retriever.release.set()
+            # The event loop keeps the retrieval running past the deadline
+            await asyncio.sleep(0.1)
+            return context
+
+        self.assertEqual(asyncio.run(turn()), (NO_CONTEXT, 0, 0))
+        self.assertTrue(self.retriever.finished.is_set())
+        self.assertEqual(metrics.snapshot()["counters"]["rag.context.deadline_exceeded"], 1)
+
+    def test_retrieval_in_time_is_used(self):
+        self.retriever.release.set()
+
+        self.assertEqual(retrieve_context("breathing").text, "Breathing slowly calms the body.")
+        self.assertNotIn("rag.context.deadline_exceeded", metrics.snapshot()["counters"])
+
+    def test_failed_retrieval_gives_no_context(self):
+        with patch.object(SlowRetriever, "similarity_search_with_scores", side_effect=RuntimeError("index gone")):
+            self.assertEqual(retrieve_context("breathing"), (NO_CONTEXT, 0, 0))
+        self.assertEqual(metrics.snapshot()["counters"]["rag.context.retrieval_failed"], 1)
+
+    def test_full_pool_gives_no_context_at_once(self):
+        pool = RetrievalPool(2)
+        with patch("rag.context._retrieval_pool", return_value=pool):
+            retrieve_context("breathing")
+            retrieve_context("sleep")
+            with patch.object(pool.executor, "submit", side_effect=AssertionError):
+                self.assertEqual(retrieve_context("anxiety"), (NO_CONTEXT, 0, 0))
+                self.assertEqual(asyncio.run(aretrieve_context("anxiety")), (NO_CONTEXT, 0, 0))
+                # The same query joins the retrieval already running
+                self.assertEqual(retrieve_context("  Breathing "), (NO_CONTEXT, 0, 0))
+
+            self.retriever.release.set()
+            # Wait for both slots to be given back
+            for _ in range(2):
+                self.assertTrue(pool.slots.acquire(timeout=5))
+            pool.slots.release()
+            pool.slots.release()
+            self.assertEqual(retrieve_context("anxiety").text, "Breathing slowly calms the body.")
+
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["rag.context.busy"], 2)
+        self.assertEqual(counters["rag.context.retrievals_merged"], 1)
+        self.assertEqual(counters["rag.context.deadline_exceeded"], 3)
+
+
+def fake_pdf_batches(file_path, batch_size, max_tokens=None, overlap=0):
+    """
+    Stand-in for PDF parsing: every line of the file is one page with one chunk,
+    and a line reading "FAIL" raises like a corrupt page would.
+    """
+    with open(file_path, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    batch = []
+    for page, line in enumerate(lines):
+        if line == "FAIL":
+            raise ValueError("Corrupt page")
+        batch.append((line, page))
+        if len(batch) == batch_size:
+            yield len(batch), batch
+            batch = []
+    yield len(batch), batch
+
+
+@override_settings(RAG_PARSE_WORKERS=0)
+class IngestionTestCase(RagTestCase):
+    def setUp(self):
+        super().setUp()
+        self.media_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_dir, ignore_errors=True)
+        self.embeddings = CountingEmbeddings(size=16)
+        for target, value in (
+            ("rag.utils.CHROMA_DB_DIR", self.index_dir),
+            ("rag.utils.iter_pdf_batches", fake_pdf_batches),
+            ("rag.utils.get_document_embeddings", lambda model=None: self.embeddings),
+        ):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        media = override_settings(MEDIA_ROOT=self.media_dir, RAG_CHUNK_STORE_DIR=os.path.join(self.media_dir, "chunks"))
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def add_document(self, title, text):
+        document = Document(title=title)
+        document.file.save(f"{title}.txt", ContentFile(text.encode("utf-8")))
+        return document
+
+    def live(self):
+        return live_generation(self.index_dir)
+
+    def collection_ids(self):
+        store = Chroma(collection_name="documents", persist_directory=self.live(), embedding_function=self.embeddings)
+        return set(store.get()["ids"])
+
+    def chunk_ids(self, document, lines):
+        """
+        Ids of the chunks fake_pdf_batches makes of lines.
+        """
+        return set(document_chunk_ids(document.id, [(line, page) for page, line in enumerate(lines)], Counter()))
+
+
+class IncrementalIngestionTest(IngestionTestCase):
+    def test_unchanged_documents_are_skipped(self):
+        self.add_document("first", "one\ntwo")
+        self.add_document("second", "three")
+        self.assertEqual(ingest_documents()["added"], 2)
+        calls = self.embeddings.calls
+
+        summary = ingest_documents()
+
+        self.assertEqual(summary["unchanged"], 2)
+        self.assertEqual(summary["added"], 0)
+        self.assertEqual(self.embeddings.calls, calls)
+        self.assertEqual(len(self.collection_ids()), 3)
+
+    def test_changed_document_replaces_its_chunks(self):
+        document = self.add_document("first", "one\ntwo\nthree")
+        ingest_documents()
+
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("uno")
+        summary = ingest_documents()
+
+        self.assertEqual(summary["updated"], 1)
+        self.assertEqual(self.collection_ids(), self.chunk_ids(document, ["uno"]))
+
+    def test_unchanged_chunks_are_not_rewritten(self):
+        document = self.add_document("book", "one\ntwo")
+        ingest_documents()
+        ids = self.collection_ids()
+
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("one\ntwo\nthree")
+        with patch("rag.utils.add_documents_to_chroma", wraps=add_documents_to_chroma) as add:
+            ingest_documents()
+
+        self.assertEqual([doc.page_content for doc in add.call_args.args[0]], ["three"])
+        self.assertEqual(self.collection_ids(), ids | self.chunk_ids(document, ["one", "two", "three"]))
+
+    def test_repeated_chunks_get_distinct_ids(self):
+        ids = document_chunk_ids(7, [("same", 0), ("same", 0), ("other", 0)], Counter())
+
+        self.assertEqual(len(set(ids)), 3)
+        self.assertTrue(all(chunk_id.startswith("7:") for chunk_id in ids))
+        self.assertEqual([chunk_id.rsplit(":", 1)[1] for chunk_id in ids], ["0", "1", "0"])
+
+    def test_removed_document_loses_its_chunks(self):
+        keep = self.add_document("keep", "one")
+        gone = self.add_document("gone", "two\nthree")
+        ingest_documents()
+
+        gone.delete()
+        summary = ingest_documents()
+
+        self.assertEqual(summary["removed"], 1)
+        self.assertEqual(self.collection_ids(), self.chunk_ids(keep, ["one"]))
+
+    def test_changed_chunking_rechunks_everything(self):
+        self.add_document("first", "one")
+        self.add_document("second", "two")
+        ingest_documents()
+
+        with self.settings(RAG_CHUNK_OVERLAP=10):
+            summary = ingest_documents()
+
+        self.assertEqual(summary["updated"], 2)
+        self.assertEqual(IngestionManifest.load(self.live()).chunking["overlap"], 10)
+
+    def test_changed_embedding_model_rebuilds_the_index(self):
+        first = self.add_document("first", "one")
+        ingest_documents()
+
+        with self.settings(RAG_EMBEDDING_MODEL="other-model"):
+            summary = ingest_documents()
+
+        self.assertEqual(summary["added"], 1)
+        self.assertEqual(IngestionManifest.load(self.live()).embedding_model, "other-model")
+        self.assertEqual(self.collection_ids(), self.chunk_ids(first, ["one"]))
+
+    def test_rebuild_reads_chunks_from_the_chunk_store(self):
+        first = self.add_document("first", "one\ntwo")
+        second = self.add_document("second", "three")
+        ingest_documents()
+        with open(second.file.path, "w", encoding="utf-8") as f:
+            f.write("four")
+
+        with self.settings(RAG_EMBEDDING_MODEL="other-model"), \
+                patch("rag.utils.iter_pdf_batches", side_effect=fake_pdf_batches) as parse:
+            summary = ingest_documents()
+
+        # Only the changed document is parsed again
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(summary["replayed"], 1)
+        self.assertEqual(summary["added"], 2)
+        self.assertEqual(
+            self.collection_ids(), self.chunk_ids(first, ["one", "two"]) | self.chunk_ids(second, ["four"])
+        )
+
+    @override_settings(RAG_VECTOR_INDEX="mmap")
+    def test_ingestion_exports_the_mmap_index(self):
+        self.add_document("first", "one\ntwo")
+
+        ingest_documents()
+
+        self.assertEqual(MmapIndex.open(self.live(), self.embeddings).count, 2)
+
+    @override_settings(RAG_VECTOR_INDEX="mmap", RAG_HYBRID_SEARCH=True, RAG_INDEX_CHECK_INTERVAL=0)
+    def test_derived_indexes_are_updated_with_the_changes(self):
+        self.add_document("first", "\n".join(f"page {i}" for i in range(8)))
+        gone = self.add_document("gone", "sadness")
+        ingest_documents()
+        previous = (MmapIndex.open(self.live(), self.embeddings).build_dir, LexicalIndex.open(self.live()).build_dir)
+
+        gone.delete()
+        self.add_document("second", "gratitude")
+        ingest_documents()
+
+        index = MmapIndex.open(self.live(), self.embeddings)
+        lexical = LexicalIndex.open(self.live())
+        self.assertEqual((index.count, index.meta["delta"], index.meta["deleted"]), (9, 1, 1))
+        self.assertEqual((lexical.count, lexical.meta["delta"], lexical.meta["deleted"]), (9, 1, 1))
+        self.assertTrue(os.path.samefile(
+            os.path.join(previous[0], "vectors.bin"), os.path.join(index.build_dir, "vectors.bin")
+        ))
+        self.assertTrue(os.path.samefile(
+            os.path.join(previous[1], "postings.bin"), os.path.join(lexical.build_dir, "postings.bin")
+        ))
+        retriever = Retriever(persist_directory=self.index_dir)
+        texts = {document.page_content for document in retriever.similarity_search("gratitude", k=10)}
+        self.assertIn("gratitude", texts)
+        self.assertNotIn("sadness", texts)
+
+    def test_parse_pool_results_are_indexed(self):
+        document = self.add_document("first", "one\ntwo")
+
+        # Threads stand in for the spawned processes, which cannot see patches
+        executor = lambda workers, queue: ThreadPoolExecutor(workers, initializer=set_event_queue, initargs=(queue,))
+        with patch("rag.parsing.iter_pdf_batches", fake_pdf_batches), patch("rag.utils.parse_executor", executor):
+            summary = ingest_documents(workers=2, batch_size=2)
+
+        self.assertEqual(summary["added"], 1)
+        self.assertEqual(self.collection_ids(), self.chunk_ids(document, ["one", "two"]))
+
+    def test_documents_are_written_in_batches(self):
+        document = self.add_document("book", "\n".join(f"page {i}" for i in range(5)))
+
+        with patch("rag.utils.add_documents_to_chroma", wraps=add_documents_to_chroma) as add:
+            summary = ingest_documents(batch_size=2)
+
+        self.assertEqual([len(call.args[0]) for call in add.call_args_list], [2, 2, 1])
+        self.assertEqual(len(self.collection_ids()), 5)
+        self.assertEqual(
+            IngestionManifest.load(self.live()).get(document.id)["chunk_ids"][-1],
+            document_chunk_ids(document.id, [("page 4", 4)], Counter())[0],
+        )
+        self.assertGreater(summary["peak_rss_mb"], 0)
+
+    def test_failure_midway_keeps_previous_version(self):
+        document = self.add_document("book", "one\ntwo")
+        ingest_documents()
+
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("uno\ndos\ntres\nFAIL")
+        summary = ingest_documents(batch_size=1)
+
+        self.assertEqual(summary["failed"], 1)
+        self.assertEqual(self.collection_ids(), self.chunk_ids(document, ["one", "two"]))
+
+
+@override_settings(RAG_INDEX_CHECK_INTERVAL=0, RAG_INDEX_GENERATIONS=2)
+class IndexGenerationTest(IngestionTestCase):
+    def generations(self):
+        return sorted(entry for entry in os.listdir(self.index_dir) if entry.startswith("gen-"))
+
+    def test_changes_go_live_in_a_new_generation(self):
+        document = self.add_document("book", "one")
+        ingest_documents()
+        first = self.live()
+        retriever = Retriever(persist_directory=self.index_dir)
+        self.assertEqual(retriever.similarity_search("one", k=1)[0].page_content, "one")
+
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("uno")
+        ingest_documents()
+
+        self.assertNotEqual(self.live(), first)
+        self.assertTrue(os.path.isdir(first))
+        self.assertEqual(retriever.similarity_search("uno", k=1)[0].page_content, "uno")
+
+    def test_unchanged_index_is_not_copied(self):
+        self.add_document("book", "one")
+        ingest_documents()
+        live = self.live()
+
+        ingest_documents()
+
+        self.assertEqual(self.live(), live)
+        self.assertEqual(len(self.generations()), 1)
+
+    def test_rollback_restores_the_previous_generation(self):
+        document = self.add_document("book", "one")
+        ingest_documents()
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("uno")
+        ingest_documents()
+
+        call_command("rollback_vector_index", stdout=StringIO())
+
+        self.assertEqual(self.collection_ids(), self.chunk_ids(document, ["one"]))
+        with self.assertRaises(CommandError):
+            call_command("rollback_vector_index", stdout=StringIO())
+
+    def test_failed_check_keeps_the_live_generation(self):
+        document = self.add_document("book", "one")
+        ingest_documents()
+        live = self.live()
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("uno")
+
+        with patch("rag.utils.check_generation", side_effect=RuntimeError("Incomplete")):
+            with self.assertRaises(RuntimeError):
+                ingest_documents()
+
+        self.assertEqual(self.live(), live)
+        self.assertEqual(self.generations(), [os.path.basename(live)])
+
+    def test_old_generations_are_pruned(self):
+        document = self.add_document("book", "one")
+        for text in ("one", "two", "three"):
+            with open(document.file.path, "w", encoding="utf-8") as f:
+                f.write(text)
+            ingest_documents()
+
+        self.assertEqual(len(self.generations()), 2)
+        self.assertEqual(self.collection_ids(), self.chunk_ids(document, ["three"]))
+
+    def test_chunks_of_pruned_generations_are_compacted_away(self):
+        self.add_document("keep", "one")
+        gone = self.add_document("gone", "two\nthree")
+        ingest_documents()
+        gone_ids = self.chunk_ids(gone, ["two", "three"])
+        gone.delete()
+        ingest_documents()
+
+        # The previous generation, which can be rolled back to, still has them
+        self.assertTrue(all(chunk_id in get_chunk_store() for chunk_id in gone_ids))
+
+        self.add_document("later", "four")
+        ingest_documents()
+
+        store = ChunkStore(os.path.join(self.media_dir, "chunks"))
+        self.assertEqual(len(store), 2)
+        self.assertFalse(any(chunk_id in store for chunk_id in gone_ids))
+
+    def test_index_without_generations_is_replaced(self):
+        self.build_index(["Old text."])
+        document = self.add_document("book", "one")
+
+        ingest_documents()
+
+        # The old layout is kept as the previous generation, until the next one goes live
+        self.assertEqual(self.collection_ids(), self.chunk_ids(document, ["one"]))
+        self.assertTrue(os.path.exists(os.path.join(self.index_dir, "chroma.sqlite3")))
+        with open(document.file.path, "w", encoding="utf-8") as f:
+            f.write("uno")
+        ingest_documents()
+        self.assertFalse(os.path.exists(os.path.join(self.index_dir, "chroma.sqlite3")))
+
+
+PASSAGE = (
+    "It was the best of times, it was the worst of times, it was the age of wisdom, "
+    "it was the age of foolishness, it was the epoch of belief, it was the epoch of "
+    "incredulity, it was the season of Light, it was the season of Darkness, it was "
+    "the spring of hope, it was the winter of despair"
+)
+OTHER_PASSAGE = (
+    "Call me Ishmael. Some years ago, never mind how long precisely, having little or "
+    "no money in my purse, and nothing particular to interest me on shore, I thought I "
+    "would sail about a little and see the watery part of the world"
+)
+
+
+class NearDuplicateTest(IngestionTestCase):
+    def test_minhash_estimates_similarity(self):
+        edition = PASSAGE.replace("the spring of hope", "the spring of hope, ")
+        self.assertGreater(np.mean(minhash(PASSAGE) == minhash(edition)), 0.8)
+        self.assertLess(np.mean(minhash(PASSAGE) == minhash(OTHER_PASSAGE)), 0.2)
+
+    def test_near_duplicate_chunks_are_not_embedded(self):
+        original = self.add_document("first edition", f"{PASSAGE}\n{OTHER_PASSAGE}")
+        ingest_documents()
+        embedded = self.embeddings.texts_embedded
+
+        reprint = self.add_document("reprint", f"{PASSAGE.upper()}!\nsomething new")
+        summary = ingest_documents()
+
+        self.assertEqual(summary["chunks_deduplicated"], 1)
+        self.assertEqual(summary["embeddings_saved"], 1)
+        self.assertEqual(summary["index_bytes_saved"], len(PASSAGE) + 1 + 16 * 4)
+        self.assertEqual(self.embeddings.texts_embedded, embedded + 1)
+        self.assertEqual(
+            self.collection_ids(),
+            self.chunk_ids(original, [PASSAGE, OTHER_PASSAGE])
+            | set(document_chunk_ids(reprint.id, [("something new", 1)], Counter())),
+        )
+        manifest = IngestionManifest.load(self.live())
+        self.assertEqual(manifest.get(reprint.id)["duplicate_of"], [str(original.id)])
+
+    def test_removing_the_original_reingests_its_duplicates(self):
+        original = self.add_document("first edition", PASSAGE)
+        ingest_documents()
+        reprint = self.add_document("reprint", PASSAGE.upper())
+        ingest_documents()
+        self.assertEqual(self.collection_ids(), self.chunk_ids(original, [PASSAGE]))
+
+        original.delete()
+        summary = ingest_documents()
+
+        self.assertEqual(summary["removed"], 1)
+        self.assertEqual(summary["updated"], 1)
+        self.assertEqual(self.collection_ids(), self.chunk_ids(reprint, [PASSAGE.upper()]))
+
+    @override_settings(RAG_DEDUP_THRESHOLD=0)
+    def test_deduplication_can_be_disabled(self):
+        self.add_document("first edition", PASSAGE)
+        self.add_document("reprint", PASSAGE)
+        summary = ingest_documents()
+
+        self.assertNotIn("chunks_deduplicated", summary)
+        self.assertEqual(len(self.collection_ids()), 2)
+
+
+class IngestionJobTest(IngestionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(email="admin@example.com", password="password123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def upload(self, name, text):
+        return self.client.post(
+            "/api/rag/documents/upload/",
+            {"file": SimpleUploadedFile(name, text.encode("utf-8"))},
+            format="multipart",
+        )
+
+    def test_upload_queues_a_job_instead_of_ingesting(self):
+        with patch("rag.utils.ingest_documents") as ingest:
+            response = self.upload("first.txt", "one\ntwo")
+
+        self.assertEqual(response.status_code, 202)
+        ingest.assert_not_called()
+        job = IngestionJob.objects.get(pk=response.data["job_id"])
+        self.assertEqual(job.status, IngestionJob.QUEUED)
+
+    def test_uploads_share_a_waiting_job(self):
+        first = self.upload("first.txt", "one")
+        second = self.upload("second.txt", "two")
+
+        self.assertEqual(first.data["job_id"], second.data["job_id"])
+        self.assertEqual(IngestionJob.objects.count(), 1)
+
+    def test_worker_records_progress(self):
+        job_id = self.upload("first.txt", "one\ntwo\nthree").data["job_id"]
+
+        self.assertEqual(run_pending_jobs(), 1)
+
+        response = self.client.get(f"/api/rag/jobs/{job_id}/")
+        self.assertEqual(response.data["status"], IngestionJob.SUCCEEDED)
+        self.assertEqual(response.data["documents_done"], 1)
+        self.assertEqual(response.data["pages_parsed"], 3)
+        self.assertEqual(response.data["chunks_embedded"], 3)
+        self.assertEqual(response.data["summary"]["added"], 1)
+        self.assertIsNotNone(response.data["chunks_per_second"])
+
+    def test_document_errors_are_recorded_on_the_job(self):
+        job_id = self.upload("empty.txt", "").data["job_id"]
+
+        run_pending_jobs()
+
+        job = IngestionJob.objects.get(pk=job_id)
+        self.assertEqual(job.status, IngestionJob.SUCCEEDED)
+        self.assertEqual(job.summary["failed"], 1)
+        self.assertEqual(len(job.errors), 1)
+
+    def retrieved_texts(self, query="two"):
+        retriever = Retriever(persist_directory=self.index_dir)
+        return {document.page_content for document in retriever.similarity_search(query, k=10)}
+
+    @override_settings(RAG_INDEX_CHECK_INTERVAL=0)
+    def test_delete_hides_the_chunks_right_away(self):
+        keep = self.add_document("keep", "one")
+        gone = self.add_document("gone", "two\nthree")
+        ingest_documents()
+
+        response = self.client.delete(f"/api/rag/documents/{gone.id}/delete/")
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data["removed_chunks"], 2)
+        self.assertEqual(self.retrieved_texts(), {"one"})
+        run_pending_jobs()
+        self.assertIsNone(IngestionManifest.load(self.live()).get(gone.id))
+        self.assertEqual(self.collection_ids(), self.chunk_ids(keep, ["one"]))
+        self.assertEqual(read_tombstones(self.index_dir), frozenset())
+
+    @override_settings(RAG_INDEX_CHECK_INTERVAL=0, RAG_VECTOR_INDEX="mmap", RAG_HYBRID_SEARCH=True)
+    def test_delete_hides_the_chunks_from_the_derived_indexes(self):
+        self.add_document("keep", "one")
+        gone = self.add_document("gone", "two\nthree")
+        ingest_documents()
+        retriever = Retriever(persist_directory=self.index_dir)
+        self.assertIsInstance(retriever.get_store(), MmapIndex)
+        self.assertIn("two", {document.page_content for document in retriever.similarity_search("two", k=10)})
+
+        self.client.delete(f"/api/rag/documents/{gone.id}/delete/")
+
+        self.assertEqual({document.page_content for document in retriever.similarity_search("two", k=10)}, {"one"})
+        snapshot = retriever.get_snapshot()
+        self.assertEqual(snapshot.deleted, {str(gone.id)})
+        self.assertEqual(snapshot.lexical.search("two three", k=10, deleted=snapshot.deleted), [])
+
+    @override_settings(RAG_INDEX_CHECK_INTERVAL=0)
+    def test_delete_during_a_build_is_hidden_as_well(self):
+        keep = self.add_document("keep", "one")
+        gone = self.add_document("gone", "two")
+        ingest_documents()
+
+        with build_lock(self.index_dir):
+            response = self.client.delete(f"/api/rag/documents/{gone.id}/delete/")
+            self.assertEqual(self.retrieved_texts(), {"one"})
+
+        self.assertEqual(response.data["removed_chunks"], 1)
+        run_pending_jobs()
+        self.assertEqual(self.collection_ids(), self.chunk_ids(keep, ["one"]))
+        self.assertEqual(read_tombstones(self.index_dir), frozenset())
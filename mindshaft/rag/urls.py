@@ -1,10 +1,12 @@
 from django.urls import path
-from .views import DocumentUploadView, ScanAndUploadFolderView, DocumentDeleteView, DocumentsListView
+from .views import DocumentUploadView, ScanAndUploadFolderView, DocumentDeleteView, DocumentsListView, IngestionJobListView, IngestionJobDetailView
 
 urlpatterns = [
     path('documents/view/', DocumentsListView.as_view(), name='document-view'),
     path('documents/upload/', DocumentUploadView.as_view(), name='document-upload'),
     path('documents/<int:pk>/delete/', DocumentDeleteView.as_view(), name='document-delete'),
     path('documents/scan-upload/', ScanAndUploadFolderView.as_view(), name='scan-upload'),
+    path('jobs/', IngestionJobListView.as_view(), name='ingestion-jobs'),
+    path('jobs/<int:pk>/', IngestionJobDetailView.as_view(), name='ingestion-job'),
 
 ]
\ No newline at end of file
@@ -1,118 +1,517 @@
+import hashlib
+import itertools
 import os
-import shutil
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from langchain_community.document_loaders import PyPDFLoader
+from collections import Counter
+from queue import Empty
+from chromadb.api.client import SharedSystemClient
 from langchain_chroma import Chroma
-from langchain_openai import OpenAIEmbeddings
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from .models import Document  # Import your Django model
 from langchain.schema import Document as LangChainDocument  # Rename to avoid conflicts
-import tiktoken
 
-# Directory to store Chroma DB
-CHROMA_DB_DIR = os.path.join(settings.BASE_DIR, 'rag', 'chroma_db')
+from .chunk_store import get_chunk_store
+from .generations import (
+    activate_generation, add_tombstone, build_lock, create_generation, discard_generation, live_generation,
+    prune_tombstones, read_current, read_history,
+)
+from .dedup import ChunkDeduplicator
+from .embedding_cache import ContentAddressedEmbeddings, cache_key
+from .embeddings import get_document_embeddings, get_embedding_model, index_embedding_model
+from .manifest import IngestionManifest, plan_changes
+from .lexical_index import FORMAT as LEXICAL_FORMAT, POINTER_FILE as LEXICAL_POINTER, build_lexical_index
+from .mmap_index import build_mmap_index, current_build
+from .parsing import (
+    BATCH, DONE, ERROR, MAX_TOKENS, iter_pdf_batches, parse_executor, parse_queue, peak_rss_mb, rss_mb, stream_pdf,
+)
+from .retriever import CHROMA_DB_DIR, mark_index_updated
 
-# Define the maximum tokens allowed per chunk
-MAX_TOKENS = 1000  # Adjust as needed
+def chunking_options():
+    """
+    Chunker settings. They are recorded in the manifest; changing them re-chunks every document.
+    """
+    return {'max_tokens': settings.RAG_CHUNK_MAX_TOKENS, 'overlap': settings.RAG_CHUNK_OVERLAP}
+
+def to_langchain_documents(doc, chunks):
+    """
+    Turn (text, page) chunks from the parser into LangChain documents for the vector store.
+    """
+    return [
+        LangChainDocument(
+            page_content=text,
+            metadata={'id': str(doc.id), 'source_file': doc.file.name, 'page': page},
+        )
+        for text, page in chunks
+    ]
+
+def document_chunk_ids(doc_id, chunks, occurrences):
+    """
+    Deterministic ids "<document id>:<content hash>:<ordinal>" for (text, page)
+    chunks. The ordinal counts the document's earlier chunks with the same
+    content, tracked in `occurrences` (a Counter), so unchanged chunks keep
+    their id when text is added or removed around them.
+    """
+    ids = []
+    for text, page in chunks:
+        content_hash = hashlib.sha256(f"{page}\0{text}".encode('utf-8')).hexdigest()[:16]
+        ids.append(f"{doc_id}:{content_hash}:{occurrences[content_hash]}")
+        occurrences[content_hash] += 1
+    return ids
 
-def chunk_text_with_tiktoken(text, max_tokens=MAX_TOKENS, model='text-embedding-ada-002'):
+def stream_documents(changes, workers, batch_size, max_tokens=MAX_TOKENS, overlap=0):
     """
-    Use tiktoken to split text into chunks of specified token size.
+    Yield (change, kind, payload) as the changed documents are parsed: BATCH
+    events with (pages_read, chunks), then one DONE (payload: the parser's
+    peak RSS in MB) or ERROR (payload: the message) per document.
+
+    With workers > 0 documents are parsed in that many processes while the
+    caller embeds and writes the batches already received; with 0 they are
+    parsed here, one at a time.
     """
-    encoding = tiktoken.encoding_for_model(model)
-    tokens = encoding.encode(text)
-    # Split tokens into chunks of max_tokens
-    for i in range(0, len(tokens), max_tokens):
-        chunk_tokens = tokens[i:i+max_tokens]
-        chunk_text = encoding.decode(chunk_tokens)
-        yield chunk_text
+    if workers <= 0:
+        for change in changes:
+            try:
+                for batch in iter_pdf_batches(change.document.file.path, batch_size, max_tokens, overlap):
+                    yield change, BATCH, batch
+            except Exception as e:
+                yield change, ERROR, str(e)
+            else:
+                yield change, DONE, peak_rss_mb()
+        return
 
-def process_document(doc):
-    """Process a single document: extract text, split into pages, then chunk each page using tiktoken."""
+    queue = parse_queue(workers)
+    executor = parse_executor(workers, queue)
+    pending = {}
+    futures = {}
     try:
-        file_path = doc.file.path
-        doc_id = str(doc.id)
-        loader = PyPDFLoader(file_path)
-        pages = loader.load()  # Load pages without pre-splitting
-
-        processed_pages = []
-        for page in pages:
-            # page.page_content should have the text of the page
-            page_text = page.page_content
-            # Chunk the page text using tiktoken
-            for chunk in chunk_text_with_tiktoken(page_text, max_tokens=MAX_TOKENS):
-                # Create a new LangChainDocument with the chunk
-                chunked_page = LangChainDocument(
-                    page_content=chunk,
-                    metadata={'id': doc_id, 'source_file': doc.file.name}
-                )
-                processed_pages.append(chunked_page)
+        for key, change in enumerate(changes):
+            pending[key] = change
+            futures[key] = executor.submit(
+                stream_pdf, key, change.document.file.path, batch_size, max_tokens, overlap
+            )
+
+        while pending:
+            try:
+                kind, key, payload = queue.get(timeout=1)
+            except Empty:
+                # A worker that died never reports; do not wait for it forever
+                for key, future in futures.items():
+                    if key in pending and future.done() and future.exception() is not None:
+                        yield pending.pop(key), ERROR, str(future.exception())
+                continue
+            change = pending[key] if kind == BATCH else pending.pop(key)
+            yield change, kind, payload
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Workers blocked on a full queue only finish once it is drained
+        while not all(future.done() for future in futures.values()):
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+        executor.shutdown()
+
+def replay_documents(changes, chunk_store, batch_size):
+    """
+    Yield the same (change, kind, payload) events as stream_documents for
+    documents whose chunks are all in the chunk store, reading them from there
+    instead of parsing the PDF. `changes` maps each change to its chunk ids.
+    """
+    for change, chunk_ids in changes.items():
+        for start in range(0, len(chunk_ids), batch_size):
+            chunks = chunk_store.get_many(chunk_ids[start:start + batch_size])
+            if chunks is None:
+                yield change, ERROR, "Chunks missing from the chunk store."
+                break
+            yield change, BATCH, (len({page for text, page in chunks}), chunks)
+        else:
+            yield change, DONE, 0
+
+class IngestionProgress:
+    """
+    Receives progress from ingest_documents. This one ignores it; the ingestion
+    worker passes one that records it on the IngestionJob.
+    """
+
+    def started(self, documents_total):
+        pass
+
+    def chunks_added(self, doc_id, pages, chunks):
+        pass
+
+    def document_done(self, doc_id):
+        pass
 
-        print(f"Processed document ID {doc_id} into {len(processed_pages)} chunked pages.")
-        return processed_pages
-    except Exception as e:
-        print(f"Error processing document ID {doc.id}: {e}")
-        return []
+    def document_failed(self, doc_id, error):
+        pass
 
-def ingest_documents(max_threads=4):
+def ingest_documents(workers=None, progress=None, batch_size=None):
     """
-    Process uploaded documents in parallel, extract text, chunk with tiktoken, 
-    create embeddings, and store in Chroma DB immediately after each document is processed.
+    Bring the vector index in line with the Document table.
+
+    Only the differences recorded against the ingestion manifest are processed:
+    new documents are chunked and added, changed files have their chunks replaced
+    and removed documents have their chunks deleted. Unchanged documents cost a
+    stat() call. Returns a dict with the number of documents in each group and
+    the peak memory of the run. Progress is reported to `progress` (an
+    IngestionProgress).
+
+    Documents are parsed page by page by `workers` processes (RAG_PARSE_WORKERS
+    by default) and embedded and written in batches of `batch_size` chunks
+    (RAG_INGEST_BATCH_SIZE) here, so memory does not grow with document size.
+
+    The live index is never written to: changes go into a new generation, a copy
+    of the live one or an empty one when the index has to be rebuilt, which goes
+    live once check_generation passes.
     """
-    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
-    all_documents = Document.objects.all()
+    if (settings.RAG_VECTOR_INDEX == 'mmap' or settings.RAG_HYBRID_SEARCH) and not settings.RAG_CHUNK_STORE_DIR:
+        raise ImproperlyConfigured(
+            "The memory-mapped and BM25 indexes read chunk text from the chunk store; set RAG_CHUNK_STORE_DIR."
+        )
+    if workers is None:
+        workers = settings.RAG_PARSE_WORKERS
+    if batch_size is None:
+        batch_size = settings.RAG_INGEST_BATCH_SIZE
+    progress = progress or IngestionProgress()
+    with build_lock(CHROMA_DB_DIR):
+        return _ingest_documents(workers, progress, batch_size)
+
+def _ingest_documents(workers, progress, batch_size):
+    live = live_generation(CHROMA_DB_DIR)
+    rebuild = None
+    if live is not None and not IngestionManifest.exists(live):
+        # Index built before the manifest existed: its chunks cannot be matched to
+        # documents, so start over once instead of adding duplicates.
+        rebuild = "Vector index has no manifest. Rebuilding it from scratch."
+    manifest = IngestionManifest.load(live) if live is not None and not rebuild else IngestionManifest(live)
+    indexed_documents, indexed_chunking = dict(manifest.documents), manifest.chunking
+    embedding_model = get_embedding_model()
+    indexed_model = index_embedding_model({'embedding_model': manifest.embedding_model})
+    if manifest.documents and indexed_model != embedding_model:
+        # Vectors of different models cannot share a collection
+        rebuild = f"Embedding model changed from {indexed_model} to {embedding_model}. Rebuilding the index."
+        manifest = IngestionManifest(live)
+    if rebuild:
+        print(rebuild)
+    manifest.embedding_model = embedding_model
+    chunking = chunking_options()
+    rechunk = bool(manifest.documents) and manifest.chunking != chunking
+    if rechunk:
+        print(f"Chunking changed from {manifest.chunking} to {chunking}. Re-chunking every document.")
+    manifest.chunking = chunking
+    changes, removed, unchanged = plan_changes(Document.objects.all(), manifest, force=rechunk)
+    summary = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': unchanged, 'failed': 0}
 
-    documents_added = False
+    # Documents chunked the same way from the same file as in the index (say,
+    # when only the embedding model changed) are not parsed again. Those with
+    # near-duplicates dropped are: their stored chunks are not all of them.
+    chunk_store = get_chunk_store()
+    replayed = {}  # change -> its chunk ids in the chunk store
+    if chunk_store is not None and indexed_chunking == chunking:
+        for change in changes:
+            entry = indexed_documents.get(str(change.document.id))
+            if (
+                entry and entry['file_hash'] == change.file_hash and entry['chunk_ids']
+                and not entry.get('duplicate_of') and all(chunk_id in chunk_store for chunk_id in entry['chunk_ids'])
+            ):
+                replayed[change] = entry['chunk_ids']
+    if replayed:
+        summary['replayed'] = len(replayed)
+    peak_rss = rss_mb()
+    parser_peak_rss = 0
+    progress.started(len(changes))
+
+    derived_missing = live is not None and (
+        (settings.RAG_VECTOR_INDEX == 'mmap' and current_build(live) is None)
+        or (settings.RAG_HYBRID_SEARCH and current_build(live, LEXICAL_POINTER, LEXICAL_FORMAT) is None)
+    )
+    if not (changes or removed or rebuild or derived_missing):
+        if live is not None:
+            # Only file times may have changed
+            manifest.save()
+            prune_tombstones(CHROMA_DB_DIR, manifest.documents)
+        summary['peak_rss_mb'] = rss_mb()
+        summary['parser_peak_rss_mb'] = 0
+        print(f"Ingestion finished, index unchanged: {summary}")
+        return summary
+
+    generation = create_generation(CHROMA_DB_DIR, copy_from=None if rebuild or live is None else live)
+    manifest.index_dir = generation
+    try:
+        vector_store = open_vector_store(generation)
+        deduplicator = None
+        if settings.RAG_DEDUP_THRESHOLD:
+            deduplicator = ChunkDeduplicator.load(generation, settings.RAG_DEDUP_THRESHOLD, vector_store._collection)
 
-    with ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = {executor.submit(process_document, doc): doc for doc in all_documents}
+        for doc_id in removed:
+            entry = manifest.remove(doc_id)
+            if deduplicator is not None:
+                deduplicator.remove(entry['chunk_ids'])
+            count = delete_document_chunks(doc_id, vector_store)
+            summary['removed'] += 1
+            print(f"Removed {count} chunks of deleted document ID {doc_id}.")
 
-        for future in as_completed(futures):
+        # A changed document must not count as a duplicate of its own previous version
+        suspended = {}  # change -> signatures of its previous chunks, restored if it fails
+        if deduplicator is not None:
+            for change in changes:
+                if change.previous:
+                    suspended[change] = deduplicator.remove(change.previous['chunk_ids'])
+        duplicate_of = {}  # change -> documents its dropped chunks duplicate
+        dropped_texts = 0
+        dropped_bytes = 0
+        embeddings_saved = 0
+
+        written = {}  # change -> ids of the chunks seen so far this run
+        occurrences = {}  # change -> Counter of its chunks' content hashes
+        failed = set()
+        events = itertools.chain(
+            replay_documents(replayed, chunk_store, batch_size),
+            stream_documents(
+                [change for change in changes if change not in replayed], workers, batch_size, **chunking
+            ),
+        )
+        for change, kind, payload in events:
+            if change in failed:
+                continue
+            doc = change.document
+            chunk_ids = written.setdefault(change, [])
+            previous_ids = change.previous['chunk_ids'] if change.previous else []
             try:
-                chunks = future.result()
-                if chunks:
-                    # As soon as we have chunks, add them to Chroma DB
-                    add_documents_to_chroma(chunks)
-                    print(f"Added {len(chunks)} chunks to Chroma DB.")
-                    documents_added = True
+                if kind == BATCH:
+                    pages, chunks = payload
+                    if chunks:
+                        ids = document_chunk_ids(doc.id, chunks, occurrences.setdefault(change, Counter()))
+                        if deduplicator is not None:
+                            # Near-duplicates are dropped before they are embedded
+                            ids, chunks, dropped, duplicated = deduplicator.filter(ids, chunks)
+                            duplicated.discard(str(doc.id))
+                            duplicate_of.setdefault(change, set()).update(duplicated)
+                            if dropped:
+                                dropped_texts += len(dropped)
+                                dropped_bytes += sum(len(text.encode('utf-8')) for text, page in dropped)
+                                embeddings_saved += uncached_count(
+                                    vector_store.embeddings, [text for text, page in dropped]
+                                )
+                        if chunk_store is not None:
+                            chunk_store.append(ids, chunks)
+                        # Chunks the previous version already has are left as they are
+                        kept = set(previous_ids).intersection(ids) if previous_ids else ()
+                        new = [(chunk_id, chunk) for chunk_id, chunk in zip(ids, chunks) if chunk_id not in kept]
+                        if new:
+                            add_documents_to_chroma(
+                                to_langchain_documents(doc, [chunk for chunk_id, chunk in new]),
+                                [chunk_id for chunk_id, chunk in new],
+                                vector_store=vector_store,
+                            )
+                        chunk_ids.extend(ids)
+                    progress.chunks_added(doc.id, pages, len(chunks))
+                    peak_rss = max(peak_rss, rss_mb())
+                    continue
+
+                if kind == ERROR:
+                    raise RuntimeError(payload)
+                parser_peak_rss = max(parser_peak_rss, payload)
+                if not occurrences.get(change):
+                    raise RuntimeError("No text could be extracted.")
+
+                stale = sorted(set(previous_ids) - set(chunk_ids))
+                if stale:
+                    vector_store.delete(stale)
+                manifest.record(
+                    doc.id, change.file_hash, change.size, change.mtime, chunk_ids,
+                    duplicate_of=duplicate_of.pop(change, ()),
+                )
+                del written[change]
+                occurrences.pop(change, None)
+                suspended.pop(change, None)
+
+                summary['updated' if change.previous else 'added'] += 1
+                progress.document_done(doc.id)
+                print(f"Added {len(chunk_ids)} chunks of document ID {doc.id} to Chroma DB.")
             except Exception as e:
-                doc = futures[future]
+                failed.add(change)
+                written.pop(change, None)
+                occurrences.pop(change, None)
+                duplicate_of.pop(change, None)
+                if deduplicator is not None:
+                    deduplicator.remove(chunk_ids)
+                    previous = suspended.pop(change, {})
+                    deduplicator.add_many(list(previous), list(previous.values()))
+                # Drop chunks beyond the previous version; the manifest still has the
+                # old hash, so the document is retried on the next run.
+                extra = sorted(set(chunk_ids) - set(previous_ids))
+                if extra:
+                    vector_store.delete(extra)
+                summary['failed'] += 1
+                progress.document_failed(doc.id, str(e))
                 print(f"Error processing document ID {doc.id}: {e}")
 
-    if not documents_added:
-        # If no documents were processed or no chunks created, clear the vector store
-        clear_chroma_db()
+        manifest.save()
+        if deduplicator is not None:
+            deduplicator.save(generation, {
+                chunk_id for entry in manifest.documents.values() for chunk_id in entry['chunk_ids']
+            })
+            summary['chunks_deduplicated'] = dropped_texts
+            summary['embeddings_saved'] = embeddings_saved
+            summary['index_bytes_saved'] = dropped_bytes + dropped_texts * 4 * index_dimension(vector_store)
+        # The derived indexes of the generation this one was copied from are
+        # updated with what changed instead of being rebuilt
+        copied_from = None if rebuild else live
+        derived = {}
+        if settings.RAG_VECTOR_INDEX == 'mmap':
+            previous = current_build(copied_from) if copied_from else None
+            derived['memory-mapped'] = build_vector_index(vector_store, generation, chunk_store, previous)['count']
+        if settings.RAG_HYBRID_SEARCH:
+            previous = current_build(copied_from, LEXICAL_POINTER, LEXICAL_FORMAT) if copied_from else None
+            derived['BM25'] = build_lexical_index(generation, vector_store._collection, chunk_store, previous)
+        check_generation(vector_store, manifest, derived)
+        mark_index_updated(generation)
+    except BaseException:
+        discard_generation(CHROMA_DB_DIR, generation)
+        raise
+    finally:
+        # Drop this run's Chroma clients; older generations get deleted under them
+        SharedSystemClient.clear_system_cache()
+
+    # Workers' retrievers switch to the new generation on their next query
+    activate_generation(CHROMA_DB_DIR, generation, keep=settings.RAG_INDEX_GENERATIONS)
+    prune_tombstones(CHROMA_DB_DIR, manifest.documents)
+    if chunk_store is not None:
+        compact_chunk_store(chunk_store)
 
-def add_documents_to_chroma(documents):
+    summary['peak_rss_mb'] = max(peak_rss, rss_mb())
+    summary['parser_peak_rss_mb'] = parser_peak_rss
+    print(f"Ingestion finished: {summary}")
+    return summary
+
+def referenced_chunk_ids(root):
     """
-    Add documents to Chroma DB.
+    Ids of the chunks the manifests of the generations on disk list, or None
+    if one of them has no manifest.
     """
-    embeddings = OpenAIEmbeddings(openai_api_key=settings.OPENAI_API_KEY, model='text-embedding-ada-002')
-    vector_store = Chroma(
-        collection_name='documents',
-        persist_directory=CHROMA_DB_DIR,
-        embedding_function=embeddings
-    )
-    vector_store.add_documents(documents)
+    chunk_ids = set()
+    for name in {*read_history(root), read_current(root)} - {None}:
+        path = os.path.normpath(os.path.join(root, name))
+        if not os.path.isdir(path):
+            continue
+        if not IngestionManifest.exists(path):
+            return None
+        for entry in IngestionManifest.load(path).documents.values():
+            chunk_ids.update(entry['chunk_ids'])
+    return chunk_ids
+
+def compact_chunk_store(chunk_store):
+    """
+    Drop the chunks no generation that can still go live refers to, once
+    enough of them have piled up (see ChunkStore.compact). Runs under the
+    build lock, after a new generation went live and older ones were pruned.
+    """
+    keep = referenced_chunk_ids(CHROMA_DB_DIR)
+    if keep is None:
+        return 0
+    dropped = chunk_store.compact(keep)
+    if dropped:
+        print(f"Dropped {dropped} unreferenced chunks from the chunk store.")
+    return dropped
 
-def clear_chroma_db():
+def uncached_count(embeddings, texts):
     """
-    Clear Chroma DB if no documents are available.
+    How many of texts the ingestion embeddings would have sent to the model.
     """
-    if os.path.exists(CHROMA_DB_DIR):
-        shutil.rmtree(CHROMA_DB_DIR)
-    print("No documents to ingest. Cleared Chroma DB.")
+    if not isinstance(embeddings, ContentAddressedEmbeddings):
+        return len(texts)
+    keys = {cache_key(embeddings.model, text) for text in texts}
+    return len(keys - set(embeddings.store.get_many(keys)))
 
-def get_relevant_context(query):
+def index_dimension(vector_store):
     """
-    Retrieve relevant context from Chroma DB based on the user's message.
+    Length of the vectors in the collection, 0 if it is empty.
     """
-    embeddings = OpenAIEmbeddings(openai_api_key=settings.OPENAI_API_KEY, model='text-embedding-ada-002')
-    vector_store = Chroma(
+    page = vector_store._collection.get(limit=1, include=['embeddings'])
+    return len(page['embeddings'][0]) if page['ids'] else 0
+
+def check_generation(vector_store, manifest, derived):
+    """
+    Make sure a new generation is complete before it goes live: the collection
+    holds exactly the chunks of the manifest, and each derived index ({name:
+    number of chunks}) all of them.
+    """
+    expected = manifest.chunk_count()
+    count = vector_store._collection.count()
+    if count != expected:
+        raise RuntimeError(f"New index holds {count} chunks but its manifest lists {expected}.")
+    for name, derived_count in derived.items():
+        if derived_count != count:
+            raise RuntimeError(f"New {name} index holds {derived_count} chunks, not {count}.")
+
+def open_vector_store(directory):
+    """
+    Open the Chroma collection of an index generation for writing, embedding
+    through the chunk store.
+    """
+    model = get_embedding_model()
+    return Chroma(
         collection_name='documents',
-        persist_directory=CHROMA_DB_DIR,
-        embedding_function=embeddings
+        persist_directory=directory,
+        embedding_function=get_document_embeddings(model),
+        # Only applied when the collection is created; the retriever checks it
+        collection_metadata={'embedding_model': model},
+    )
+
+def build_vector_index(vector_store, directory, chunk_store, previous=None, **options):
+    """
+    Export the Chroma collection into a new memory-mapped build in directory,
+    clustered as the RAG_IVF_* settings say unless options override them, and
+    based on the build in `previous` where possible. Returns its meta.
+    """
+    options = {
+        'dtype': settings.RAG_MMAP_DTYPE,
+        'nlist': settings.RAG_IVF_LISTS,
+        'min_rows': settings.RAG_IVF_MIN_ROWS,
+        **options,
+    }
+    return build_mmap_index(
+        directory,
+        vector_store._collection,
+        index_embedding_model(vector_store._collection.metadata),
+        chunk_store,
+        previous=previous,
+        **options
     )
-    docs = vector_store.similarity_search(query, k=3)
-    context = "\n".join([doc.page_content for doc in docs])
-    return context
+
+def add_documents_to_chroma(documents, ids=None, vector_store=None):
+    """
+    Add documents to Chroma DB, replacing chunks that already have their ids.
+    """
+    if vector_store is None:
+        vector_store = open_vector_store(live_generation(CHROMA_DB_DIR) or CHROMA_DB_DIR)
+    vector_store.add_documents(documents, ids=ids)
+
+def delete_document_chunks(doc_id, vector_store=None):
+    """
+    Delete every chunk of a document from Chroma DB, found through the
+    document id in the chunk metadata. Returns the number of chunks deleted.
+    """
+    if vector_store is None:
+        vector_store = open_vector_store(live_generation(CHROMA_DB_DIR) or CHROMA_DB_DIR)
+    ids = vector_store._collection.get(where={'id': str(doc_id)}, include=[])['ids']
+    if ids:
+        vector_store.delete(ids)
+    return len(ids)
+
+def remove_document_from_index(doc_id):
+    """
+    Hide a document's chunks from retrieval right away. Its id is added to the
+    index's tombstones, which the workers' retrievers filter out of the vector
+    and BM25 searches alike; the queued ingestion run builds a generation
+    without the document and drops the tombstone. Nothing is written to the
+    live generation, so this works while a build holds the lock. Returns the
+    number of chunks the live generation has of the document.
+    """
+    add_tombstone(CHROMA_DB_DIR, doc_id)
+    live = live_generation(CHROMA_DB_DIR)
+    if live is None or not IngestionManifest.exists(live):
+        return 0
+    entry = IngestionManifest.load(live).documents.get(str(doc_id))
+    return len(entry['chunk_ids']) if entry else 0
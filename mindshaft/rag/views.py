@@ -2,19 +2,27 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
-from .models import Document, IngestionStatus
-from .serializers import DocumentSerializer
-from .utils import ingest_documents
-from langchain_chroma import Chroma
+from .models import Document, IngestionJob
+from .serializers import DocumentSerializer, IngestionJobSerializer
+from .utils import remove_document_from_index
 import os
-from django.conf import settings
 from django.core.files import File
+from django.urls import reverse
 
 from users.decorators import email_verified_required
 from django.utils.decorators import method_decorator
 
 
-CHROMA_DB_DIR = os.path.join(settings.BASE_DIR, 'rag', 'chroma_db')
+def queued_response(request, message, job, **extra):
+    """
+    202 response pointing the client at the ingestion job to poll.
+    """
+    return Response({
+        'message': message,
+        'job_id': job.id,
+        'status_url': request.build_absolute_uri(reverse('ingestion-job', args=[job.id])),
+        **extra,
+    }, status=status.HTTP_202_ACCEPTED)
 
 class DocumentUploadView(APIView):
     """
@@ -23,12 +31,6 @@ class DocumentUploadView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        # Check if ingestion is in progress
-        #//TODO ENable this
-        # ingestion_status = IngestionStatus.get_status()
-        # if ingestion_status.is_ingesting:
-        #     return Response({'error': 'Ingestion is in progress. Please wait until it completes.'}, status=status.HTTP_400_BAD_REQUEST)
-
         # Handle multiple files
         files = request.FILES.getlist('file')
 
@@ -44,22 +46,10 @@ class DocumentUploadView(APIView):
             document.save()
             documents.append(document)
 
-        # Start the ingestion process
-        self.run_ingestion()
+        # The ingestion worker picks the documents up
+        job = IngestionJob.enqueue(request.user)
 
-        return Response({'message': 'Documents uploaded successfully. Ingestion completed.'}, status=status.HTTP_201_CREATED)
-
-
-    def run_ingestion(self):
-        ingestion_status = IngestionStatus.get_status()
-        ingestion_status.is_ingesting = True
-        ingestion_status.save()
-
-        try:
-            ingest_documents()
-        finally:
-            ingestion_status.is_ingesting = False
-            ingestion_status.save()
+        return queued_response(request, 'Documents uploaded successfully. Ingestion queued.', job)
 
 
 #//TODO Change the permissions to admin only
@@ -102,13 +92,13 @@ class ScanAndUploadFolderView(APIView):
                 document.save()
                 documents.append(document)
 
-        # Run the ingestion process
-        ingest_documents()
+        # The ingestion worker picks the documents up
+        job = IngestionJob.enqueue(request.user)
 
-        return Response({
-            'message': 'PDF files uploaded and ingested successfully.',
-            'uploaded_files': [doc.title for doc in documents]
-        }, status=status.HTTP_201_CREATED)
+        return queued_response(
+            request, 'PDF files uploaded successfully. Ingestion queued.', job,
+            uploaded_files=[doc.title for doc in documents],
+        )
 
     def get_pdf_files(self, folder_path):
         """
@@ -133,8 +123,7 @@ class DocumentDeleteView(APIView):
 
     def delete(self, request, pk):
         # Check if ingestion is in progress
-        ingestion_status = IngestionStatus.get_status()
-        if ingestion_status.is_ingesting:
+        if IngestionJob.is_running():
             return Response({'error': 'Ingestion is in progress. Please wait until it completes.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
@@ -142,33 +131,19 @@ class DocumentDeleteView(APIView):
             if not document:
                 return Response({'error': 'Document not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-            # Start ingestion in a new thread
-            if not os.path.exists(CHROMA_DB_DIR):
-                self.run_ingestion()
-
-            vector_store = Chroma(
-                collection_name='documents',
-                persist_directory=CHROMA_DB_DIR
-            )
-            vector_store.delete([str(pk)])
-
+            doc_id = document.id
             os.remove(document.file.path)
             document.delete()
-            return Response({'message': 'Document deleted successfully. Ingestion completed.'}, status=status.HTTP_200_OK)
+
+            # Retrieval stops returning its chunks now; the worker rebuilds the index without them
+            removed_chunks = remove_document_from_index(doc_id)
+            job = IngestionJob.enqueue(request.user)
+            return queued_response(
+                request, 'Document deleted successfully. Index update queued.', job, removed_chunks=removed_chunks
+            )
         except Document.DoesNotExist:
             return Response({'error': 'Document not found.'}, status=status.HTTP_404_NOT_FOUND)
 
-    def run_ingestion(self):
-        ingestion_status = IngestionStatus.get_status()
-        ingestion_status.is_ingesting = True
-        ingestion_status.save()
-
-        try:
-            ingest_documents()
-        finally:
-            ingestion_status.is_ingesting = False
-            ingestion_status.save()
-
 
 #@method_decorator(email_verified_required, name='dispatch')
 class DocumentsListView(APIView):
@@ -180,4 +155,30 @@ class DocumentsListView(APIView):
     def get(self, request):
         documents = Document.objects.all()
         serializer = DocumentSerializer(documents, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+
+class IngestionJobListView(APIView):
+    """
+    View to list recent ingestion jobs.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        jobs = IngestionJob.objects.all()[:20]
+        serializer = IngestionJobSerializer(jobs, many=True)
+        return Response(serializer.data)
+
+
+class IngestionJobDetailView(APIView):
+    """
+    View to poll the progress of an ingestion job.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        try:
+            job = IngestionJob.objects.get(pk=pk)
+        except IngestionJob.DoesNotExist:
+            return Response({'error': 'Ingestion job not found.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(IngestionJobSerializer(job).data)
@@ -1,13 +1,30 @@
 import logging
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 from django.utils.timezone import now
 
 logger = logging.getLogger(__name__)
 
 class ResetDailyLimitMiddleware:
+    # Supports both modes so async views are not forced back onto a thread
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        self.reset_daily_limit(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        await sync_to_async(self.reset_daily_limit)(request)
+        return await self.get_response(request)
+
+    def reset_daily_limit(self, request):
         if request.user.is_authenticated:
             logger.info(f"Middleware invoked for user {request.user.email}")
             print(request.user.credits_used_today)
@@ -19,13 +36,17 @@ class ResetDailyLimitMiddleware:
 
         else: 
             logger.info("Middleware invoked for anonymous user")
-        return self.get_response(request)
 
 
 
 class DebugMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
         print("DebugMiddleware executed!")  # This should print for every request